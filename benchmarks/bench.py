@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# bench.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""
+Offline benchmark of the snapshot run over synthetic fleets (fake EC2/SNS, no network)
+
+ex: python benchmarks/bench.py --sizes 10,100,1000,10000 --latency 0.005 --concurrency 10
+"""
+
+from __future__ import print_function
+
+import gc
+import json
+import os
+import sys
+import time
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake import VOLUMES_PER_INSTANCE
+from benchmarks.fake import FakeSessions
+from benchmarks.fake import build_fleet
+from s3snapshot.s3snapshot import s3snapshot
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2: only the peak of the whole process is available
+    tracemalloc = None
+    import resource
+
+SIZES = '10,100,1000,10000'
+# The limiter of the script starts with the real API rates; the benchmark starts high
+# so the results show the cost of the pipeline unless --rate-limits is given
+RATE_LIMITS = {
+    'describe': 100000,
+    'create-snapshot': 100000,
+    'tagging': 100000,
+    'instance-state': 100000,
+    'delete-snapshot': 100000,
+    'other': 100000,
+}
+
+
+class Silence(object):
+    """
+    Discard the output of the run (click.echo writes to sys.stdout)
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def peak_memory_start():
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+
+
+def peak_memory_stop():
+    """
+    Return the peak memory (MB) of the run
+    """
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak / 1024.0 / 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_benchmark(volumes, event, per_instance, latency, limits, stop_delay):
+    """
+    Run the whole pipeline over a fleet with the number of volumes given and return the measures
+    """
+    sessions = FakeSessions(
+        fleet=lambda role_arn, region: build_fleet(volumes, per_instance=per_instance),
+        latency=latency,
+        limits=limits,
+        stop_delay=stop_delay
+    )
+    peak_memory_start()
+    start = time.time()
+    with Silence():
+        result = s3snapshot(event=dict(event), start_time=start, program='benchmark', sessions=sessions)
+    elapsed = time.time() - start
+    peak = peak_memory_stop()
+
+    calls = sessions.calls()
+    return {
+        'volumes': volumes,
+        'result': result.get('result'),
+        'success': result.get('success'),
+        'wall-time': round(elapsed, 3),
+        'volumes-per-second': round(volumes / elapsed, 1) if elapsed else None,
+        'peak-memory-mb': round(peak, 2),
+        'api-calls': sum(calls.values()),
+        'calls-per-volume': dict((operation, round(count / float(volumes), 3))
+                                 for operation, count in sorted(calls.items())),
+        'throttled': sum(sessions.throttled().values()),
+        'throttling-retries': result.get('throttling-retries'),
+    }
+
+
+def report(measures):
+    click.echo('{0:>8} {1:>10} {2:>9} {3:>10} {4:>9} {5:>9} {6:>9}  {7}'.format(
+        'volumes', 'result', 'time(s)', 'vol/s', 'peak(MB)', 'calls', 'retries', 'calls per volume'))
+    for item in measures:
+        click.echo('{volumes:>8} {result:>10} {wall-time:>9.3f} {volumes-per-second:>10} {peak-memory-mb:>9.2f} '
+                   '{api-calls:>9} {throttling-retries:>9}  {calls}'.format(
+                       calls=', '.join('{0}={1}'.format(operation, count)
+                                       for operation, count in item['calls-per-volume'].items()),
+                       **item))
+
+
+@click.command()
+@click.option('--sizes', default=SIZES, help='Comma separated list of fleet sizes (volumes)')
+@click.option('--per-instance', type=int, default=VOLUMES_PER_INSTANCE, help='Volumes per instance')
+@click.option('--latency', type=float, default=0.0, help='Seconds added to every fake API call')
+@click.option('--throttle', metavar='LIMITS',
+              help=('Calls per second of each API family accepted by the fake before RequestLimitExceeded.\n'
+                    'ex: --throttle \'{"create-snapshot": 50, "describe": 100}\''))
+@click.option('--stop-delay', type=float, default=0.0, help='Seconds the fake instances take to stop')
+@click.option('--page-size', type=int, default=1000, help='page-size of the run')
+@click.option('-c', '--concurrency', type=int, default=1, help='concurrency of the run')
+@click.option('--rate-limits', metavar='RATES', default=json.dumps(RATE_LIMITS),
+              help='rate-limits of the run (the script defaults are the real API rates)')
+@click.option('--event', metavar='JSON', default='{}',
+              help='Extra keys of the event. ex: --event \'{"multi-volume": true}\'')
+@click.option('--json', 'as_json', is_flag=True, help='Print the measures as json')
+def bench(sizes, per_instance, latency, throttle, stop_delay, page_size, concurrency, rate_limits, event, as_json):
+    event = dict(json.loads(event))
+    event.setdefault('page-size', page_size)
+    event.setdefault('concurrency', concurrency)
+    event.setdefault('rate-limits', json.loads(rate_limits))
+    limits = json.loads(throttle) if throttle else None
+
+    measures = list()
+    for volumes in [int(size) for size in sizes.split(',') if size.strip()]:
+        measures.append(run_benchmark(volumes, event, per_instance, latency, limits, stop_delay))
+        if not as_json:
+            click.echo('[+] {0} volumes in {1:.3f} seconds'.format(volumes, measures[-1]['wall-time']), err=True)
+
+    if as_json:
+        click.echo(json.dumps(measures, indent=2))
+    else:
+        report(measures)
+
+
+if __name__ == '__main__':
+    bench()
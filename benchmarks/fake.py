@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+#
+# fake.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""In-process fake of the EC2, SNS and SSM APIs used by the script (benchmarks and tests, not installed)"""
+
+from __future__ import print_function
+
+import collections
+import datetime
+import fnmatch
+import itertools
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from s3snapshot.ratelimit import api_family
+
+OWNER_ID = '123456789012'
+VOLUMES_PER_INSTANCE = 2
+# Type and size (GiB) of the volumes by position in the instance: the root volume, then the odd and even data volumes
+VOLUME_TYPES = (('gp3', 8), ('gp2', 100), ('st1', 500))
+
+
+def build_fleet(volumes, per_instance=VOLUMES_PER_INSTANCE, tags=None):
+    """
+    Return the reservations of a synthetic fleet with the number of volumes given
+    (one instance per reservation, the first volume of each instance is the root volume)
+    """
+    tags = tags or {'Env': 'PROD'}
+    reservations = list()
+    for number in range(0, volumes, per_instance):
+        instance_id = 'i-{0:08x}'.format(number // per_instance)
+        count = min(per_instance, volumes - number)
+        reservations.append({
+            'OwnerId': OWNER_ID,
+            'Instances': [{
+                'InstanceId': instance_id,
+                'RootDeviceName': '/dev/xvda',
+                'State': {'Name': 'running'},
+                'StateTransitionReason': '',
+                'Tags': [{'Key': 'Name', 'Value': 'server-{0}'.format(number // per_instance)}] + [
+                    {'Key': key, 'Value': value} for key, value in sorted(tags.items())],
+                'BlockDeviceMappings': [{
+                    'DeviceName': '/dev/xvda' if index == 0 else '/dev/xvd{0}'.format(chr(ord('a') + index)),
+                    'Ebs': {'VolumeId': 'vol-{0:08x}{1:02d}'.format(number // per_instance, index)}
+                } for index in range(count)]
+            }]
+        })
+    return reservations
+
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class FakeEC2(object):
+    def __init__(self, reservations=None, latency=0.0, limits=None, stop_delay=0.0, copy_limit=None,
+                 complete_delay=0.0):
+        """
+        Fake EC2 client keeping the instances and snapshots in memory
+        latency: seconds added to every call
+        limits: dict API family -> calls per second. The calls above the limit fail with RequestLimitExceeded
+        stop_delay: seconds an instance stays in the stopping state
+        copy_limit: copies pending at the same time. The copies above the limit fail with ResourceLimitExceeded
+        complete_delay: seconds a snapshot stays pending after its creation
+        """
+        self.reservations = reservations or []
+        self.instances = dict((reservation['Instances'][0]['InstanceId'], reservation['Instances'][0])
+                              for reservation in self.reservations)
+        self.latency = latency
+        self.limits = limits or {}
+        self.stop_delay = stop_delay
+        self.copy_limit = copy_limit
+        self.complete_delay = complete_delay
+        self.snapshots = collections.OrderedDict()
+        self.by_volume = dict()
+        self.created = dict()
+        self.stopping = dict()
+        self.calls = collections.Counter()
+        self.throttled = collections.Counter()
+        self.windows = dict()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    def call(self, operation):
+        """
+        Count the call, apply the latency and the rate limit of the family of the operation
+        """
+        family = api_family(operation)
+        with self.lock:
+            self.calls[operation] += 1
+            limit = self.limits.get(family)
+            if limit:
+                now = time.time()
+                window = self.windows.setdefault(family, collections.deque())
+                while window and window[0] < now - 1:
+                    window.popleft()
+                if len(window) >= limit:
+                    self.throttled[operation] += 1
+                    raise client_error('RequestLimitExceeded', operation)
+                window.append(now)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def response(self, **kwargs):
+        kwargs['ResponseMetadata'] = {'HTTPStatusCode': 200}
+        return kwargs
+
+    def refresh_states(self):
+        now = time.time()
+        for instance_id, stopped_at in list(self.stopping.items()):
+            if now >= stopped_at:
+                instance = self.instances[instance_id]
+                instance['State'] = {'Name': 'stopped'}
+                instance['StateTransitionReason'] = 'User initiated ({0} GMT)'.format(
+                    datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+                del self.stopping[instance_id]
+
+    @staticmethod
+    def page(items, max_results, next_token):
+        start = int(next_token or 0)
+        end = start + (max_results or 1000)
+        return items[start:end], (str(end) if end < len(items) else None)
+
+    @staticmethod
+    def match_tags(item, name, values):
+        key = name[4:]
+        return any(tag['Key'] == key and any(fnmatch.fnmatchcase(tag['Value'], value) for value in values)
+                   for tag in item.get('Tags', []))
+
+    def describe_instances(self, Filters=None, InstanceIds=None, MaxResults=None, NextToken=None):
+        self.call('describe_instances')
+        with self.lock:
+            self.refresh_states()
+            reservations = self.reservations
+            if InstanceIds:
+                reservations = [item for item in reservations if item['Instances'][0]['InstanceId'] in InstanceIds]
+            for item in Filters or []:
+                name, values = item['Name'], item['Values']
+                if name == 'instance-id':
+                    reservations = [reservation for reservation in reservations
+                                    if reservation['Instances'][0]['InstanceId'] in values]
+                elif name == 'instance-state-name':
+                    reservations = [reservation for reservation in reservations
+                                    if reservation['Instances'][0]['State']['Name'] in values]
+                elif name.startswith('tag:'):
+                    reservations = [reservation for reservation in reservations
+                                    if self.match_tags(reservation['Instances'][0], name, values)]
+                elif name == 'block-device-mapping.device-name':
+                    reservations = [reservation for reservation in reservations if any(
+                        fnmatch.fnmatchcase(block['DeviceName'], value) for value in values
+                        for block in reservation['Instances'][0]['BlockDeviceMappings'])]
+            page, token = self.page(reservations, MaxResults, NextToken)
+        response = self.response(Reservations=page)
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def volumes(self):
+        """
+        The volumes attached to the instances (type and size given by VOLUME_TYPES)
+        """
+        for reservation in self.reservations:
+            instance = reservation['Instances'][0]
+            for index, block in enumerate(instance['BlockDeviceMappings']):
+                volume_type, size = VOLUME_TYPES[0] if index == 0 else VOLUME_TYPES[1 + (index + 1) % 2]
+                yield {
+                    'VolumeId': block['Ebs']['VolumeId'],
+                    'VolumeType': volume_type,
+                    'Size': size,
+                    'State': 'in-use',
+                    'Tags': list(block['Ebs'].get('Tags', [])),
+                    'Attachments': [{'InstanceId': instance['InstanceId'], 'Device': block['DeviceName'],
+                                     'State': 'attached'}],
+                }
+
+    def describe_volumes(self, Filters=None, VolumeIds=None, MaxResults=None, NextToken=None):
+        self.call('describe_volumes')
+        attributes = {
+            'volume-id': lambda volume: [volume['VolumeId']],
+            'volume-type': lambda volume: [volume['VolumeType']],
+            'size': lambda volume: [str(volume['Size'])],
+            'attachment.instance-id': lambda volume: [item['InstanceId'] for item in volume['Attachments']],
+            'attachment.device': lambda volume: [item['Device'] for item in volume['Attachments']],
+            'attachment.status': lambda volume: [item['State'] for item in volume['Attachments']],
+        }
+        with self.lock:
+            volumes = list(self.volumes())
+            if VolumeIds:
+                volumes = [volume for volume in volumes if volume['VolumeId'] in VolumeIds]
+            for item in Filters or []:
+                name, values = item['Name'], item['Values']
+                if name.startswith('tag:'):
+                    volumes = [volume for volume in volumes if self.match_tags(volume, name, values)]
+                else:
+                    volumes = [volume for volume in volumes if any(
+                        fnmatch.fnmatchcase(attribute, value) for value in values
+                        for attribute in attributes[name](volume))]
+            page, token = self.page(volumes, MaxResults, NextToken)
+        response = self.response(Volumes=page)
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def describe_snapshots(self, OwnerIds=None, Filters=None, SnapshotIds=None, MaxResults=None, NextToken=None):
+        self.call('describe_snapshots')
+        with self.lock:
+            filters = dict((item['Name'], item['Values']) for item in Filters or [])
+            if 'volume-id' in filters:
+                snapshots = [self.snapshots[snapshot_id] for volume_id in filters.pop('volume-id')
+                             for snapshot_id in self.by_volume.get(volume_id, [])]
+            else:
+                snapshots = list(self.snapshots.values())
+            if SnapshotIds:
+                snapshots = [snapshot for snapshot in snapshots if snapshot['SnapshotId'] in SnapshotIds]
+            for name, values in filters.items():
+                if name.startswith('tag:'):
+                    snapshots = [snapshot for snapshot in snapshots if self.match_tags(snapshot, name, values)]
+                elif name == 'status':
+                    snapshots = [snapshot for snapshot in snapshots if snapshot['State'] in values]
+            page, token = self.page(snapshots, MaxResults, NextToken)
+            # Only the snapshots described complete, once they are complete_delay seconds old
+            now = time.time()
+            for snapshot in page:
+                if snapshot['State'] == 'pending' and now - self.created[snapshot['SnapshotId']] >= self.complete_delay:
+                    snapshot['State'] = 'completed'
+                    snapshot['Progress'] = '100%'
+        response = self.response(Snapshots=[dict(snapshot) for snapshot in page])
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def new_snapshot(self, volume_id, description, tags):
+        snapshot_id = 'snap-{0:017x}'.format(next(self.sequence))
+        snapshot = {
+            'SnapshotId': snapshot_id,
+            'VolumeId': volume_id,
+            'State': 'pending',
+            'Progress': '0%',
+            'StartTime': datetime.datetime.utcnow(),
+            'Description': description,
+            'OwnerId': OWNER_ID,
+            'VolumeSize': 8,
+            'Tags': list(tags)
+        }
+        self.snapshots[snapshot_id] = snapshot
+        self.created[snapshot_id] = time.time()
+        self.by_volume.setdefault(volume_id, []).append(snapshot_id)
+        return snapshot
+
+    def create_snapshot(self, VolumeId, Description='', TagSpecifications=None, DryRun=False):
+        self.call('create_snapshot')
+        tags = [tag for specification in TagSpecifications or [] for tag in specification['Tags']]
+        with self.lock:
+            snapshot = self.new_snapshot(VolumeId, Description, tags)
+            return self.response(**dict(snapshot))
+
+    def create_snapshots(self, InstanceSpecification, Description='', TagSpecifications=None,
+                         CopyTagsFromSource=None, DryRun=False):
+        self.call('create_snapshots')
+        tags = [tag for specification in TagSpecifications or [] for tag in specification['Tags']]
+        with self.lock:
+            instance = self.instances[InstanceSpecification['InstanceId']]
+            snapshots = list()
+            for block in instance['BlockDeviceMappings']:
+                volume_id = block['Ebs']['VolumeId']
+                if block['DeviceName'] == instance['RootDeviceName']:
+                    if InstanceSpecification.get('ExcludeBootVolume'):
+                        continue
+                elif volume_id in InstanceSpecification.get('ExcludeDataVolumeIds', []):
+                    continue
+                snapshots.append(dict(self.new_snapshot(volume_id, Description, tags)))
+            return self.response(Snapshots=snapshots)
+
+    def copy_snapshot(self, SourceRegion, SourceSnapshotId, Description='', TagSpecifications=None,
+                      DryRun=False):
+        self.call('copy_snapshot')
+        tags = [tag for specification in TagSpecifications or [] for tag in specification['Tags']]
+        with self.lock:
+            pending = [snapshot for snapshot in self.snapshots.values()
+                       if snapshot['State'] == 'pending' and snapshot['VolumeId'] == 'vol-ffffffff']
+            if self.copy_limit is not None and len(pending) >= self.copy_limit:
+                raise client_error('ResourceLimitExceeded', 'CopySnapshot')
+            # The copies have an arbitrary volume id
+            snapshot = self.new_snapshot('vol-ffffffff', Description, tags)
+            return self.response(SnapshotId=snapshot['SnapshotId'])
+
+    def create_tags(self, Resources, Tags, DryRun=False):
+        self.call('create_tags')
+        with self.lock:
+            for resource in Resources:
+                if resource not in self.snapshots:
+                    raise client_error('InvalidSnapshot.NotFound', 'CreateTags')
+            for resource in Resources:
+                tags = dict((tag['Key'], tag['Value']) for tag in self.snapshots[resource]['Tags'])
+                tags.update((tag['Key'], tag['Value']) for tag in Tags)
+                self.snapshots[resource]['Tags'] = [{'Key': key, 'Value': value} for key, value in tags.items()]
+        return self.response()
+
+    def delete_snapshot(self, SnapshotId, DryRun=False):
+        self.call('delete_snapshot')
+        with self.lock:
+            snapshot = self.snapshots.pop(SnapshotId, None)
+            if snapshot is None:
+                raise client_error('InvalidSnapshot.NotFound', 'DeleteSnapshot')
+            self.by_volume[snapshot['VolumeId']].remove(SnapshotId)
+        return self.response()
+
+    def stop_instances(self, InstanceIds, DryRun=False):
+        self.call('stop_instances')
+        with self.lock:
+            for instance_id in InstanceIds:
+                self.instances[instance_id]['State'] = {'Name': 'stopping'}
+                self.stopping[instance_id] = time.time() + self.stop_delay
+        return self.response(StoppingInstances=[{'InstanceId': instance_id} for instance_id in InstanceIds])
+
+    def start_instances(self, InstanceIds, DryRun=False):
+        self.call('start_instances')
+        with self.lock:
+            for instance_id in InstanceIds:
+                self.instances[instance_id]['State'] = {'Name': 'running'}
+                self.stopping.pop(instance_id, None)
+        return self.response(StartingInstances=[{'InstanceId': instance_id} for instance_id in InstanceIds])
+
+    def get_waiter(self, name):
+        return FakeWaiter(self, name)
+
+
+class FakeWaiter(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def wait(self, InstanceIds=None, **kwargs):
+        """
+        Poll DescribeInstances till the instances are stopped (instance_stopped waiter)
+        """
+        while True:
+            reservations = self.client.describe_instances(InstanceIds=InstanceIds)['Reservations']
+            if all(item['Instances'][0]['State']['Name'] == 'stopped' for item in reservations):
+                return
+            time.sleep(max(self.client.stop_delay / 4.0, 0.01))
+
+
+class FakeSNS(object):
+    def __init__(self):
+        self.messages = list()
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def publish(self, **kwargs):
+        with self.lock:
+            self.calls['publish'] += 1
+            self.messages.append(kwargs)
+        return {'MessageId': str(len(self.messages))}
+
+
+class FakeSSM(object):
+    def __init__(self, delay=0.0, failures=None):
+        """
+        Fake SSM client running the commands sent to the instances
+        delay: seconds an invocation stays InProgress
+        failures: instance ids where the invocations fail (ex: the freeze of the filesystems)
+        history keeps (time, instance id, comment) of each invocation finished (order of the freezes and thaws)
+        """
+        self.delay = delay
+        self.failures = set(failures or [])
+        self.commands = dict()
+        self.history = list()
+        self.calls = collections.Counter()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    def send_command(self, InstanceIds, DocumentName, Parameters=None, Comment='', TimeoutSeconds=None):
+        with self.lock:
+            self.calls['send_command'] += 1
+            command_id = 'cmd-{0:08x}'.format(next(self.sequence))
+            self.commands[command_id] = {
+                'comment': Comment,
+                'done': time.time() + self.delay,
+                'invocations': collections.OrderedDict((instance_id, None) for instance_id in InstanceIds),
+            }
+        return {'Command': {'CommandId': command_id, 'InstanceIds': list(InstanceIds), 'Status': 'Pending'}}
+
+    def list_command_invocations(self, CommandId, Details=False, MaxResults=50, NextToken=None):
+        with self.lock:
+            self.calls['list_command_invocations'] += 1
+            command = self.commands[CommandId]
+            now = time.time()
+            items = list()
+            for instance_id, status in command['invocations'].items():
+                if status is None and now >= command['done']:
+                    status = 'Failed' if instance_id in self.failures else 'Success'
+                    command['invocations'][instance_id] = status
+                    self.history.append((now, instance_id, command['comment']))
+                items.append({'CommandId': CommandId, 'InstanceId': instance_id, 'Status': status or 'InProgress',
+                              'CommandPlugins': [{'Output': 'failed' if status == 'Failed' else ''}]})
+            page, token = FakeEC2.page(items, MaxResults, NextToken)
+        response = {'CommandInvocations': page}
+        if token:
+            response['NextToken'] = token
+        return response
+
+
+class FakeSessions(object):
+    def __init__(self, fleet=None, ssm=None, **kwargs):
+        """
+        Replace AccountSessions: one FakeEC2 and one FakeSSM (keyword arguments ssm) per account and region
+        built by fleet(role_arn, region) and one FakeSNS. The other keyword arguments are given to the FakeEC2
+        """
+        self.fleet = fleet or (lambda role_arn, region: [])
+        self.kwargs = kwargs
+        self.ssm_kwargs = dict(ssm or {})
+        self.ec2 = dict()
+        self.ssm = dict()
+        self.sns = FakeSNS()
+        self.config = dict()
+        self.pool_size = None
+        self.lock = threading.Lock()
+
+    def configure(self, config=None, pool_size=None):
+        self.config = dict(config or {})
+        self.pool_size = pool_size
+
+    def configured(self, config=None, pool_size=None):
+        # The fake clients have no settings: the runs share them
+        return self
+
+    def client(self, service, region=None, role_arn=None, config=None):
+        if service == 'sns':
+            return self.sns
+        if service == 'ssm':
+            with self.lock:
+                if (role_arn, region) not in self.ssm:
+                    self.ssm[(role_arn, region)] = FakeSSM(**self.ssm_kwargs)
+                return self.ssm[(role_arn, region)]
+        if service != 'ec2':
+            raise ValueError('Service {0} not supported by the fake'.format(service))
+        with self.lock:
+            if (role_arn, region) not in self.ec2:
+                self.ec2[(role_arn, region)] = FakeEC2(self.fleet(role_arn, region), **self.kwargs)
+            return self.ec2[(role_arn, region)]
+
+    def calls(self):
+        """
+        Number of calls per operation of all the fake clients
+        """
+        calls = collections.Counter(self.sns.calls)
+        for client in list(self.ec2.values()) + list(self.ssm.values()):
+            calls.update(client.calls)
+        return calls
+
+    def throttled(self):
+        throttled = collections.Counter()
+        for client in self.ec2.values():
+            throttled.update(client.throttled)
+        return throttled
@@ -12,34 +12,90 @@ from __future__ import print_function
 
 import time
 
+# Taken before the other imports on purpose: the startup time of a cold start includes them
+INIT_TIME = time.time()
+
 import click
-import pkg_resources
 
-from s3snapshot.s3snapshot import s3snapshot
+from s3snapshot import __version__
+
+PACKAGE = 's3snapshot'
+VERSION = __version__
+
+# Kept between warm invocations of the same container
+ENGINE = dict()
+SESSIONS = dict()
+
+
+def load_engine():
+    """
+    Import the snapshot and prune modules (boto3 included) only on the first invocation
+    Return the seconds spent by the import (0 on warm invocations)
+    """
+    if ENGINE:
+        return 0.0
+    start = time.time()
+    from s3snapshot.accounts import default_sessions
+    from s3snapshot.plan import execute
+    from s3snapshot.plan import plan
+    from s3snapshot.prune import prune
+    from s3snapshot.shard import coordinate
+    from s3snapshot.s3snapshot import s3snapshot
+    ENGINE['sessions'] = default_sessions
+    ENGINE['prune'] = prune
+    ENGINE['plan'] = plan
+    ENGINE['execute'] = execute
+    ENGINE['coordinate'] = coordinate
+    ENGINE['s3snapshot'] = s3snapshot
+    return time.time() - start
+
+
+def account_sessions(session_name):
+    """
+    Return the AccountSessions (sessions and clients) of the session name reused by the warm invocations
+    """
+    if session_name not in SESSIONS:
+        SESSIONS[session_name] = ENGINE['sessions'](session_name=session_name)
+    return SESSIONS[session_name]
 
 
 def lambda_handler(event, context):
     """
     This function read the event data and parse to s3snapshot function
+    The event {"action": "prune", ...} applies the retention policy instead
+    {"action": "plan", "plan": <file>, ...} writes the plan and {"action": "execute", "plan": <file>, ...} executes it
+    {"action": "coordinate", ...} splits the run in shards executed by invocations of the function
+    Return the message with the status of the run, or the result of the run (with the message, cold-start
+    and startup-time) when the event has "full-result": true (ex: the shards invoked by a coordinator)
     """
-    PACKAGE = pkg_resources.require("s3snapshot")[0].project_name
-    VERSION = pkg_resources.require("s3snapshot")[0].version
-
     start = time.time()
+    cold_start = not ENGINE
+    load_time = load_engine()
+    # On a cold start the time since the module was imported by the runtime is included
+    startup = (time.time() - INIT_TIME) if cold_start else load_time
+
     click.echo('[+] Start time: {0}'.format(time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(start))))
 
-    response = s3snapshot(
+    job = event.get('action') if event.get('action') in ('prune', 'plan', 'execute', 'coordinate') else 's3snapshot'
+    response = ENGINE[job](
         event=event,
         context=context,
         start_time=start,
         program='{package}-{version}'.format(
             package=PACKAGE, version=VERSION
-        )
+        ),
+        sessions=account_sessions(event.get('role-session-name', PACKAGE))
     )
 
     code = response.get('result')
-    message = '{icon} The s3snapshot was : {status}'.format(
-        icon='[=]' if code == 'Sucessfull' else '[!]',
+    message = '{icon} The {job} was : {status}'.format(
+        icon='[=]' if code == 'Successful' else '[!]',
+        job=job,
         status=code
     )
-    return message
+    if not event.get('full-result'):
+        return message
+    response['message'] = message
+    response['cold-start'] = cold_start
+    response['startup-time'] = round(startup, 3)
+    return response
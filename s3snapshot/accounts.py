@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# accounts.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Sessions of the accounts processed by the run (AssumeRole) and the clients shared by the run"""
+
+from __future__ import print_function
+
+import threading
+
+import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
+
+SESSION_NAME = 's3snapshot'
+DURATION = 3600
+# Settings of the clients (event key client-config). The connection pool of each client is sized to the
+# workers that share it (concurrency + POOL_MARGIN) and never below pool-size (the default of botocore)
+CLIENT_CONFIG = {
+    'retry-mode': 'standard',
+    # Attempts of each call including the first one
+    'max-attempts': 3,
+    'connect-timeout': 10,
+    'read-timeout': 60,
+    'tcp-keepalive': True,
+    'pool-size': 10,
+}
+POOL_MARGIN = 2
+
+
+def account_id(role_arn):
+    """
+    Return the account id of the role (arn:aws:iam::<account>:role/<name>)
+    """
+    if not role_arn:
+        return None
+    return role_arn.split(':')[4]
+
+
+def client_config(settings):
+    """
+    Return the botocore Config of the client settings (keys of CLIENT_CONFIG)
+    """
+    kwargs = {
+        'max_pool_connections': int(settings['pool-size']),
+        'retries': {'mode': settings['retry-mode'], 'total_max_attempts': int(settings['max-attempts'])},
+        'connect_timeout': settings['connect-timeout'],
+        'read_timeout': settings['read-timeout'],
+    }
+    if settings['tcp-keepalive']:
+        kwargs['tcp_keepalive'] = True
+    try:
+        return Config(**kwargs)
+    except TypeError:
+        # botocore before tcp_keepalive (the connections are still reused by the pool)
+        kwargs.pop('tcp_keepalive', None)
+        return Config(**kwargs)
+
+
+def resolve_config(config=None, pool_size=None):
+    """
+    Return the client settings: CLIENT_CONFIG updated by config with the pool sized to pool_size workers
+    """
+    settings = dict(CLIENT_CONFIG)
+    settings.update(config or {})
+    if pool_size:
+        settings['pool-size'] = max(int(settings['pool-size']), int(pool_size) + POOL_MARGIN)
+    return settings
+
+
+def assume_role_session(role_arn, session_name=SESSION_NAME, duration=DURATION, sts_client=None):
+    """
+    Return a boto3 session with the temporary credentials of the role
+    The credentials are refreshed by botocore before they expire
+    """
+    sts = sts_client or boto3.client('sts')
+
+    def refresh():
+        credentials = sts.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=session_name,
+            DurationSeconds=duration
+        )['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat()
+        }
+
+    session = botocore.session.get_session()
+    session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=refresh(),
+        refresh_using=refresh,
+        method='sts-assume-role'
+    )
+    return boto3.session.Session(botocore_session=session)
+
+
+class AccountSessions(object):
+    def __init__(self, session_name=SESSION_NAME, duration=DURATION, config=None):
+        """
+        Cache of one session per account for the life of the run
+        role_arn None is the account of the ambient credentials
+        The role is assumed only once per account (under the lock of the role) and the clients are created
+        under a lock because the boto3 sessions are not thread safe
+        The clients are cached too (by their settings) so a long lived instance (ex: Lambda warm invocations
+        or the daemon) reuses them and their connections. config updates CLIENT_CONFIG for all the clients
+        """
+        self.session_name = session_name
+        self.duration = duration
+        self.sessions = dict()
+        self.role_locks = dict()
+        self.clients = dict()
+        self.config = dict(CLIENT_CONFIG)
+        self.config.update(config or {})
+        self.lock = threading.Lock()
+
+    def configure(self, config=None, pool_size=None):
+        """
+        Default settings of the clients (the runs use their own settings with configured)
+        """
+        with self.lock:
+            self.config = resolve_config(config, pool_size)
+
+    def configured(self, config=None, pool_size=None):
+        """
+        Return the sessions with the settings of the clients of one run (event key client-config) and
+        the workers sharing each client. The runs in parallel (ex: the jobs of the daemon) share the sessions
+        and the clients of the same settings without changing the settings of each other
+        """
+        return ConfiguredSessions(self, resolve_config(config, pool_size))
+
+    def session(self, role_arn=None):
+        """
+        Return the session of the account (the role is assumed by the first call)
+        The AssumeRole call runs under the lock of its role only, so the roles of the other accounts
+        are assumed in parallel and the cached clients are not waiting for it
+        """
+        with self.lock:
+            if not role_arn or role_arn in self.sessions:
+                return self._session(role_arn)
+            role_lock = self.role_locks.setdefault(role_arn, threading.Lock())
+            # The STS client of the ambient credentials is shared by the roles
+            sts_client = self._client('sts', None, None)
+
+        with role_lock:
+            with self.lock:
+                if role_arn in self.sessions:
+                    return self.sessions[role_arn]
+            session = assume_role_session(
+                role_arn,
+                session_name=self.session_name,
+                duration=self.duration,
+                sts_client=sts_client
+            )
+            with self.lock:
+                self.sessions[role_arn] = session
+            return session
+
+    def _session(self, role_arn):
+        """
+        Session already created (or the session of the ambient credentials). Called with the lock held
+        """
+        if role_arn not in self.sessions:
+            self.sessions[role_arn] = boto3.session.Session()
+        return self.sessions[role_arn]
+
+    def client(self, service, region=None, role_arn=None, config=None):
+        """
+        Return the client of the service shared by the run (config overrides the settings for this client
+        ex: {"read-timeout": 960, "max-attempts": 1} or a larger pool-size)
+        """
+        # The role of the account is assumed outside the lock of the clients
+        self.session(role_arn)
+        with self.lock:
+            return self._client(service, region, role_arn, config)
+
+    def _client(self, service, region, role_arn, config=None):
+        settings = dict(self.config)
+        settings.update(config or {})
+        key = (service, region, role_arn, tuple(sorted(settings.items())))
+        if key not in self.clients:
+            self.clients[key] = self._session(role_arn).client(service, region_name=region,
+                                                              config=client_config(settings))
+        return self.clients[key]
+
+
+class ConfiguredSessions(object):
+    def __init__(self, sessions, config):
+        """
+        AccountSessions seen with the client settings config of one run
+        """
+        self.sessions = sessions
+        self.config = config
+
+    def configured(self, config=None, pool_size=None):
+        return self.sessions.configured(config, pool_size)
+
+    def session(self, role_arn=None):
+        return self.sessions.session(role_arn)
+
+    def client(self, service, region=None, role_arn=None, config=None):
+        settings = dict(self.config)
+        settings.update(config or {})
+        return self.sessions.client(service, region=region, role_arn=role_arn, config=settings)
+
+
+# Class of the sessions created when no sessions are given (tests can set a stub backend ex: FakeSessions)
+SESSIONS_BACKEND = AccountSessions
+
+
+def default_sessions(session_name=SESSION_NAME):
+    """
+    Return new sessions of SESSIONS_BACKEND (used by the runs that are not given sessions)
+    """
+    return SESSIONS_BACKEND(session_name=session_name)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# cache.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Local inventory cache (SQLite) of the instances and snapshot names"""
+
+from __future__ import print_function
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_TTL = 300
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS instances ('
+    ' scope TEXT NOT NULL, filters TEXT NOT NULL, fetched REAL NOT NULL, data TEXT NOT NULL,'
+    ' PRIMARY KEY (scope, filters))',
+    'CREATE TABLE IF NOT EXISTS snapshot_names ('
+    ' scope TEXT NOT NULL, volume_id TEXT NOT NULL, date TEXT NOT NULL, prefix TEXT, fetched REAL NOT NULL,'
+    ' PRIMARY KEY (scope, volume_id, date))',
+)
+
+
+def json_default(value):
+    """
+    Dates of the API responses are kept as iso strings
+    """
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+class InventoryCache(object):
+    def __init__(self, path, ttl=CACHE_TTL):
+        """
+        Cache of the DescribeInstances results and of the highest snapshot name of each volume
+        per scope (account/region). The entries older than ttl seconds are evicted
+        """
+        self.path = os.path.expanduser(path)
+        self.ttl = float(ttl)
+        self.lock = threading.Lock()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # The regions are processed by several threads that share the connection under the lock
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the expired entries
+        """
+        limit = time.time() - self.ttl
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM instances WHERE fetched < ?', (limit,))
+            self.connection.execute('DELETE FROM snapshot_names WHERE fetched < ?', (limit,))
+
+    def get_instances(self, scope, filter_list):
+        """
+        Return the list of (owner_id, instance) cached for the filters or None if it is not cached
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT data FROM instances WHERE scope = ? AND filters = ? AND fetched >= ?',
+                (scope, json.dumps(filter_list, sort_keys=True), time.time() - self.ttl)
+            ).fetchone()
+        if row is None:
+            return None
+        return [tuple(item) for item in json.loads(row[0])]
+
+    def put_instances(self, scope, filter_list, instances):
+        data = json.dumps(instances, default=json_default, separators=(',', ':'))
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO instances (scope, filters, fetched, data) VALUES (?, ?, ?, ?)',
+                (scope, json.dumps(filter_list, sort_keys=True), time.time(), data)
+            )
+
+    def get_names(self, scope, date, volume_ids):
+        """
+        Return a dict volume_id -> highest prefix of the date (None if the volume has no snapshot that date)
+        The volumes that are not cached are not in the dict
+        """
+        names = dict()
+        volume_ids = list(volume_ids)
+        with self.lock:
+            for i in range(0, len(volume_ids), 500):
+                chunk = volume_ids[i:i + 500]
+                rows = self.connection.execute(
+                    'SELECT volume_id, prefix FROM snapshot_names WHERE scope = ? AND date = ? AND fetched >= ?'
+                    ' AND volume_id IN ({0})'.format(', '.join('?' * len(chunk))),
+                    [scope, date, time.time() - self.ttl] + chunk
+                ).fetchall()
+                names.update(rows)
+        return names
+
+    def put_names(self, scope, date, names):
+        """
+        Write the highest prefix of each volume (names is a dict volume_id -> prefix or None)
+        A prefix never replaces a higher one already cached
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            for volume_id, prefix in names.items():
+                row = self.connection.execute(
+                    'SELECT prefix FROM snapshot_names WHERE scope = ? AND volume_id = ? AND date = ?',
+                    (scope, volume_id, date)
+                ).fetchone()
+                if row and row[0] and (prefix is None or row[0] > prefix):
+                    prefix = row[0]
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO snapshot_names (scope, volume_id, date, prefix, fetched)'
+                    ' VALUES (?, ?, ?, ?, ?)',
+                    (scope, volume_id, date, prefix, now)
+                )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
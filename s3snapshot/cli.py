@@ -19,12 +19,36 @@ import time
 import click
 import pkg_resources
 
+from .cache import CACHE_TTL
+from .daemon import daemon
+from .drcopy import COPY_CONCURRENCY
+from .drcopy import COPY_TIMEOUT
+from .filters import SELECTION_KEYS
+from .plan import execute
+from .plan import plan
+from .prune import DRY_RUN
+from .prune import KEEP_DAILY
+from .prune import KEEP_LAST
+from .prune import KEEP_MONTHLY
+from .prune import KEEP_WEEKLY
+from .prune import prune
+from .s3snapshot import COMPLETION_TIMEOUT
+from .s3snapshot import CONCURRENCY
+from .s3snapshot import EXCLUDE_ROOT
+from .s3snapshot import MIN_INTERVAL
+from .s3snapshot import MULTI_VOLUME
+from .s3snapshot import PAGE_SIZE
+from .s3snapshot import SKIP_UNCHANGED
 from .s3snapshot import SNS_ARN
 from .s3snapshot import SNS_ARN_ERROR
 from .s3snapshot import STOP
 from .s3snapshot import STOPPED
+from .s3snapshot import TRACK_COMPLETION
 from .s3snapshot import VERBOSE
 from .s3snapshot import s3snapshot
+from .shard import PROCESSES
+from .shard import SHARD_VOLUMES
+from .shard import coordinate
 
 locale.setlocale(locale.LC_ALL, '')
 
@@ -32,19 +56,71 @@ reload(sys)
 sys.setdefaultencoding('utf8')
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('-l', '--label', metavar='LABEL', help='Label to be included in the Snapshot description')
 @click.option('-s', '--stop', is_flag=True, default=STOP, help='Stop Instance before start the snapshot')
 @click.option('-sp', '--stopped', is_flag=True, default=STOPPED,
               help='Check if instance is stopped before start the snapshot. (If not skip and flag error)')
+@click.option('--freeze', is_flag=True, default=False,
+              help='Freeze the filesystems of the running instances (SSM) during the snapshot instead of a stop')
+@click.option('--hooks', metavar='CONFIG',
+              help=('JSON configuration of the freeze and thaw hooks '
+                    'ex: --hooks \'{"timeout": 30, "thaw-after": 60, "freeze": ["..."], "thaw": ["..."]}\''))
 @click.option('--sns-arn', metavar='SNS_ARN', help='The SNS topic ARN to send message when finished')
 @click.option('--sns-arn-error', metavar='SNS_ARN', help='The SNS topic ARN to send message when an error occour!')
 @click.option('-f', '--filter', metavar='FILTER', help=('Filter list to snapshot.\n'
-                                                        'ex: --filter \'{"instances": ["i-12345678", "i-abcdef12"], "tags": {"tag:Owner": "John", "tag:Name": "PROD"}}\''''))
+                                                        'ex: --filter \'{"instances": ["i-12345678", "i-abcdef12"], "tags": {"tag:Owner": "John", "tag:Name": "PROD"}}\'\n'
+                                                        'Volumes: volume-types, min-size, max-size, volume-tags, devices, exclude-devices, '
+                                                        'volume-scope (all, root, data)'))
+@click.option('--page-size', metavar='N', type=int, default=PAGE_SIZE,
+              help='Number of instances requested per DescribeInstances page')
+@click.option('-c', '--concurrency', metavar='N', type=int, default=CONCURRENCY,
+              help='Number of instances processed in parallel')
+@click.option('-m', '--multi-volume', is_flag=True, default=MULTI_VOLUME,
+              help='Snapshot all the volumes of each instance with a single crash-consistent CreateSnapshots call')
+@click.option('--exclude-root', is_flag=True, default=EXCLUDE_ROOT, help='Do not snapshot the root volume')
+@click.option('--skip-unchanged', is_flag=True, default=SKIP_UNCHANGED,
+              help='Skip the volumes not changed since their last snapshot (recent or taken after the instance stopped)')
+@click.option('--min-interval', metavar='SECONDS', type=float, default=MIN_INTERVAL,
+              help='With --skip-unchanged skip the volumes with a snapshot newer than SECONDS')
+@click.option('--track-completion', is_flag=True, default=TRACK_COMPLETION,
+              help='Wait till the snapshots are completed and report the time to complete and the throughput')
+@click.option('--completion-timeout', metavar='SECONDS', type=float, default=COMPLETION_TIMEOUT,
+              help='With --track-completion stop waiting after SECONDS and report the snapshots still pending')
+@click.option('--copy-regions', metavar='REGIONS',
+              help='Comma separated list of regions where the snapshots created are copied. ex: --copy-regions eu-west-1')
+@click.option('--copy-concurrency', metavar='N', type=int, default=COPY_CONCURRENCY,
+              help='Copies in flight per destination region (the concurrent copy limit of the account)')
+@click.option('--copy-timeout', metavar='SECONDS', type=float, default=COPY_TIMEOUT,
+              help='With --copy-regions stop waiting for the copies after SECONDS')
+@click.option('--rate-limits', metavar='RATES',
+              help=('Initial rate (calls per second) of each API family.\n'
+                    'ex: --rate-limits \'{"describe": 20, "create-snapshot": 5, "tagging": 10, "instance-state": 5}\''))
+@click.option('--client-config', metavar='CONFIG',
+              help=('Settings of the AWS clients (the connection pools are sized to the concurrency).\n'
+                    'ex: --client-config \'{"retry-mode": "adaptive", "max-attempts": 5, "read-timeout": 30}\''))
+@click.option('-r', '--regions', metavar='REGIONS',
+              help='Comma separated list of regions processed in parallel. ex: --regions us-east-1,eu-west-1')
+@click.option('-a', '--accounts', metavar='ROLE_ARNS',
+              help=('Comma separated list of IAM roles assumed to process other accounts in parallel.\n'
+                    'ex: --accounts arn:aws:iam::111111111111:role/Snapshot,arn:aws:iam::222222222222:role/Snapshot'))
+@click.option('--time-budget', metavar='SECONDS', type=float,
+              help='Stop starting new instances before the time budget is over and return a continuation token')
+@click.option('--continuation-token', metavar='TOKEN', help='Resume the run that returned the continuation token')
+@click.option('--journal-dir', metavar='PATH', help='Directory of the journal used to resume the runs')
+@click.option('--cache', metavar='PATH',
+              help='SQLite file caching the instances and the snapshot names between runs. ex: ~/.s3snapshot.db')
+@click.option('--cache-ttl', metavar='SECONDS', type=float, default=CACHE_TTL,
+              help='Seconds the cached instances and snapshot names are valid')
+@click.option('--emit-metrics', is_flag=True, default=None,
+              help='Write the metrics of the API calls and phases as embedded metric format json lines')
+@click.option('--report', metavar='PATH',
+              help='Write one json line per volume processed to the file (- for stdout)')
 @click.option('--verbose', is_flag=True, default=VERBOSE, help='Show extra information during execution')
 @click.version_option()
+@click.pass_context
 # Main function for CLI iteration
-def cli(*args, **kwargs):
+def cli(ctx, *args, **kwargs):
     filter_args = kwargs.pop('filter')
     label = kwargs.pop('label')
     sns_arn = kwargs.pop('sns_arn') or SNS_ARN
@@ -56,32 +132,184 @@ def cli(*args, **kwargs):
     event['sns-arn'] = sns_arn
     event['sns-arn-error'] = sns_arn_error
     event['label'] = label
+    event['page-size'] = kwargs.pop('page_size')
+    event['concurrency'] = kwargs.pop('concurrency')
+    event['multi-volume'] = kwargs.pop('multi_volume')
+    event['exclude-root'] = kwargs.pop('exclude_root')
+    event['skip-unchanged'] = kwargs.pop('skip_unchanged')
+    event['min-interval'] = kwargs.pop('min_interval')
+    event['track-completion'] = kwargs.pop('track_completion')
+    event['completion-timeout'] = kwargs.pop('completion_timeout')
+    event['copy-regions'] = kwargs.pop('copy_regions')
+    event['copy-concurrency'] = kwargs.pop('copy_concurrency')
+    event['copy-timeout'] = kwargs.pop('copy_timeout')
+    event['regions'] = kwargs.pop('regions')
+    event['accounts'] = kwargs.pop('accounts')
+    event['time-budget'] = kwargs.pop('time_budget')
+    event['continuation-token'] = kwargs.pop('continuation_token')
+    event['cache'] = kwargs.pop('cache')
+    event['cache-ttl'] = kwargs.pop('cache_ttl')
+    event['emit-metrics'] = kwargs.pop('emit_metrics')
+    event['report'] = kwargs.pop('report')
+    journal_dir = kwargs.pop('journal_dir')
+    if journal_dir:
+        event['journal'] = {'store': 'file', 'path': journal_dir}
+    rate_limits = kwargs.pop('rate_limits')
+    if rate_limits:
+        event['rate-limits'] = json.loads(rate_limits)
+    client_config = kwargs.pop('client_config')
+    if client_config:
+        event['client-config'] = json.loads(client_config)
+    hooks = kwargs.pop('hooks')
+    freeze = kwargs.pop('freeze')
+    event['hooks'] = json.loads(hooks) if hooks else freeze
 
     if filter_args:
         filter_args = json.loads(filter_args)
-        if 'tags' in filter_args.keys():
-            event['tags'] = filter_args['tags']
+        for key in SELECTION_KEYS:
+            if key in filter_args.keys():
+                event[key] = filter_args[key]
 
-        if 'instances' in filter_args.keys():
-            event['instances'] = filter_args['instances']
+    verbose = kwargs.pop('verbose')
+    if ctx.invoked_subcommand:
+        # The subcommand runs with the same filters, targets and SNS topics
+        ctx.obj = {'event': event, 'verbose': verbose}
+        return
 
-    PACKAGE = pkg_resources.require("s3snapshot")[0].project_name
-    VERSION = pkg_resources.require("s3snapshot")[0].version
+    if event['stop'] and event['stopped']:
+        click.echo('[!] Unable to process. You need to choose --stop or --stopped option')
+        return
 
-    click.echo('ECTP Snapshot to S3 - Version {0}'.format(VERSION))
-    click.echo('')
+    if event['hooks'] and (event['stop'] or event['stopped']):
+        click.echo('[!] Unable to process. The freeze hooks can not be used with --stop or --stopped')
+        return
+
+    return run(s3snapshot, 's3snapshot', event, verbose)
+
+
+@cli.command('prune')
+@click.option('--keep-last', metavar='N', type=int, default=KEEP_LAST,
+              help='Number of the newest snapshots of each volume to keep')
+@click.option('--keep-daily', metavar='N', type=int, default=KEEP_DAILY,
+              help='Number of days to keep the newest snapshot of the day')
+@click.option('--keep-weekly', metavar='N', type=int, default=KEEP_WEEKLY,
+              help='Number of weeks to keep the newest snapshot of the week')
+@click.option('--keep-monthly', metavar='N', type=int, default=KEEP_MONTHLY,
+              help='Number of months to keep the newest snapshot of the month')
+@click.option('--dry-run', is_flag=True, default=DRY_RUN, help='Only list the snapshots that would be deleted')
+@click.pass_obj
+def prune_cli(obj, **kwargs):
+    """
+    Delete the snapshots created by s3snapshot that are not retained by the policy
+    """
+    event = obj['event']
+    event['keep-last'] = kwargs.pop('keep_last')
+    event['keep-daily'] = kwargs.pop('keep_daily')
+    event['keep-weekly'] = kwargs.pop('keep_weekly')
+    event['keep-monthly'] = kwargs.pop('keep_monthly')
+    event['dry-run'] = kwargs.pop('dry_run')
+
+    return run(prune, 'prune', event, obj['verbose'])
+
+
+@cli.command('plan')
+@click.argument('path')
+@click.pass_obj
+def plan_cli(obj, path):
+    """
+    Discover the volumes, resolve the snapshot names and write the plan to PATH
+    """
+    event = obj['event']
+    if event['stop'] and event['stopped']:
+        click.echo('[!] Unable to process. You need to choose --stop or --stopped option')
+        return
+
+    if event['hooks'] and (event['stop'] or event['stopped']):
+        click.echo('[!] Unable to process. The freeze hooks can not be used with --stop or --stopped')
+        return
+    event['plan'] = path
 
+    return run(plan, 'plan', event, obj['verbose'])
+
+
+@cli.command('execute')
+@click.argument('path')
+@click.pass_obj
+def execute_cli(obj, path):
+    """
+    Create the snapshots of the plan of PATH without discovery (the filters and targets are the ones of the plan)
+    """
+    event = obj['event']
+    event['plan'] = path
+
+    return run(execute, 'execute', event, obj['verbose'])
+
+
+@cli.command('coordinate')
+@click.option('--shards', metavar='N', type=int, help='Number of shards (by default one per --shard-volumes volumes)')
+@click.option('--shard-volumes', metavar='N', type=int, default=SHARD_VOLUMES, help='Volumes per shard')
+@click.option('--processes', metavar='N', type=int, default=PROCESSES,
+              help='Local worker processes executing the shards')
+@click.option('--function', metavar='NAME',
+              help='Execute each shard with an invocation of the Lambda function instead of local processes')
+@click.pass_obj
+def coordinate_cli(obj, **kwargs):
+    """
+    Discover the volumes and execute them in shards by parallel workers with one summary
+    """
+    event = obj['event']
     if event['stop'] and event['stopped']:
         click.echo('[!] Unable to process. You need to choose --stop or --stopped option')
         return
 
+    if event['hooks'] and (event['stop'] or event['stopped']):
+        click.echo('[!] Unable to process. The freeze hooks can not be used with --stop or --stopped')
+        return
+    event['shards'] = kwargs.pop('shards')
+    event['shard-volumes'] = kwargs.pop('shard_volumes')
+    function = kwargs.pop('function')
+    processes = kwargs.pop('processes')
+    if function:
+        event['dispatcher'] = {'backend': 'lambda', 'function': function}
+    else:
+        event['dispatcher'] = {'backend': 'local', 'processes': processes}
+
+    return run(coordinate, 'coordinate', event, obj['verbose'])
+
+
+@cli.command('daemon')
+@click.argument('schedule')
+@click.pass_obj
+def daemon_cli(obj, schedule):
+    """
+    Run the jobs of the SCHEDULE (json file) on time till SIGTERM/SIGINT with warm clients and inventory
+    """
+    PACKAGE = pkg_resources.require("s3snapshot")[0].project_name
+    VERSION = pkg_resources.require("s3snapshot")[0].version
+
+    # The options given are the defaults of the jobs
+    event = dict((key, value) for key, value in obj['event'].items() if value is not None)
+    daemon(verbose=obj['verbose'], program='{package}-{version}'.format(package=PACKAGE, version=VERSION),
+           schedule=schedule, event=event)
+
+
+def run(function, job, event, verbose):
+    """
+    Execute the job (s3snapshot, prune, plan, execute or coordinate) and show the elapsed time and the result
+    """
+    PACKAGE = pkg_resources.require("s3snapshot")[0].project_name
+    VERSION = pkg_resources.require("s3snapshot")[0].version
+
+    click.echo('ECTP Snapshot to S3 - Version {0}'.format(VERSION))
+    click.echo('')
+
     start = time.time()
     click.echo('[+] Start time: {0}'.format(
         time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(start)))
     )
 
-    response = s3snapshot(
-        verbose=kwargs.pop('verbose'),
+    response = function(
+        verbose=verbose,
         event=event,
         start_time=start,
         program='{package}-{version}'.format(
@@ -96,8 +324,9 @@ def cli(*args, **kwargs):
     )
     )
     code = response['result']
-    message = '{icon} The s3snapshot was : {status}'.format(
-        icon='[=]' if code == 'Sucessfull' else '[!]',
+    message = '{icon} The {job} was : {status}'.format(
+        icon='[=]' if code == 'Successful' else '[!]',
+        job=job,
         status=code
     )
     return click.echo(message)
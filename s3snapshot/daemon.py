@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+#
+# daemon.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Long running scheduler of the snapshot jobs with warm clients and inventory"""
+
+from __future__ import print_function
+
+import io
+import json
+import signal
+import threading
+import time
+import traceback
+import zlib
+
+import click
+
+from .accounts import default_sessions
+from .cache import InventoryCache
+from .journal import target_key
+from .prune import prune
+from .ratelimit import RateLimiter
+from .ratelimit import throttled_client
+from .s3snapshot import FAULT
+from .s3snapshot import TARGET_CONCURRENCY
+from .s3snapshot import VERBOSE
+from .s3snapshot import iter_instances
+from .s3snapshot import parse_event
+from .s3snapshot import run_parallel
+from .s3snapshot import s3snapshot
+
+# Seconds between the runs of a job, the start times of the jobs are spread over the window
+EVERY = 86400
+WINDOW = 600
+# The inventory of a job is refreshed REFRESH_AHEAD seconds before its start
+REFRESH_AHEAD = 120
+MAX_JOBS = 2
+# Longest sleep of the scheduler loop and sleep while a job waits for the jobs in conflict (seconds)
+TICK = 30
+BLOCKED_DELAY = 5
+DAEMON_CACHE = '~/.s3snapshot-daemon.db'
+DAEMON_CACHE_TTL = 900
+ACTIONS = {
+    's3snapshot': s3snapshot,
+    'prune': prune,
+}
+
+
+def parse_at(value):
+    """
+    Seconds since midnight (UTC) of HH:MM or HH:MM:SS (0 if not given)
+    """
+    if not value:
+        return 0
+    parts = [int(part) for part in value.split(':')]
+    return parts[0] * 3600 + parts[1] * 60 + (parts[2] if len(parts) > 2 else 0)
+
+
+def jitter(name, window):
+    """
+    Deterministic offset of the job in the window (the same on every start of the daemon)
+    """
+    if not window:
+        return 0
+    return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % int(window)
+
+
+class Job(object):
+    def __init__(self, name, event=None, action='s3snapshot', every=EVERY, at=None, window=WINDOW):
+        """
+        Job run every seconds at the time at (HH:MM UTC, the slot of the job) plus its jitter in the window
+        """
+        if action not in ACTIONS:
+            raise ValueError('Unknown action {0} of the job {1}'.format(action, name))
+        self.name = name
+        self.event = dict(event or {})
+        self.action = action
+        self.every = int(every)
+        self.offset = (parse_at(at) + jitter(name, window)) % self.every
+        self.next = None
+        # Slot of the last inventory refresh and the (target, instance id) of the job (None if unknown)
+        self.refreshed = None
+        self.instances = None
+        options = parse_event(self.event)
+        if options['invalid']:
+            raise ValueError('Invalid event of the job {0}: {1}'.format(name, options['invalid']))
+        self.targets = set(target_key(role_arn, region) for role_arn in options['accounts']
+                           for region in options['regions'])
+
+    def schedule(self, now):
+        """
+        Next start at or after now (the slots missed while the daemon was down or busy are skipped)
+        """
+        start = (int(now) - self.offset) // self.every * self.every + self.offset
+        if start < now:
+            start += self.every
+        self.next = start
+        return start
+
+    def conflicts(self, other):
+        """
+        True if the jobs may touch the same instances: the instances of the inventories
+        or the targets (account/region) when an inventory is unknown
+        """
+        if self.instances is not None and other.instances is not None:
+            return bool(self.instances & other.instances)
+        return bool(self.targets & other.targets)
+
+
+def load_schedule(schedule):
+    """
+    Read the schedule (path of a json file or dict):
+    {"window": 600, "refresh-ahead": 120, "max-jobs": 2, "cache": "~/.s3snapshot-daemon.db", "cache-ttl": 900,
+     "event": {<keys of all the jobs>},
+     "jobs": [{"name": "prod", "every": 86400, "at": "02:00", "action": "s3snapshot", "event": {...}}, ...]}
+    """
+    if not isinstance(schedule, dict):
+        with io.open(schedule, encoding='utf-8') as fp:
+            schedule = json.load(fp)
+    window = schedule.get('window', WINDOW)
+    jobs = list()
+    for item in schedule.get('jobs', []):
+        event = dict(schedule.get('event', {}))
+        event.update(item.get('event', {}))
+        jobs.append(Job(item['name'], event=event, action=item.get('action', 's3snapshot'),
+                        every=item.get('every', EVERY), at=item.get('at'), window=item.get('window', window)))
+    if len(set(job.name for job in jobs)) != len(jobs):
+        raise ValueError('The names of the jobs must be unique')
+    return schedule, jobs
+
+
+class Daemon(object):
+    def __init__(self, schedule, sessions=None, program='', verbose=VERBOSE, clock=time.time):
+        """
+        Run the jobs of the schedule on time with the same sessions (clients and connections)
+        and the same inventory cache. Before each start the instances of the job are described again
+        (in a thread, so the scheduler starts the other jobs on time) and the run reads a fresh inventory.
+        The jobs that may touch the same instances are serialized
+        """
+        self.schedule, self.jobs = load_schedule(schedule)
+        self.sessions = sessions or default_sessions()
+        self.program = program
+        self.verbose = verbose
+        self.clock = clock
+        self.refresh_ahead = float(self.schedule.get('refresh-ahead', REFRESH_AHEAD))
+        self.max_jobs = int(self.schedule.get('max-jobs', MAX_JOBS))
+        self.cache_path = self.schedule.get('cache', DAEMON_CACHE)
+        self.cache_ttl = float(self.schedule.get('cache-ttl', DAEMON_CACHE_TTL))
+        self.running = dict()
+        self.refreshing = dict()
+        self.results = list()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def refresh(self, job):
+        """
+        Describe the instances of the job and write them to the cache (the run reads them from the cache)
+        Keep the instances of the job to find the jobs in conflict
+        """
+        options = parse_event(job.event)
+        if job.action != 's3snapshot' or options['selection'].volume_discovery:
+            # No inventory of instances: the conflicts are found by targets
+            job.instances = None
+            return
+        targets = [(role_arn, region) for role_arn in options['accounts'] for region in options['regions']]
+        # The clients of the settings of the job (the sessions are shared with the jobs running)
+        sessions = self.sessions.configured(options['client-config'], pool_size=options['concurrency'])
+        cache = None
+
+        def refresh_target(target):
+            role_arn, region = target
+            limiter = RateLimiter(options['rate-limits'], metrics=options['metrics'])
+            client = throttled_client(sessions, 'ec2', limiter, region=region, role_arn=role_arn)
+            instances = list(iter_instances(client, options['filters'], page_size=options['page-size']))
+            cache.put_instances(target_key(role_arn, region), options['filters'], instances)
+            return set((target_key(role_arn, region), instance['InstanceId']) for _, instance in instances
+                       if options['selection'].match_instance(instance))
+
+        try:
+            cache = InventoryCache(self.cache_path, ttl=self.cache_ttl)
+            parts = run_parallel(refresh_target, targets, min(len(targets), TARGET_CONCURRENCY))
+            job.instances = set().union(*parts)
+            click.echo('[+] Inventory of the job {0} refreshed : {1} instances'.format(job.name, len(job.instances)))
+        except Exception:
+            click.echo('[!] Unable to refresh the inventory of the job {0}'.format(job.name))
+            if self.verbose:
+                click.echo('[!] {0}'.format(traceback.format_exc()))
+            job.instances = None
+        finally:
+            if cache:
+                cache.close()
+
+    def run_refresh(self, job):
+        try:
+            self.refresh(job)
+        finally:
+            with self.lock:
+                del self.refreshing[job.name]
+
+    def start_refresh(self, job):
+        """
+        Refresh the inventory of the job in a thread (the job waits for it before it starts)
+        """
+        job.refreshed = job.next
+        thread = threading.Thread(target=self.run_refresh, args=(job,))
+        thread.daemon = True
+        with self.lock:
+            self.refreshing[job.name] = thread
+        thread.start()
+        return thread
+
+    def run_job(self, job, start):
+        event = dict(job.event)
+        if job.action == 's3snapshot':
+            event.setdefault('cache', self.cache_path)
+            event.setdefault('cache-ttl', self.cache_ttl)
+        try:
+            result = ACTIONS[job.action](verbose=self.verbose, start_time=start, program=self.program, event=event,
+                                         sessions=self.sessions)
+        except Exception:
+            click.echo('[!] The job {0} failed : {1}'.format(job.name, traceback.format_exc()))
+            result = {'result': FAULT}
+        click.echo('[=] Job {name} : {result} in {elapsed:.1f} seconds'.format(
+            name=job.name, result=result.get('result'), elapsed=self.clock() - start))
+        with self.lock:
+            self.results.append((job.name, start, result))
+            del self.running[job.name]
+
+    def start(self, job, now):
+        with self.lock:
+            self.running[job.name] = job
+        click.echo('[+] Starting the job {0} (slot {1})'.format(
+            job.name, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(job.next))))
+        job.schedule(now + 1)
+        thread = threading.Thread(target=self.run_job, args=(job, now))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def step(self):
+        """
+        Refresh the inventories of the jobs about to start and start the jobs due without conflicts
+        Return the seconds till the next event
+        """
+        now = self.clock()
+        for job in self.jobs:
+            if job.next is None:
+                job.schedule(now)
+            if job.refreshed != job.next and job.next - self.refresh_ahead <= now and job.name not in self.running:
+                self.start_refresh(job)
+
+        blocked = False
+        for job in sorted(self.jobs, key=lambda item: item.next):
+            if job.next > now or job.name in self.running:
+                continue
+            with self.lock:
+                running = list(self.running.values())
+                refreshing = job.name in self.refreshing
+            if len(running) >= self.max_jobs:
+                break
+            if refreshing:
+                # Started as soon as its inventory is read
+                blocked = True
+                continue
+            blocking = [other.name for other in running if other.conflicts(job)]
+            if blocking:
+                blocked = True
+                if self.verbose:
+                    click.echo('[=] Job {0} waiting for {1}'.format(job.name, ', '.join(blocking)))
+                continue
+            self.start(job, now)
+
+        waits = [job.next - self.refresh_ahead - now for job in self.jobs if job.refreshed != job.next]
+        waits += [job.next - now for job in self.jobs if job.name not in self.running]
+        if blocked:
+            # Check again soon if the jobs in conflict are finished
+            waits.append(BLOCKED_DELAY)
+        return max(1.0, min([TICK] + [wait for wait in waits if wait > 0]))
+
+    def stop(self, *args):
+        click.echo('[+] Stopping the scheduler (the running jobs are finished)')
+        self.stopped.set()
+
+    def run(self, until=None):
+        """
+        Schedule the jobs till stop (SIGTERM/SIGINT) or the time until, then wait for the running jobs
+        """
+        for job in self.jobs:
+            click.echo('[+] Job {name:20} : every {every}s - next start {start}'.format(
+                name=job.name, every=job.every,
+                start=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(job.schedule(self.clock())))))
+        while not self.stopped.is_set() and (until is None or self.clock() < until):
+            delay = self.step()
+            if until is not None:
+                delay = min(delay, max(0.0, until - self.clock()))
+            self.stopped.wait(delay)
+        while True:
+            with self.lock:
+                if not self.running and not self.refreshing:
+                    break
+            time.sleep(0.5)
+        return self.results
+
+
+def daemon(verbose=VERBOSE, program='', schedule=None, sessions=None, until=None, event=None):
+    """
+    Run the scheduler of the jobs of the schedule (path or dict) till SIGTERM/SIGINT
+    event: keys of all the jobs under the event of the schedule (ex: the CLI options)
+    """
+    schedule, _ = load_schedule(schedule)
+    if event:
+        schedule = dict(schedule, event=dict(event, **schedule.get('event', {})))
+    scheduler = Daemon(schedule, sessions=sessions, program=program, verbose=verbose)
+    try:
+        signal.signal(signal.SIGTERM, scheduler.stop)
+        signal.signal(signal.SIGINT, scheduler.stop)
+    except ValueError:
+        # Not the main thread: stopped by until
+        pass
+    return scheduler.run(until=until)
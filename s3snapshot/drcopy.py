@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# drcopy.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Copy of the snapshots created by the run to other regions (DR) within the concurrent copy limits"""
+
+from __future__ import print_function
+
+import threading
+import time
+import traceback
+from collections import deque
+
+import click
+from botocore.exceptions import ClientError
+from botocore.exceptions import ParamValidationError
+
+# Concurrent copies per destination region (service limit)
+COPY_CONCURRENCY = 20
+# Polls of the copies: first delay, growth of the delay when nothing changed, maximum delay and timeout (seconds)
+COPY_DELAY = 5
+COPY_BACKOFF = 1.5
+COPY_MAX_DELAY = 60
+COPY_TIMEOUT = 3600
+COPY_CHUNK = 200
+# Tags of the snapshot carried over to the copies
+COPY_TAGS = ('Name', 'Scripted', 'State:Protected')
+# The copies have this arbitrary volume id: the volume of the source is kept in the tag SOURCE_VOLUME_TAG
+COPY_VOLUME_ID = 'vol-ffffffff'
+SOURCE_VOLUME_TAG = 'SourceVolumeId'
+# The destination has no room for another copy
+LIMIT_ERRORS = ('ResourceLimitExceeded', 'PendingSnapshotLimitExceeded')
+
+
+class CopySlots(object):
+    def __init__(self, limit=COPY_CONCURRENCY):
+        """
+        Copies in flight per destination (account, region) shared by all the source regions of the run
+        When the service refuses a copy the limit of the destination is lowered to the copies in flight
+        (other copies use the quota too) and it grows by one after each copy completed up to limit
+        """
+        self.limit = int(limit)
+        self.limits = dict()
+        self.inflight = dict()
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        with self.lock:
+            if self.inflight.get(key, 0) >= self.limits.get(key, self.limit):
+                return False
+            self.inflight[key] = self.inflight.get(key, 0) + 1
+            return True
+
+    def release(self, key, completed=False):
+        with self.lock:
+            self.inflight[key] = max(0, self.inflight.get(key, 0) - 1)
+            if completed:
+                self.limits[key] = min(self.limit, self.limits.get(key, self.limit) + 1)
+
+    def refused(self, key):
+        with self.lock:
+            self.limits[key] = max(1, self.inflight.get(key, 0))
+
+
+def copy_tags(tags, volume_id=None):
+    tags = [tag for tag in tags if tag['Key'] in COPY_TAGS]
+    if volume_id:
+        tags.append({'Key': SOURCE_VOLUME_TAG, 'Value': volume_id})
+    return tags
+
+
+class CopyScheduler(object):
+    def __init__(self, source, region, clients, slots, account=None, program='', delay=COPY_DELAY,
+                 max_delay=COPY_MAX_DELAY, timeout=COPY_TIMEOUT, deadline=None):
+        """
+        Copy the snapshots of the source region (client source) to the destination regions
+        clients is a dict destination region -> client. One queue per destination is fed with the snapshots
+        as soon as they are completed and the copies start as soon as the destination has a free slot
+        The state of the sources and of the copies is polled with batched DescribeSnapshots calls
+        """
+        self.source = source
+        self.region = region
+        self.clients = clients
+        self.slots = slots
+        self.account = account
+        self.program = program
+        self.delay = delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.deadline = deadline
+
+    def poll(self, client, snapshot_ids):
+        """
+        Yield the snapshots with batched DescribeSnapshots calls (errors are retried on the next poll)
+        """
+        for i in range(0, len(snapshot_ids), COPY_CHUNK):
+            try:
+                response = client.describe_snapshots(SnapshotIds=snapshot_ids[i:i + COPY_CHUNK])
+            except Exception:
+                click.echo('[!] Error polling the state of the snapshots : {0}'.format(traceback.format_exc()))
+                continue
+            for snapshot in response.get('Snapshots', []):
+                yield snapshot
+
+    def start(self, item):
+        """
+        Start the copy of the item. Return started, refused (no room in the destination) or failed
+        """
+        client = self.clients[item['region']]
+        tags = item.pop('tags')
+        kwargs = {
+            'SourceRegion': self.region,
+            'SourceSnapshotId': item['source-snapshot-id'],
+            'Description': 'Script {program} [DR copy of {id} from {region}]'.format(
+                program=self.program, id=item['source-snapshot-id'], region=self.region),
+        }
+        try:
+            try:
+                response = client.copy_snapshot(
+                    TagSpecifications=[{'ResourceType': 'snapshot', 'Tags': tags}], **kwargs)
+            except ParamValidationError:
+                # The botocore installed don't know the TagSpecifications parameter of CopySnapshot
+                response = client.copy_snapshot(**kwargs)
+                client.create_tags(Resources=[response['SnapshotId']], Tags=tags)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in LIMIT_ERRORS:
+                item['tags'] = tags
+                return 'refused'
+            item['error'] = traceback.format_exc()
+            return 'failed'
+        except Exception:
+            item['error'] = traceback.format_exc()
+            return 'failed'
+
+        item['snapshot-id'] = response['SnapshotId']
+        item['started'] = time.time()
+        click.echo('[+] Copy started : {source-snapshot-id} -> {region} {snapshot-id}'.format(**item))
+        return 'started'
+
+    def run(self, snapshots):
+        """
+        snapshots is a dict source snapshot id -> tags
+        Return the list of records of the copies (one per snapshot and destination) with the state:
+        completed, error, failed (CopySnapshot failed), pending (still copying at the timeout),
+        not-started (queued at the timeout) or source-error / source-pending
+        """
+        waiting = dict(snapshots)
+        queues = dict((region, deque()) for region in self.clients)
+        inflight = dict((region, dict()) for region in self.clients)
+        records = list()
+        end = time.time() + self.timeout
+        delay = self.delay
+
+        while waiting or any(queues.values()) or any(inflight.values()):
+            progress = False
+
+            # The sources completed are queued for every destination
+            for snapshot in self.poll(self.source, sorted(waiting)):
+                if snapshot['SnapshotId'] not in waiting or snapshot.get('State') not in ('completed', 'error'):
+                    continue
+                tags = waiting.pop(snapshot['SnapshotId'])
+                progress = True
+                item = {
+                    'source-snapshot-id': snapshot['SnapshotId'],
+                    'source-region': self.region,
+                    'size-gb': snapshot.get('VolumeSize', 0),
+                }
+                if snapshot['State'] == 'error':
+                    records.append(dict(item, state='source-error', region=None))
+                    continue
+                for region in queues:
+                    queues[region].append(dict(item, region=region, tags=copy_tags(tags, snapshot.get('VolumeId')),
+                                               queued=time.time()))
+
+            # Start the copies up to the free slots of each destination
+            expired = self.deadline is not None and self.deadline.expired()
+            for region, queue in queues.items():
+                key = (self.account, region)
+                while queue and not expired and self.slots.acquire(key):
+                    item = queue.popleft()
+                    state = self.start(item)
+                    if state == 'refused':
+                        self.slots.release(key)
+                        self.slots.refused(key)
+                        queue.appendleft(item)
+                        break
+                    progress = True
+                    if state == 'started':
+                        inflight[region][item['snapshot-id']] = item
+                    else:
+                        self.slots.release(key)
+                        click.echo('[!] Unable to copy {source-snapshot-id} to {region}'.format(**item))
+                        records.append(dict(item, state='failed'))
+
+            # The copies completed free their slot
+            for region, copies in inflight.items():
+                for snapshot in self.poll(self.clients[region], sorted(copies)):
+                    if snapshot['SnapshotId'] not in copies or snapshot.get('State') not in ('completed', 'error'):
+                        continue
+                    item = copies.pop(snapshot['SnapshotId'])
+                    progress = True
+                    self.slots.release((self.account, region), completed=snapshot['State'] == 'completed')
+                    item['completed'] = time.time()
+                    records.append(dict(item, state=snapshot['State']))
+                    click.echo('[=] Copy {state} : {source-snapshot-id} -> {region} {snapshot-id}'.format(
+                        state=snapshot['State'], **item))
+
+            if not (waiting or any(queues.values()) or any(inflight.values())):
+                break
+            if time.time() + delay > end or expired:
+                for snapshot_id in sorted(waiting):
+                    records.append({'source-snapshot-id': snapshot_id, 'source-region': self.region,
+                                    'region': None, 'state': 'source-pending'})
+                for region, queue in queues.items():
+                    records.extend(dict(item, state='not-started') for item in queue)
+                for region, copies in inflight.items():
+                    for item in copies.values():
+                        self.slots.release((self.account, region))
+                        records.append(dict(item, state='pending'))
+                break
+            time.sleep(delay)
+            delay = self.delay if progress else min(self.max_delay, delay * COPY_BACKOFF)
+
+        for record in records:
+            record.pop('tags', None)
+        return records
+
+
+def copy_report(records):
+    """
+    Summary of the copies of each destination region: copies completed, throughput (GB/min from
+    the first copy started to the last completed), queue wait and copy time (seconds), failed,
+    pending and not started copies
+    """
+    report = dict()
+    for region in sorted(set(record['region'] for record in records if record.get('region'))):
+        items = [record for record in records if record.get('region') == region]
+        completed = [record for record in items if record['state'] == 'completed']
+        started = [record for record in items if 'started' in record]
+        waits = [record['started'] - record['queued'] for record in started]
+        times = [record['completed'] - record['started'] for record in completed]
+
+        gb_per_minute = 0.0
+        if completed:
+            span = max(record['completed'] for record in completed) - min(record['started'] for record in completed)
+            gb = sum(record['size-gb'] for record in completed)
+            gb_per_minute = round(gb / (span / 60.0), 2) if span > 0 else 0.0
+
+        report[region] = {
+            'copied': len(completed),
+            'copied-gb': sum(record['size-gb'] for record in completed),
+            'gb-per-minute': gb_per_minute,
+            'queue-wait': {
+                'avg': round(sum(waits) / len(waits), 1) if waits else 0.0,
+                'max': round(max(waits), 1) if waits else 0.0,
+            },
+            'copy-time': {
+                'avg': round(sum(times) / len(times), 1) if times else 0.0,
+                'max': round(max(times), 1) if times else 0.0,
+            },
+            'failed': [dict((key, record.get(key)) for key in ('source-snapshot-id', 'snapshot-id', 'state'))
+                       for record in items if record['state'] in ('error', 'failed')],
+            'pending': [record['snapshot-id'] for record in items if record['state'] == 'pending'],
+            'not-started': [record['source-snapshot-id'] for record in items if record['state'] == 'not-started'],
+        }
+    source = [record['source-snapshot-id'] for record in records if record['state'] in ('source-error',
+                                                                                         'source-pending')]
+    if source:
+        report['not-copied-sources'] = source
+    return report
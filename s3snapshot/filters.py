@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# filters.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Selection of the volumes: the filter of the event compiled to EC2 filters and a residual evaluated locally"""
+
+from __future__ import print_function
+
+import fnmatch
+import re
+
+# Values accepted in one EC2 filter
+MAX_VALUES = 200
+VOLUME_SCOPES = ('all', 'root', 'data')
+# instances: discovery by DescribeInstances, volumes: DescribeVolumes first (only the instances of the volumes
+# selected are described), auto: volumes when the selection has volume criteria and no instance ids
+DISCOVERY = 'auto'
+DISCOVERY_MODES = ('auto', 'instances', 'volumes')
+# The EC2 filters only know the wildcards * and ?
+LOCAL_PATTERN = re.compile(r'[\[\]]')
+# Event keys of the selection
+SELECTION_KEYS = ('tags', 'instances', 'volume-tags', 'volume-types', 'min-size', 'max-size', 'devices',
+                  'exclude-devices', 'volume-scope', 'discovery')
+
+
+def as_list(value):
+    if isinstance(value, (list, tuple)):
+        return [str(item) for item in value]
+    return [str(value)]
+
+
+def split_tags(tags):
+    """
+    Split the tag filters ex: {"tag:Env": ["PROD", "QA"], "tag:Backup": "*", "!tag:Scratch": "*"}
+    in the EC2 filters and the negated filters (prefix !) that EC2 can't evaluate
+    Return (filters, negated) where negated is a list of (tag key, patterns)
+    """
+    filters = list()
+    negated = list()
+    for name, value in sorted(tags.items()):
+        if name.startswith('!'):
+            if not name.startswith('!tag:'):
+                raise ValueError('Only the tag filters can be negated: {0}'.format(name))
+            negated.append((name[5:], as_list(value)))
+        else:
+            filters.append({'Name': name, 'Values': as_list(value)})
+    return filters, negated
+
+
+def match_any(value, patterns):
+    return any(fnmatch.fnmatchcase(value or '', pattern) for pattern in patterns)
+
+
+class Selection(object):
+    def __init__(self, instance_filters=None, negated_tags=None, volume_filters=None, negated_volume_tags=None,
+                 devices=None, exclude_devices=None, volume_scope='all', min_size=None, max_size=None,
+                 discovery=DISCOVERY):
+        """
+        Volumes to snapshot: instance_filters and volume_filters are the EC2 filters of DescribeInstances and
+        DescribeVolumes (server side), the other criteria are the residual evaluated locally
+        (negated tags, device patterns EC2 can't evaluate, root/data volumes and size ranges)
+        """
+        if volume_scope not in VOLUME_SCOPES:
+            raise ValueError('Unknown volume scope {0}'.format(volume_scope))
+        if discovery not in DISCOVERY_MODES:
+            raise ValueError('Unknown discovery {0}'.format(discovery))
+        self.instance_filters = instance_filters or []
+        self.negated_tags = negated_tags or []
+        self.volume_filters = volume_filters or []
+        self.negated_volume_tags = negated_volume_tags or []
+        self.devices = devices or []
+        self.exclude_devices = exclude_devices or []
+        self.volume_scope = volume_scope
+        self.min_size = min_size
+        self.max_size = max_size
+        self.discovery = discovery
+
+    @property
+    def needs_volumes(self):
+        """
+        True if the volumes must be described (type, size or tags of the volumes)
+        """
+        return bool(self.volume_filters or self.negated_volume_tags or self.min_size or self.max_size)
+
+    @property
+    def selects_volumes(self):
+        """
+        True if some volumes of the instances selected can be left out
+        """
+        return bool(self.needs_volumes or self.devices or self.exclude_devices or self.volume_scope != 'all')
+
+    @property
+    def instance_ids(self):
+        for item in self.instance_filters:
+            if item['Name'] == 'instance-id':
+                return item['Values']
+        return None
+
+    @property
+    def volume_discovery(self):
+        if self.discovery == 'auto':
+            return self.needs_volumes and not self.instance_ids
+        return self.discovery == 'volumes'
+
+    def server_devices(self):
+        """
+        Device patterns that EC2 can evaluate (all or none, the filter values are ORed)
+        """
+        if self.devices and not any(LOCAL_PATTERN.search(device) for device in self.devices):
+            return self.devices
+        return []
+
+    def discovery_filters(self):
+        """
+        DescribeVolumes filters of the volume discovery: the volumes attached selected by the server side criteria
+        """
+        filter_list = list(self.volume_filters)
+        filter_list.append({'Name': 'attachment.status', 'Values': ['attached']})
+        if self.server_devices():
+            filter_list.append({'Name': 'attachment.device', 'Values': self.server_devices()})
+        for item in self.instance_filters:
+            if item['Name'] == 'instance-id':
+                filter_list.append({'Name': 'attachment.instance-id', 'Values': item['Values']})
+        return filter_list
+
+    def match_tags(self, tags):
+        """
+        False if a tag matches one of the negated tag filters (the tags of an instance or of its snapshots)
+        """
+        values = dict((tag['Key'], tag['Value']) for tag in tags or [])
+        return not any(key in values and match_any(values[key], patterns) for key, patterns in self.negated_tags)
+
+    def match_instance(self, instance):
+        return self.match_tags(instance.get('Tags'))
+
+    def match_block(self, device_name, root_device):
+        if self.volume_scope == 'root' and not root_device:
+            return False
+        if self.volume_scope == 'data' and root_device:
+            return False
+        if self.devices and not match_any(device_name, self.devices):
+            return False
+        return not (self.exclude_devices and match_any(device_name, self.exclude_devices))
+
+    def match_volume(self, volume):
+        size = volume.get('Size', 0)
+        if self.min_size and size < self.min_size:
+            return False
+        if self.max_size and size > self.max_size:
+            return False
+        values = dict((tag['Key'], tag['Value']) for tag in volume.get('Tags') or [])
+        return not any(key in values and match_any(values[key], patterns)
+                       for key, patterns in self.negated_volume_tags)
+
+
+def compile_selection(event):
+    """
+    Build the Selection of the event keys:
+    tags: {"tag:Env": "PROD" | ["PROD", "QA"] | "prod-*", "!tag:Scratch": "*"} (! negates, * is any value)
+    instances: [instance ids]
+    volume-tags: same as tags for the tags of the volumes
+    volume-types: ["gp3", "io2"]
+    min-size / max-size: GiB
+    devices / exclude-devices: device name patterns ex: ["/dev/sd[f-p]", "/dev/xvd*"]
+    volume-scope: all, root (only the root volumes) or data (only the data volumes)
+    discovery: auto, instances or volumes
+    """
+    instance_filters, negated_tags = split_tags(event.get('tags') or {})
+    if event.get('instances'):
+        instance_filters.append({'Name': 'instance-id', 'Values': [item for item in event.get('instances')]})
+
+    devices = as_list(event['devices']) if event.get('devices') else []
+    exclude_devices = as_list(event['exclude-devices']) if event.get('exclude-devices') else []
+    selection = Selection(devices=devices, exclude_devices=exclude_devices,
+                          volume_scope=event.get('volume-scope') or 'all',
+                          discovery=event.get('discovery') or DISCOVERY)
+    if selection.server_devices():
+        # Only the instances with at least one of the devices
+        instance_filters.append({'Name': 'block-device-mapping.device-name', 'Values': selection.server_devices()})
+    selection.instance_filters = instance_filters
+    selection.negated_tags = negated_tags
+
+    volume_filters, negated_volume_tags = split_tags(event.get('volume-tags') or {})
+    if event.get('volume-types'):
+        volume_filters.append({'Name': 'volume-type', 'Values': as_list(event['volume-types'])})
+    if event.get('min-size') is not None:
+        selection.min_size = int(event['min-size'])
+    if event.get('max-size') is not None:
+        selection.max_size = int(event['max-size'])
+        low = max(1, selection.min_size or 1)
+        if selection.max_size - low < MAX_VALUES:
+            # The filter size only matches exact values: small ranges are sent as the list of sizes
+            volume_filters.append({'Name': 'size', 'Values': [str(size) for size in
+                                                              range(low, selection.max_size + 1)]})
+    selection.volume_filters = volume_filters
+    selection.negated_volume_tags = negated_volume_tags
+    return selection
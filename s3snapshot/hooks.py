@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+#
+# hooks.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Freeze and thaw hooks run on the instances for application-consistent snapshots without stopping them"""
+
+from __future__ import print_function
+
+import threading
+import time
+import traceback
+
+import click
+from botocore.exceptions import ClientError
+
+from .ratelimit import throttled_client
+
+HOOKS_BACKEND = 'ssm'
+# Seconds to wait for the acknowledgement of a freeze
+FREEZE_TIMEOUT = 30
+# Seconds after which an instance thaws itself when the thaw command never arrives
+THAW_AFTER = 60
+# Polls of the commands: first delay, growth of the delay when nothing changed and maximum delay (seconds)
+HOOK_DELAY = 0.2
+HOOK_BACKOFF = 1.5
+HOOK_MAX_DELAY = 2.0
+# Instances of one SendCommand call
+SSM_BATCH = 50
+SSM_DOCUMENT = 'AWS-RunShellScript'
+# Final states of the command invocations
+DONE_STATES = ('Success', 'Failed', 'TimedOut', 'Cancelled', 'Undeliverable', 'Terminated', 'InvalidPlatform',
+               'AccessDenied')
+# Keys of the hooks configuration not given to the backend
+HOOK_KEYS = ('freeze', 'thaw', 'timeout', 'thaw-after')
+
+# The data filesystems (ext3/4, xfs) are frozen, the root and boot filesystems stay writable so the agent
+# can receive the thaw. The instance thaws itself after {thaw_after} seconds
+FREEZE_COMMANDS = [
+    'STATE=/run/s3snapshot-frozen',
+    'sync',
+    ': > $STATE',
+    'for mount in $(findmnt -rn -t ext3,ext4,xfs -o TARGET | grep -vxE "/|/boot|/boot/efi"); do',
+    '  if fsfreeze -f "$mount"; then echo "$mount" >> $STATE; else',
+    '    for frozen in $(cat $STATE); do fsfreeze -u "$frozen"; done; rm -f $STATE; exit 1',
+    '  fi',
+    'done',
+    'nohup sh -c "sleep {thaw_after}; for frozen in \\$(cat $STATE 2>/dev/null); do fsfreeze -u \\$frozen; done; '
+    'rm -f $STATE" > /dev/null 2>&1 &',
+]
+THAW_COMMANDS = [
+    'STATE=/run/s3snapshot-frozen',
+    'for frozen in $(cat $STATE 2>/dev/null); do fsfreeze -u "$frozen" || true; done',
+    'rm -f $STATE',
+]
+
+
+class SSMCommands(object):
+    def __init__(self, sessions, region=None, role_arn=None, limiter=None, document=SSM_DOCUMENT,
+                 execution_timeout=FREEZE_TIMEOUT):
+        """
+        Run the hooks with the SendCommand calls of Systems Manager (the instances need the SSM agent)
+        All the calls of the region share the rate limits of limiter
+        """
+        if limiter:
+            self.client = throttled_client(sessions, 'ssm', limiter, region=region, role_arn=role_arn)
+        else:
+            self.client = sessions.client('ssm', region=region, role_arn=role_arn)
+        self.document = document
+        self.execution_timeout = int(execution_timeout)
+
+    def send(self, instance_ids, commands, comment=''):
+        """
+        Send the commands to the instances. Return the list of (command id, instance ids) sent and
+        a dict instance id -> error for the instances that could not receive them
+        """
+        sent = list()
+        errors = dict()
+        for i in range(0, len(instance_ids), SSM_BATCH):
+            batch = instance_ids[i:i + SSM_BATCH]
+            try:
+                sent.append((self.send_command(batch, commands, comment), batch))
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'InvalidInstanceId' or len(batch) == 1:
+                    errors.update((instance_id, traceback.format_exc()) for instance_id in batch)
+                    continue
+                # One instance not managed by SSM rejects the whole call: send them one by one
+                for instance_id in batch:
+                    try:
+                        sent.append((self.send_command([instance_id], commands, comment), [instance_id]))
+                    except Exception:
+                        errors[instance_id] = traceback.format_exc()
+            except Exception:
+                errors.update((instance_id, traceback.format_exc()) for instance_id in batch)
+        return sent, errors
+
+    def send_command(self, instance_ids, commands, comment):
+        response = self.client.send_command(
+            InstanceIds=instance_ids,
+            DocumentName=self.document,
+            Comment=comment[:100],
+            TimeoutSeconds=max(30, self.execution_timeout),
+            Parameters={'commands': commands, 'executionTimeout': [str(self.execution_timeout)]}
+        )
+        return response['Command']['CommandId']
+
+    def status(self, command_id):
+        """
+        Return a dict instance id -> (status, output) of the invocations of the command
+        """
+        states = dict()
+        kwargs = {'CommandId': command_id, 'Details': True}
+        while True:
+            response = self.client.list_command_invocations(**kwargs)
+            for item in response.get('CommandInvocations', []):
+                output = ''.join(plugin.get('Output', '') for plugin in item.get('CommandPlugins', []))
+                states[item['InstanceId']] = (item.get('Status'), output)
+            if not response.get('NextToken'):
+                return states
+            kwargs['NextToken'] = response['NextToken']
+
+
+# Backends available with the event key hooks: {"backend": "<name>", ...}
+HOOKS_BACKENDS = {
+    'ssm': SSMCommands,
+}
+
+
+class FreezeHooks(object):
+    def __init__(self, backend, freeze=None, thaw=None, timeout=FREEZE_TIMEOUT, thaw_after=THAW_AFTER,
+                 delay=HOOK_DELAY, max_delay=HOOK_MAX_DELAY):
+        """
+        Freeze the instances with batched commands and thaw each instance as soon as its snapshots
+        are created. freeze and thaw are the lists of shell commands ({thaw_after} is replaced)
+        """
+        self.backend = backend
+        self.freeze_commands = [command.replace('{thaw_after}', str(int(thaw_after)))
+                                for command in (freeze or FREEZE_COMMANDS)]
+        self.thaw_commands = list(thaw or THAW_COMMANDS)
+        self.timeout = float(timeout)
+        self.delay = delay
+        self.max_delay = max_delay
+        self.records = dict()
+        self.thaws = list()
+        # Instances not frozen because the deadline expired
+        self.deferred = list()
+        self.frozen = 0
+        self.lock = threading.Lock()
+
+    def wait(self, pending, deadline):
+        """
+        Poll the commands of pending (dict command id -> set of instance ids) and yield
+        (instance id, status, output) for each invocation finished. Remove them from pending
+        """
+        for command_id, instance_ids in list(pending.items()):
+            try:
+                states = self.backend.status(command_id)
+            except Exception:
+                click.echo('[!] Error polling the command {0} : {1}'.format(command_id, traceback.format_exc()))
+                states = dict()
+            for instance_id in list(instance_ids):
+                status, output = states.get(instance_id, (None, ''))
+                if status in DONE_STATES or time.time() > deadline:
+                    instance_ids.discard(instance_id)
+                    yield instance_id, status, output
+            if not instance_ids:
+                del pending[command_id]
+
+    def freeze(self, instance_ids, limit=1, deadline=None):
+        """
+        Freeze the instances and yield (instance id, error) as soon as each freeze is acknowledged
+        (error None) or failed. At most limit instances are frozen and not thawed at the same time
+        so an instance is not left frozen while it waits for a free worker. Each instance yielded
+        must be given to thaw (a freeze that failed may have frozen some filesystems)
+        No freeze is sent after the deadline expires, the instances left are kept in deferred
+        """
+        waiting = list(instance_ids)
+        pending = dict()
+        sent_at = dict()
+        delay = self.delay
+        while waiting or pending:
+            if waiting and deadline is not None and deadline.expired():
+                self.deferred.extend(waiting)
+                waiting = list()
+            with self.lock:
+                free = max(0, int(limit) - self.frozen)
+            if waiting and free:
+                batch, waiting = waiting[:free], waiting[free:]
+                with self.lock:
+                    self.frozen += len(batch)
+                now = time.time()
+                sent, errors = self.backend.send(batch, self.freeze_commands, comment='s3snapshot freeze')
+                for command_id, ids in sent:
+                    pending[command_id] = set(ids)
+                    sent_at.update((instance_id, now) for instance_id in ids)
+                for instance_id, error in errors.items():
+                    # Not delivered: nothing to thaw
+                    self.records[instance_id] = {'instance-id': instance_id, 'state': 'freeze-failed',
+                                                 'thaw': 'not-needed'}
+                    yield instance_id, error
+
+            progress = False
+            for command_id, ids in list(pending.items()):
+                done = list(self.wait({command_id: ids}, sent_at[next(iter(ids))] + self.timeout))
+                if not ids:
+                    del pending[command_id]
+                for instance_id, status, output in done:
+                    progress = True
+                    record = {'instance-id': instance_id, 'freeze-time': time.time() - sent_at[instance_id]}
+                    self.records[instance_id] = record
+                    if status == 'Success':
+                        record['state'] = 'frozen'
+                        record['frozen'] = time.time()
+                        yield instance_id, None
+                    else:
+                        record['state'] = 'freeze-failed'
+                        yield instance_id, 'Freeze of instance {id} {status} {output}'.format(
+                            id=instance_id, status=status or 'timed out', output=output.strip()).strip()
+
+            if (waiting and not free) or pending:
+                time.sleep(delay)
+                delay = self.delay if progress else min(self.max_delay, delay * HOOK_BACKOFF)
+
+    def thaw(self, instance_id):
+        """
+        Send the thaw of the instance (never raises, the failures are reported by wait_thawed)
+        """
+        now = time.time()
+        record = self.records.setdefault(instance_id, {'instance-id': instance_id, 'state': 'freeze-failed'})
+        if record.get('thaw') == 'not-needed':
+            with self.lock:
+                self.frozen = max(0, self.frozen - 1)
+            return
+        sent, errors = self.backend.send([instance_id], self.thaw_commands, comment='s3snapshot thaw')
+        with self.lock:
+            self.frozen = max(0, self.frozen - 1)
+            if 'frozen' in record:
+                record['window'] = now - record.pop('frozen')
+            if errors:
+                record['thaw'] = 'failed'
+                record['thaw-error'] = errors[instance_id]
+            else:
+                record['thaw'] = 'sent'
+                self.thaws.extend(sent)
+        if errors:
+            click.echo('[!] Unable to thaw instance {0}. It thaws itself after the timeout'.format(instance_id))
+        else:
+            click.echo('[+] Instance thawed : {0}'.format(instance_id))
+
+    def wait_thawed(self):
+        """
+        Wait for the thaw commands and return the list of records of the run
+        """
+        pending = dict((command_id, set(ids)) for command_id, ids in self.thaws)
+        delay = self.delay
+        end = time.time() + self.timeout
+        while pending:
+            for instance_id, status, output in self.wait(pending, end):
+                record = self.records[instance_id]
+                record['thaw'] = 'thawed' if status == 'Success' else 'failed'
+                if status != 'Success':
+                    record['thaw-error'] = 'Thaw of instance {id} {status} {output}'.format(
+                        id=instance_id, status=status or 'timed out', output=output.strip()).strip()
+            if pending:
+                time.sleep(delay)
+                delay = min(self.max_delay, delay * HOOK_BACKOFF)
+        return list(self.records.values())
+
+
+def freeze_hooks(config, sessions, region=None, role_arn=None, limiter=None):
+    """
+    Build the hooks from the event configuration ex: {"backend": "ssm", "timeout": 30, "thaw-after": 60,
+    "freeze": [<commands>], "thaw": [<commands>]}. The other keys are given to the backend
+    """
+    config = dict(config or {})
+    name = config.pop('backend', HOOKS_BACKEND)
+    if name not in HOOKS_BACKENDS:
+        raise ValueError('Unknown hooks backend {0}'.format(name))
+    hook_config = dict((key.replace('-', '_'), config.pop(key)) for key in HOOK_KEYS if key in config)
+    config.setdefault('execution_timeout', hook_config.get('timeout', FREEZE_TIMEOUT))
+    backend = HOOKS_BACKENDS[name](sessions, region=region, role_arn=role_arn, limiter=limiter, **config)
+    return FreezeHooks(backend, **hook_config)
+
+
+def hooks_report(records):
+    """
+    Summary of the hooks: instances frozen, freeze time (send to acknowledgement) and consistency
+    window (acknowledgement to thaw sent) in seconds, instances where the freeze or the thaw failed
+    """
+    frozen = [record for record in records if record['state'] == 'frozen']
+    freeze_times = [record['freeze-time'] for record in records if 'freeze-time' in record]
+    windows = [record['window'] for record in frozen if 'window' in record]
+    return {
+        'frozen': len(frozen),
+        'freeze-time': {
+            'avg': round(sum(freeze_times) / len(freeze_times), 3) if freeze_times else 0.0,
+            'max': round(max(freeze_times), 3) if freeze_times else 0.0,
+        },
+        'window': {
+            'avg': round(sum(windows) / len(windows), 3) if windows else 0.0,
+            'max': round(max(windows), 3) if windows else 0.0,
+        },
+        'freeze-failed': sorted(record['instance-id'] for record in records if record['state'] == 'freeze-failed'),
+        'thaw-failed': sorted(record['instance-id'] for record in records if record.get('thaw') == 'failed'),
+    }
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# journal.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Time budget of the run and journal of the volumes already processed (resume)"""
+
+from __future__ import print_function
+
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+import click
+
+# Stop starting new instances when less than MARGIN seconds are left
+MARGIN = 30
+JOURNAL_DIR = '/tmp/s3snapshot-journal'
+JOURNAL_STORE = 'file'
+# Minimum seconds between two saves of the journal while the run is in progress
+SAVE_INTERVAL = 5
+TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class Deadline(object):
+    def __init__(self, context=None, budget=None, margin=MARGIN):
+        """
+        Deadline of the run given by the Lambda context (get_remaining_time_in_millis)
+        and/or by a time budget in seconds. Without both the run never expires
+        """
+        self.context = context if hasattr(context, 'get_remaining_time_in_millis') else None
+        self.end = time.time() + float(budget) if budget else None
+        self.margin = float(margin)
+
+    @property
+    def enabled(self):
+        return bool(self.context or self.end)
+
+    def remaining(self):
+        """
+        Seconds left before the deadline (None if there is no deadline)
+        """
+        remaining = list()
+        if self.context:
+            remaining.append(self.context.get_remaining_time_in_millis() / 1000.0)
+        if self.end:
+            remaining.append(self.end - time.time())
+        return min(remaining) if remaining else None
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining < self.margin
+
+
+class FileJournalStore(object):
+    def __init__(self, path=JOURNAL_DIR):
+        """
+        Keep each journal in a json file of the directory (ex: /tmp of the Lambda container)
+        """
+        self.path = path
+
+    def filename(self, run_id):
+        return os.path.join(self.path, '{0}.json'.format(run_id))
+
+    def load(self, run_id):
+        try:
+            with open(self.filename(run_id)) as fp:
+                return json.load(fp)
+        except (IOError, OSError):
+            return None
+
+    def save(self, run_id, data):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        # Write and rename so a run killed in the middle never leaves a truncated journal
+        temp = '{0}.tmp'.format(self.filename(run_id))
+        with open(temp, 'w') as fp:
+            json.dump(data, fp, separators=(',', ':'))
+        os.rename(temp, self.filename(run_id))
+
+    def delete(self, run_id):
+        try:
+            os.remove(self.filename(run_id))
+        except (IOError, OSError):
+            pass
+
+
+# Stores available with the event key journal: {"store": "<name>", ...}
+JOURNAL_STORES = {
+    'file': FileJournalStore,
+}
+
+
+def journal_store(config=None):
+    """
+    Build the store of the journal from the event configuration ex: {"store": "file", "path": "/tmp/journal"}
+    """
+    config = dict(config or {})
+    name = config.pop('store', JOURNAL_STORE)
+    if name not in JOURNAL_STORES:
+        raise ValueError('Unknown journal store {0}'.format(name))
+    return JOURNAL_STORES[name](**config)
+
+
+def target_key(role_arn=None, region=None):
+    """
+    Key of one region of one account in the journal
+    """
+    return '{account}/{region}'.format(account=role_arn or 'self', region=region or 'default')
+
+
+class Journal(object):
+    def __init__(self, store, run_id=None, data=None, save_interval=SAVE_INTERVAL):
+        """
+        Volumes already processed by each region of each account of the run
+        The run_id is the continuation token returned to resume the run
+        """
+        self.store = store
+        self.run_id = run_id or 'snapshot-{date}-{id}'.format(
+            date=time.strftime('%Y%m%d%H%M%S', time.gmtime()),
+            id=uuid.uuid4().hex[:8]
+        )
+        self.data = data or {'run-id': self.run_id, 'created': time.time(), 'invocations': 0, 'done': {}}
+        self.save_interval = save_interval
+        self.last_save = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def resume(cls, store, token):
+        """
+        Load the journal of the continuation token (None if it does not exist)
+        """
+        if not TOKEN_PATTERN.match(token or ''):
+            return None
+        data = store.load(token)
+        if data is None:
+            return None
+        return cls(store, run_id=token, data=data)
+
+    def done(self, target):
+        with self.lock:
+            return set(self.data['done'].get(target, []))
+
+    def mark(self, target, volume_ids):
+        """
+        Record the volumes processed (successful or not) so they are not snapshotted again
+        """
+        with self.lock:
+            self.data['done'].setdefault(target, []).extend(volume_ids)
+            if time.time() - self.last_save < self.save_interval:
+                return
+        self.save()
+
+    def save(self):
+        """
+        Return False if the journal could not be saved
+        """
+        with self.lock:
+            self.last_save = time.time()
+            try:
+                self.store.save(self.run_id, self.data)
+            except Exception:
+                click.echo('[!] Unable to save the journal {0}'.format(self.run_id))
+                return False
+        return True
+
+    def start(self):
+        """
+        Count one more invocation of the run and save the journal
+        """
+        with self.lock:
+            self.data['invocations'] += 1
+        return self.save()
+
+    def complete(self):
+        """
+        Remove the journal once every volume is processed
+        """
+        self.store.delete(self.run_id)
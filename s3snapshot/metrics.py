@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# metrics.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Metrics of the API calls and of the phases of the run"""
+
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+NAMESPACE = 's3snapshot'
+# Upper bounds (milliseconds) of the buckets of the latency histograms
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code', 'ClientError')
+    return type(error).__name__
+
+
+class OperationMetrics(object):
+    def __init__(self):
+        """
+        Counters and latency histogram of one API operation
+        """
+        self.calls = 0
+        self.errors = 0
+        self.throttles = 0
+        self.retries = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+        self.error_codes = dict()
+
+    def record(self, latency, error=None, throttled=False):
+        milliseconds = latency * 1000.0
+        self.calls += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+        index = 0
+        while index < len(BUCKETS) and milliseconds > BUCKETS[index]:
+            index += 1
+        self.histogram[index] += 1
+        if throttled:
+            self.throttles += 1
+        elif error:
+            self.errors += 1
+            self.error_codes[error] = self.error_codes.get(error, 0) + 1
+
+    def percentile(self, percent):
+        """
+        Upper bound of the bucket of the percentile (the max for the last bucket)
+        """
+        if not self.calls:
+            return 0.0
+        rank = self.calls * percent / 100.0
+        count = 0
+        for index, bucket_count in enumerate(self.histogram):
+            count += bucket_count
+            if count >= rank:
+                return float(BUCKETS[index]) if index < len(BUCKETS) else round(self.max, 2)
+        return round(self.max, 2)
+
+    def to_dict(self):
+        labels = ['<={0}'.format(bound) for bound in BUCKETS] + ['>{0}'.format(BUCKETS[-1])]
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'error-codes': self.error_codes,
+            'throttles': self.throttles,
+            'retries': self.retries,
+            'latency-ms': {
+                'avg': round(self.total / self.calls, 2) if self.calls else 0.0,
+                'max': round(self.max, 2),
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+            },
+            'histogram-ms': dict((label, count) for label, count in zip(labels, self.histogram) if count),
+        }
+
+
+class Phase(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.add_phase(self.name, time.time() - self.start)
+
+
+class Metrics(object):
+    def __init__(self):
+        """
+        Thread safe metrics of one run: calls, errors, throttles, retries and latency of each API operation
+        and the time spent in each phase (the time of the workers running in parallel is added up)
+        """
+        self.lock = threading.Lock()
+        self.operations = dict()
+        self.phases = dict()
+
+    def record(self, operation, latency, error=None, throttled=False):
+        """
+        Record one attempt of the operation (latency in seconds, error is the error code)
+        """
+        with self.lock:
+            self.operations.setdefault(operation, OperationMetrics()).record(latency, error, throttled)
+
+    def retry(self, operation):
+        with self.lock:
+            self.operations.setdefault(operation, OperationMetrics()).retries += 1
+
+    def call(self, operation, function, *args, **kwargs):
+        """
+        Call the function and record the attempt (used for the calls that don't go through the rate limiter)
+        """
+        start = time.time()
+        try:
+            response = function(*args, **kwargs)
+        except Exception as e:
+            self.record(operation, time.time() - start, error=error_code(e))
+            raise
+        self.record(operation, time.time() - start)
+        return response
+
+    def phase(self, name):
+        """
+        Context manager that adds the time of the block to the phase
+        """
+        return Phase(self, name)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            phase = self.phases.setdefault(name, {'seconds': 0.0, 'count': 0})
+            phase['seconds'] += seconds
+            phase['count'] += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'operations': dict((operation, item.to_dict()) for operation, item in sorted(self.operations.items())),
+                'phases': dict((name, {'seconds': round(phase['seconds'], 3), 'count': phase['count']})
+                               for name, phase in self.phases.items()),
+            }
+
+    def emf(self, namespace=NAMESPACE, timestamp=None):
+        """
+        Return the metrics as CloudWatch embedded metric format log lines (one per operation and per phase)
+        """
+        timestamp = int((timestamp or time.time()) * 1000)
+        data = self.to_dict()
+        lines = list()
+        for operation, item in sorted(data['operations'].items()):
+            lines.append(json.dumps({
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [['Operation']],
+                        'Metrics': [
+                            {'Name': 'Calls', 'Unit': 'Count'},
+                            {'Name': 'Errors', 'Unit': 'Count'},
+                            {'Name': 'Throttles', 'Unit': 'Count'},
+                            {'Name': 'Retries', 'Unit': 'Count'},
+                            {'Name': 'LatencyAvg', 'Unit': 'Milliseconds'},
+                            {'Name': 'LatencyMax', 'Unit': 'Milliseconds'},
+                        ]
+                    }]
+                },
+                'Operation': operation,
+                'Calls': item['calls'],
+                'Errors': item['errors'],
+                'Throttles': item['throttles'],
+                'Retries': item['retries'],
+                'LatencyAvg': item['latency-ms']['avg'],
+                'LatencyMax': item['latency-ms']['max'],
+            }, sort_keys=True))
+        for name, phase in sorted(data['phases'].items()):
+            lines.append(json.dumps({
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [['Phase']],
+                        'Metrics': [{'Name': 'PhaseTime', 'Unit': 'Seconds'}]
+                    }]
+                },
+                'Phase': name,
+                'PhaseTime': phase['seconds'],
+                'PhaseCount': phase['count'],
+            }, sort_keys=True))
+        return lines
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+#
+# plan.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Snapshot plan: discovery and names computed ahead of the run and executed later"""
+
+from __future__ import print_function
+
+import datetime
+import json
+import os
+import time
+import traceback
+from collections import OrderedDict
+
+import click
+
+from .accounts import default_sessions
+from .accounts import account_id
+from .filters import SELECTION_KEYS
+from .hooks import SSM_BATCH
+from .journal import target_key
+from .ratelimit import RateLimiter
+from .ratelimit import throttled_client
+from .s3snapshot import FAULT
+from .s3snapshot import FILTER_CHUNK
+from .s3snapshot import STATE_BATCH
+from .s3snapshot import VERBOSE
+from .s3snapshot import RunTotals
+from .s3snapshot import SnapshotItem
+from .s3snapshot import discover_volumes
+from .s3snapshot import parse_event
+from .s3snapshot import run_targets
+from .s3snapshot import s3snapshot
+from .s3snapshot import targets_result
+from .s3snapshot import targets_summary
+
+PLAN_VERSION = 1
+# Keys of the event that define the job of the plan (the other keys are given when the plan is executed)
+PLAN_KEYS = SELECTION_KEYS + ('stop', 'stopped', 'label', 'protected', 'multi-volume', 'exclude-root',
+                              'skip-unchanged', 'min-interval', 'regions', 'accounts', 'role-session-name', 'hooks')
+
+
+def dedupe_volumes(snapshot_volumes):
+    """
+    Keep one snapshot of the volumes attached to several instances (multi-attach)
+    Return (volumes, duplicates) with duplicates a list of dicts volume-id -> instance-ids
+    """
+    instances = OrderedDict()
+    volumes = list()
+    for snapshot in snapshot_volumes:
+        if snapshot.volume_id in instances:
+            instances[snapshot.volume_id].append(snapshot.instance_id)
+            continue
+        instances[snapshot.volume_id] = [snapshot.instance_id]
+        volumes.append(snapshot)
+    duplicates = [{'volume-id': volume_id, 'instance-ids': instance_ids}
+                  for volume_id, instance_ids in instances.items() if len(instance_ids) > 1]
+    return volumes, duplicates
+
+
+def ceil_div(count, size):
+    return (count + size - 1) // size
+
+
+def expected_calls(instances, volumes, options):
+    """
+    Number of write and polling API calls of the execution of the plan per operation
+    (without retries, one poll of the stopped instances and of the completed snapshots)
+    """
+    # The names of the plan are resolved again at the execution
+    calls = {'describe_snapshots': ceil_div(volumes, FILTER_CHUNK)}
+    if options['multi-volume']:
+        calls['create_snapshots'] = instances
+        # The Name of each snapshot is written by the tagger
+        calls['create_tags'] = volumes
+    else:
+        calls['create_snapshot'] = volumes
+    if options['stop']:
+        calls['stop_instances'] = ceil_div(instances, STATE_BATCH)
+        calls['describe_instances'] = ceil_div(instances, FILTER_CHUNK)
+        calls['start_instances'] = instances
+    elif options['stopped']:
+        calls['describe_instances'] = ceil_div(instances, FILTER_CHUNK)
+        calls['start_instances'] = instances if options['multi-volume'] else volumes
+    elif options['hooks'] is not None:
+        # Batched freezes, one thaw per instance and one poll of each command
+        calls['send_command'] = ceil_div(instances, SSM_BATCH) + instances
+        calls['list_command_invocations'] = ceil_div(instances, SSM_BATCH) + instances
+    if options['track-completion']:
+        calls['describe_snapshots'] += ceil_div(volumes, FILTER_CHUNK)
+    if options['copy-regions']:
+        # At least one poll of the sources and of the copies of each destination
+        calls['describe_snapshots'] = calls.get('describe_snapshots', 0) + ceil_div(volumes, FILTER_CHUNK) * (
+            1 + len(options['copy-regions']))
+        calls['copy_snapshot'] = volumes * len(options['copy-regions'])
+    calls['publish'] = 1
+    return dict((operation, count) for operation, count in calls.items() if count)
+
+
+def snapshot_name(snapshot):
+    return [tag['Value'] for tag in snapshot.tags if tag['Key'] == 'Name'][0]
+
+
+def plan_instances(snapshot_volumes):
+    """
+    Compact form of the volumes: the instance data is written once with the volumes of the instance
+    """
+    instances = OrderedDict()
+    for snapshot in snapshot_volumes:
+        if snapshot.instance_id not in instances:
+            instances[snapshot.instance_id] = {
+                'instance-id': snapshot.instance_id,
+                'name': snapshot.instance_name,
+                'state': snapshot.state,
+                'owner-id': snapshot.owner_id,
+                'stop-time': snapshot.stop_time,
+                'data-volumes': snapshot.data_volumes,
+                'tags': [tag for tag in snapshot.tags if tag['Key'] != 'Name'],
+                'volumes': []
+            }
+        instances[snapshot.instance_id]['volumes'].append({
+            'volume-id': snapshot.volume_id,
+            'device': snapshot.device_name,
+            'root': snapshot.root_device,
+            'snapshot-name': snapshot_name(snapshot)
+        })
+    return list(instances.values())
+
+
+def planned_volumes(instances):
+    """
+    Return the SnapshotItems of the instances of a plan (the inverse of plan_instances)
+    """
+    snapshot_volumes = list()
+    for instance in instances:
+        for volume in instance['volumes']:
+            snapshot_volumes.append(SnapshotItem(
+                volume_id=volume['volume-id'],
+                instance_id=instance['instance-id'],
+                instance_name=instance['name'],
+                root_device=volume['root'],
+                tags=instance['tags'] + [{'Key': 'Name', 'Value': volume['snapshot-name']}],
+                state=instance['state'],
+                device_name=volume['device'],
+                owner_id=instance['owner-id'],
+                data_volumes=instance['data-volumes'],
+                stop_time=instance['stop-time']
+            ))
+    return snapshot_volumes
+
+
+class PlanTotals(RunTotals):
+    def __init__(self, instances=0, volumes=0, name=None):
+        """
+        Counters of the plan (success are the volumes planned) and the plan of each target
+        """
+        super(PlanTotals, self).__init__(instances=instances, volumes=volumes, name=name)
+        self.targets = list()
+        self.duplicates = list()
+        self.planned_instances = 0
+
+    def merge(self, other):
+        super(PlanTotals, self).merge(other)
+        with self.lock:
+            self.targets.extend(other.targets)
+            self.duplicates.extend(other.duplicates)
+            self.planned_instances += other.planned_instances
+
+    def to_dict(self):
+        return {
+            'result': self.status,
+            'instances': self.instances,
+            'volumes': self.volumes,
+            'planned-instances': self.planned_instances,
+            'skipped': len(self.skipped),
+            'duplicates': len(self.duplicates),
+        }
+
+    def summary(self):
+        msg_result = ''
+        msg_result += '[=] Total Instances          : {instances}\n'.format(instances=self.instances)
+        msg_result += '[=] Total volumes planned    : {total}\n'.format(total=self.volumes)
+        if self.skipped:
+            msg_result += '[=] Total volumes unchanged  : {skipped}\n'.format(skipped=len(self.skipped))
+        if self.duplicates:
+            msg_result += '[=] Multi-attached volumes   : {0}\n'.format(len(self.duplicates))
+        return msg_result
+
+
+def plan_region(options, region=None, role_arn=None, sessions=None):
+    """
+    Run the discovery and the name resolution of one region of one account
+    Return the PlanTotals of the region with its plan
+    """
+    sessions = sessions or default_sessions()
+    try:
+        limiter = RateLimiter(options['rate-limits'], metrics=options['metrics'])
+        client = throttled_client(sessions, 'ec2', limiter, region=region, role_arn=role_arn)
+        total_instances, snapshot_volumes, skipped = discover_volumes(client, options,
+                                                                      scope=target_key(role_arn, region))
+    except Exception:
+        click.echo('[!] Unable to get instances info{account}{region}. Check your permissions or connectivity'.format(
+            account=' of account {0}'.format(account_id(role_arn)) if role_arn else '',
+            region=' of region {0}'.format(region) if region else '')
+        )
+        if options['verbose']:
+            click.echo('Error {error}'.format(error=traceback.format_exc()))
+        totals = PlanTotals(name=region)
+        totals.fault = True
+        totals.add_error(traceback.format_exc())
+        return totals
+
+    snapshot_volumes, duplicates = dedupe_volumes(snapshot_volumes)
+    for item in duplicates:
+        click.echo('[=] Multi-attached Volume-id : {0} - Snapshot once for the instances : {1}'.format(
+            item['volume-id'], ', '.join(item['instance-ids']))
+        )
+
+    instances = plan_instances(snapshot_volumes)
+    totals = PlanTotals(instances=total_instances, volumes=len(snapshot_volumes), name=region)
+    totals.add_success(len(snapshot_volumes))
+    totals.skipped = skipped
+    totals.duplicates = duplicates
+    totals.planned_instances = len(instances)
+    totals.targets.append({
+        'account': role_arn,
+        'region': region,
+        'total-instances': total_instances,
+        'instances': instances,
+        'skipped': skipped,
+        'duplicates': duplicates
+    })
+    totals.retries = limiter.retries
+    return totals
+
+
+def save_plan(path, data):
+    """
+    Write the plan as compact json (write and rename so a reader never sees a truncated plan)
+    """
+    temp = '{0}.tmp'.format(path)
+    with open(temp, 'w') as fp:
+        json.dump(data, fp, separators=(',', ':'))
+    os.rename(temp, path)
+
+
+def load_plan(path):
+    """
+    Read the plan of the file (or the plan itself given as a dict, ex: the shard of a worker)
+    """
+    if isinstance(path, dict):
+        data = path
+    else:
+        with open(path) as fp:
+            data = json.load(fp)
+    if data.get('version') != PLAN_VERSION:
+        raise ValueError('Unsupported plan version {0}'.format(data.get('version')))
+    return data
+
+
+def build_plan(options, event, sessions=None):
+    """
+    Run the discovery and the name resolution of all the targets
+    Return (totals, accounts, plan) with plan None if no target could be processed
+    """
+    totals, accounts = run_targets(options, plan_region, totals_class=PlanTotals, sessions=sessions)
+    if all(part.fault for account in accounts.values() for part in account.parts):
+        return totals, accounts, None
+
+    data = {
+        'version': PLAN_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'date': datetime.datetime.today().strftime('%Y%m%d'),
+        'event': dict((key, event[key]) for key in PLAN_KEYS if key in event),
+        'volumes': totals.volumes,
+        'expected-calls': expected_calls(totals.planned_instances, totals.volumes, options),
+        'targets': totals.targets,
+    }
+    return totals, accounts, data
+
+
+def plan(verbose=VERBOSE, start_time=time.time(), program='', event=None, context=None, sessions=None):
+    """
+    Run the discovery and the name resolution and write the plan to the file of the event key plan
+    The plan is processed later by execute without discovery
+    """
+    event = event or {}
+    options = parse_event(event, verbose=verbose, program=program)
+    if options['invalid']:
+        return {'result': FAULT}
+    path = event.get('plan')
+    if not path:
+        click.echo('[!] Unable to process. You need to give the file of the plan')
+        return {'result': FAULT}
+
+    totals, accounts, data = build_plan(options, event, sessions=sessions)
+    if data is None:
+        return {'result': FAULT}
+
+    calls = data['expected-calls']
+    try:
+        save_plan(path, data)
+    except Exception:
+        click.echo('[!] Unable to write the plan {0}'.format(path))
+        if options['verbose']:
+            click.echo('[!] {0}'.format(traceback.format_exc()))
+        return {'result': FAULT}
+
+    msg_result = totals.summary() + targets_summary(accounts)
+    msg_result += '[=] Expected API calls       : {calls}\n'.format(
+        calls=', '.join('{0}={1}'.format(operation, count) for operation, count in sorted(calls.items()))
+    )
+    click.echo(msg_result)
+    click.echo('[+] Plan written to : {0}'.format(path))
+
+    result = targets_result(accounts, totals.to_dict())
+    result['plan'] = path
+    result['expected-calls'] = calls
+    result['metrics'] = options['metrics'].to_dict()
+    return result
+
+
+def execute(verbose=VERBOSE, start_time=time.time(), program='', event=None, context=None, sessions=None):
+    """
+    Create the snapshots of the plan given by the event key plan (file or dict) without discovery
+    The job (filters, accounts, regions, stop, stopped, label...) is the one of the plan,
+    the other keys of the event (concurrency, rate-limits, sns-arn, report...) apply to the execution
+    """
+    event = dict(event or {})
+    path = event.get('plan')
+    # A plan given inline is not repeated in the output and the result
+    name = 'inline' if isinstance(path, dict) else path
+    try:
+        data = load_plan(path)
+    except Exception:
+        click.echo('[!] Unable to process. Unable to read the plan {0}'.format(name))
+        if verbose:
+            click.echo('[!] {0}'.format(traceback.format_exc()))
+        return {'result': FAULT}
+
+    for key in PLAN_KEYS:
+        event.pop(key, None)
+    event.update(data['event'])
+
+    if data['date'] != datetime.datetime.today().strftime('%Y%m%d'):
+        click.echo('[!] The plan was created on {0}. The snapshot names are resolved for today'.format(
+            data['date']))
+    click.echo('[+] Executing the plan : {0} - {1} volumes'.format(name, data['volumes']))
+
+    planned = dict()
+    for target in data['targets']:
+        planned[target_key(target['account'], target['region'])] = (
+            target['total-instances'],
+            planned_volumes(target['instances']),
+            target['skipped']
+        )
+
+    result = s3snapshot(verbose=verbose, start_time=start_time, program=program, event=event, context=context,
+                        sessions=sessions, planned=planned)
+    result['plan'] = name
+    return result
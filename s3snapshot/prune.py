@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+#
+# prune.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Retention of the snapshots created by the script"""
+
+from __future__ import print_function
+
+import datetime
+import re
+import time
+import traceback
+
+import click
+
+from .accounts import default_sessions
+from .accounts import account_id
+from .drcopy import COPY_VOLUME_ID
+from .drcopy import SOURCE_VOLUME_TAG
+from .journal import target_key
+from .ratelimit import RateLimiter
+from .ratelimit import throttled_client
+from .report import result_record
+from .s3snapshot import FAULT
+from .s3snapshot import PAGE_SIZE
+from .s3snapshot import VERBOSE
+from .s3snapshot import RunTotals
+from .s3snapshot import emit_metrics
+from .s3snapshot import iter_volume_snapshots
+from .s3snapshot import notify
+from .s3snapshot import open_report
+from .s3snapshot import parse_event
+from .s3snapshot import run_parallel
+from .s3snapshot import run_targets
+from .s3snapshot import select_volumes
+from .s3snapshot import targets_result
+from .s3snapshot import targets_summary
+
+KEEP_LAST = 0
+KEEP_DAILY = 0
+KEEP_WEEKLY = 0
+KEEP_MONTHLY = 0
+DRY_RUN = False
+# Keys of the snapshot runs that can't scope the retention (the prune is refused instead of ignoring them)
+UNSUPPORTED_KEYS = ('skip-unchanged',)
+# Name of the snapshots: s<YYYYMMDD><letter>-<name>-<device>
+NAME_PATTERN = re.compile(r'^s(\d{8})([A-Za-z])-')
+
+
+def parse_name(name):
+    """
+    Return (date, rank) of the snapshot name or None if the name was not created by the script
+    The rank follows the letters given by increment_string (a..z then A..Z)
+    """
+    match = NAME_PATTERN.match(name or '')
+    if not match:
+        return None
+    try:
+        date = datetime.datetime.strptime(match.group(1), '%Y%m%d').date()
+    except ValueError:
+        return None
+    letter = match.group(2)
+    if letter.islower():
+        rank = ord(letter) - ord('a')
+    else:
+        rank = 26 + ord(letter) - ord('A')
+    return date, rank
+
+
+class RetentionPolicy(object):
+    def __init__(self, keep_last=KEEP_LAST, daily=KEEP_DAILY, weekly=KEEP_WEEKLY, monthly=KEEP_MONTHLY):
+        """
+        Keep the last N snapshots plus the newest snapshot of the last days, weeks and months (GFS)
+        """
+        self.keep_last = keep_last
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+
+    def __bool__(self):
+        return bool(self.keep_last or self.daily or self.weekly or self.monthly)
+
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        return 'last={0} daily={1} weekly={2} monthly={3}'.format(
+            self.keep_last, self.daily, self.weekly, self.monthly
+        )
+
+    def keep(self, snapshots):
+        """
+        Return the set of snapshot ids to keep
+        snapshots is the list of snapshots of one volume sorted from the newest to the oldest
+        """
+        keep = set(snapshot['id'] for snapshot in snapshots[:self.keep_last])
+        periods = (
+            (self.daily, lambda date: date),
+            (self.weekly, lambda date: date.isocalendar()[:2]),
+            (self.monthly, lambda date: (date.year, date.month)),
+        )
+        for count, period in periods:
+            seen = set()
+            for snapshot in snapshots:
+                key = period(snapshot['date'])
+                if key in seen:
+                    continue
+                if len(seen) >= count:
+                    break
+                seen.add(key)
+                keep.add(snapshot['id'])
+        return keep
+
+
+class PruneTotals(RunTotals):
+    unit = 'snapshots'
+
+    def __init__(self, instances=0, volumes=0, name=None):
+        """
+        Counters of the prune run (volumes are the snapshots to delete, success the ones deleted)
+        With dry-run nothing is deleted and the snapshots that would be deleted are the candidates
+        """
+        super(PruneTotals, self).__init__(instances=instances, volumes=volumes, name=name)
+        self.scanned = 0
+        self.kept = 0
+        self.protected = 0
+        self.candidates = list()
+
+    def merge(self, other):
+        super(PruneTotals, self).merge(other)
+        with self.lock:
+            self.scanned += other.scanned
+            self.kept += other.kept
+            self.protected += other.protected
+            self.candidates.extend(other.candidates)
+
+    def to_dict(self):
+        return {
+            'result': self.status,
+            'volumes': self.instances,
+            'scanned': self.scanned,
+            'kept': self.kept,
+            'protected': self.protected,
+            'to-delete': self.volumes,
+            'deleted': self.success,
+            'candidates': len(self.candidates),
+            'failures': self.failures,
+            'throttling-retries': self.retries,
+        }
+
+    def summary(self):
+        msg_result = ''
+        msg_result += '[=] Total volumes            : {volumes}\n'.format(volumes=self.instances)
+        msg_result += '[=] Total snapshots scanned  : {scanned}\n'.format(scanned=self.scanned)
+        msg_result += '[=] Total snapshots kept     : {kept}\n'.format(kept=self.kept)
+        msg_result += '[=] Total snapshots protected: {protected}\n'.format(protected=self.protected)
+        msg_result += '[=] Total snapshots to delete: {total}\n'.format(total=self.volumes)
+        msg_result += '[=] Total snapshots deleted  : {success}\n'.format(success=self.success)
+        if self.candidates:
+            msg_result += '[=] Snapshots to delete (dry): {count}\n'.format(count=len(self.candidates))
+        msg_result += '[=] Total snapshots failed   : {failed}\n'.format(failed=self.failures)
+        msg_result += '[=] Throttling retries       : {retries}\n'.format(retries=self.retries)
+        return msg_result
+
+
+def iter_scripted_snapshots(client, filter_list=None, page_size=PAGE_SIZE):
+    """
+    Yield the snapshots of the account tagged Scripted=True (paginated and filtered by the owner)
+    """
+    paginator = client.get_paginator('describe_snapshots')
+    pages = paginator.paginate(
+        OwnerIds=['self'],
+        Filters=[{'Name': 'tag:Scripted', 'Values': ['True']}] + (filter_list or []),
+        PaginationConfig={'PageSize': page_size}
+    )
+    for page in pages:
+        for snapshot in page.get('Snapshots', []):
+            yield snapshot
+
+
+def prune_region(options, region=None, role_arn=None, sessions=None):
+    """
+    Compute the snapshots to delete of one region of one account and delete them
+    Return the PruneTotals of the region
+    """
+    sessions = sessions or default_sessions()
+    policy = options['retention']
+    metrics = options['metrics']
+    totals = PruneTotals(name=region)
+    by_volume = dict()
+    start = time.time()
+
+    try:
+        limiter = RateLimiter(options['rate-limits'], metrics=metrics)
+        client = throttled_client(sessions, 'ec2', limiter, region=region, role_arn=role_arn)
+
+        if options['scoped']:
+            # Only the snapshots of the volumes of the selection (the names of the snapshots don't carry
+            # the instance tags, so the selection is resolved to volume ids first)
+            _, snapshot_volumes = select_volumes(client, options, scope=target_key(role_arn, region))
+            click.echo('[+] Volumes of the selection : {0}'.format(len(snapshot_volumes)))
+            snapshots = iter_volume_snapshots(
+                client, [(snapshot.owner_id, snapshot.volume_id) for snapshot in snapshot_volumes],
+                [{'Name': 'tag:Scripted', 'Values': ['True']}], page_size=options['page-size'])
+        else:
+            snapshots = iter_scripted_snapshots(client, page_size=options['page-size'])
+
+        for snapshot in snapshots:
+            tags = dict((tag['Key'], tag['Value']) for tag in snapshot.get('Tags', []))
+            parsed = parse_name(tags.get('Name'))
+            if not parsed:
+                continue
+            # The DR copies are grouped by the volume of their source (copies without the tag are left out)
+            volume_id = snapshot.get('VolumeId')
+            if volume_id == COPY_VOLUME_ID:
+                volume_id = tags.get(SOURCE_VOLUME_TAG)
+                if not volume_id:
+                    continue
+            totals.scanned += 1
+            by_volume.setdefault(volume_id, []).append({
+                'id': snapshot['SnapshotId'],
+                'volume-id': volume_id,
+                'name': tags.get('Name'),
+                'date': parsed[0],
+                'rank': parsed[1],
+                'protected': tags.get('State:Protected', '').endswith(':True')
+            })
+
+    except Exception:
+        click.echo('[!] Unable to get snapshots info{account}{region}. Check your permissions or connectivity'.format(
+            account=' of account {0}'.format(account_id(role_arn)) if role_arn else '',
+            region=' of region {0}'.format(region) if region else '')
+        )
+        if options['verbose']:
+            click.echo('Error {error}'.format(error=traceback.format_exc()))
+        totals.fault = True
+        totals.add_error(traceback.format_exc())
+        return totals
+    metrics.add_phase('discovery', time.time() - start)
+
+    deletions = list()
+    for volume_id, snapshots in by_volume.items():
+        snapshots.sort(key=lambda snapshot: (snapshot['date'], snapshot['rank']), reverse=True)
+        keep = policy.keep(snapshots)
+        for snapshot in snapshots:
+            if snapshot['id'] in keep:
+                totals.kept += 1
+            elif snapshot['protected']:
+                totals.protected += 1
+            else:
+                deletions.append(snapshot)
+
+    totals.instances = len(by_volume)
+
+    if options['dry-run']:
+        # Nothing is deleted: the snapshots are only reported as candidates
+        for snapshot in deletions:
+            click.echo('[~] Dry run. Snapshot to delete : {id} - {name}'.format(**snapshot))
+        totals.candidates = [{'snapshot-id': snapshot['id'], 'name': snapshot['name']} for snapshot in deletions]
+        totals.retries = limiter.retries
+        return totals
+
+    totals.volumes = len(deletions)
+
+    def delete(snapshot):
+        fields = {'account': account_id(role_arn), 'region': region, 'snapshot-id': snapshot['id'],
+                  'volume-id': snapshot['volume-id'], 'name': snapshot['name']}
+        try:
+            with metrics.phase('delete'):
+                client.delete_snapshot(SnapshotId=snapshot['id'])
+            click.echo('[-] Snapshot deleted : {id} - {name}'.format(**snapshot))
+            totals.add_success()
+            options['report'].write(result_record('deleted', **fields))
+        except Exception:
+            click.echo('[!] Unable to delete Snapshot : {id} - {name}'.format(**snapshot))
+            totals.add_failure(traceback.format_exc())
+            options['report'].write(result_record('failure', traceback.format_exc(), **fields))
+
+    run_parallel(delete, deletions, options['concurrency'])
+    totals.retries = limiter.retries
+    return totals
+
+
+def prune(verbose=VERBOSE, start_time=time.time(), program='', event=None, context=None, sessions=None):
+    """
+    Delete the snapshots created by the script that are not retained by the policy
+    The event accepts the same keys of s3snapshot plus:
+    keep-last, keep-daily, keep-weekly, keep-monthly: int
+    dry-run: bool (only list the snapshots that would be deleted)
+    """
+    options = parse_event(event, verbose=verbose, program=program)
+    if options['invalid']:
+        return {'result': FAULT}
+    event = event or {}
+    options['retention'] = RetentionPolicy(
+        keep_last=int(event.get('keep-last', KEEP_LAST)),
+        daily=int(event.get('keep-daily', KEEP_DAILY)),
+        weekly=int(event.get('keep-weekly', KEEP_WEEKLY)),
+        monthly=int(event.get('keep-monthly', KEEP_MONTHLY))
+    )
+    options['dry-run'] = event.get('dry-run', DRY_RUN)
+
+    if not options['retention']:
+        # Without a policy everything would be deleted
+        click.echo('[!] Unable to process. You need to choose at least one retention policy')
+        return {'result': FAULT}
+
+    unsupported = [key for key in UNSUPPORTED_KEYS if event.get(key)]
+    if unsupported:
+        click.echo('[!] Unable to process. The prune can not be scoped by {0}'.format(', '.join(unsupported)))
+        return {'result': FAULT}
+
+    # Any criteria of the selection limits the prune to the snapshots of the volumes selected
+    selection = options['selection']
+    options['scoped'] = bool(options['filters'] or selection.negated_tags or selection.selects_volumes or
+                             options['exclude-root'])
+
+    click.echo('[+] The retention policy is  : {0}'.format(options['retention']))
+    click.echo('[+] The dry-run parameter is : {0}'.format(options['dry-run']))
+
+    open_report(options)
+
+    totals, accounts = run_targets(options, prune_region, totals_class=PruneTotals, sessions=sessions)
+    options['report'].close()
+    if all(part.fault for account in accounts.values() for part in account.parts):
+        return {'result': FAULT}
+
+    msg_result = totals.summary() + targets_summary(accounts)
+    click.echo(msg_result)
+
+    result = targets_result(accounts, totals.to_dict())
+    if options['dry-run']:
+        result['dry-run'] = totals.candidates
+        result['metrics'] = options['metrics'].to_dict()
+        result['errors'] = totals.errors.to_dict()
+        return result
+
+    with options['metrics'].phase('notify'):
+        notify(options, totals, msg_result, start_time, event=event, context=context, job='prune', sessions=sessions)
+    emit_metrics(options, context)
+    result['metrics'] = options['metrics'].to_dict()
+    result['errors'] = totals.errors.to_dict()
+    return result
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#
+# ratelimit.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Client side rate limiter for the EC2 API calls"""
+
+from __future__ import print_function
+
+import random
+import threading
+import time
+
+import click
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as EndpointError
+
+from .metrics import error_code
+
+# Initial and maximum rate (calls per second) of each API family
+RATES = {
+    'describe': 20.0,
+    'create-snapshot': 5.0,
+    'tagging': 10.0,
+    'instance-state': 5.0,
+    'delete-snapshot': 5.0,
+    'other': 10.0,
+}
+MAX_RATES = {
+    'describe': 100.0,
+    'create-snapshot': 50.0,
+    'tagging': 50.0,
+    'instance-state': 20.0,
+    'delete-snapshot': 20.0,
+    'other': 50.0,
+}
+MIN_RATE = 0.5
+RAMP_UP = 0.1
+BACK_OFF = 0.5
+MAX_ATTEMPTS = 8
+BASE_DELAY = 0.2
+MAX_DELAY = 20.0
+THROTTLING_ERRORS = (
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'SnapshotCreationPerVolumeRateExceeded',
+)
+# Server errors retried by the limiter with the connection errors and timeouts (the rate is not cut)
+TRANSIENT_ERRORS = (
+    'InternalError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'Unavailable',
+    'RequestTimeout',
+    'RequestTimeoutException',
+)
+# Settings of the clients wrapped by ThrottledClient: the limiter is the only layer that retries,
+# so it sees every throttling error (back off of the rates and metrics)
+THROTTLED_CLIENT_CONFIG = {
+    'retry-mode': 'legacy',
+    'max-attempts': 1,
+}
+FAMILIES = {
+    'copy_snapshot': 'create-snapshot',
+    'create_snapshot': 'create-snapshot',
+    'create_snapshots': 'create-snapshot',
+    'create_tags': 'tagging',
+    'delete_tags': 'tagging',
+    'delete_snapshot': 'delete-snapshot',
+    'start_instances': 'instance-state',
+    'stop_instances': 'instance-state',
+}
+
+
+def api_family(operation):
+    """
+    Return the API family of the client method (ex: describe_snapshots -> describe)
+    """
+    if operation.startswith('describe_'):
+        return 'describe'
+    return FAMILIES.get(operation, 'other')
+
+
+def is_throttling(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+
+
+def is_transient(error):
+    """
+    Server errors and connection errors / timeouts of the HTTP client
+    """
+    if isinstance(error, (EndpointError, HTTPClientError)):
+        return True
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in TRANSIENT_ERRORS
+
+
+class TokenBucket(object):
+    def __init__(self, rate, max_rate=None, min_rate=MIN_RATE):
+        """
+        Token bucket that refill rate tokens per second
+        The rate ramps up while the calls succeed and is cut on throttling
+        """
+        self.rate = float(rate)
+        self.max_rate = float(max_rate or rate)
+        self.min_rate = min(min_rate, self.rate)
+        self.tokens = 1.0
+        self.last = time.time()
+        self.last_throttle = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block till there is a token available
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + RAMP_UP)
+
+    def throttled(self):
+        with self.lock:
+            # Calls already in flight when the rate was cut don't cut it again
+            now = time.time()
+            if now - self.last_throttle >= 1.0 / self.rate:
+                self.rate = max(self.min_rate, self.rate * BACK_OFF)
+            self.last_throttle = now
+            self.tokens = 0.0
+
+
+class RateLimiter(object):
+    def __init__(self, rates=None, max_attempts=MAX_ATTEMPTS, metrics=None):
+        """
+        Shared token buckets per API family (describe / create-snapshot / tagging / instance-state)
+        rates is a dict family -> initial rate to tune the limits per account
+        metrics (optional) records every attempt of the calls
+        """
+        rates = rates or {}
+        self.buckets = dict()
+        for family, rate in RATES.items():
+            rate = float(rates.get(family, rate))
+            self.buckets[family] = TokenBucket(rate, max_rate=max(rate, MAX_RATES[family]))
+        self.max_attempts = max_attempts
+        self.metrics = metrics
+        self.retries = 0
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def call(self, family, function, *args, **kwargs):
+        """
+        Call the function when the bucket of the family allows it
+        A throttled call (or a transient server error) is retried with exponential back off and jitter
+        """
+        bucket = self.buckets.get(family, self.buckets['other'])
+        operation = getattr(function, '__name__', family)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            start = time.time()
+            try:
+                response = function(*args, **kwargs)
+            except (ClientError, EndpointError, HTTPClientError) as e:
+                if self.metrics:
+                    self.metrics.record(operation, time.time() - start, error=error_code(e), throttled=is_throttling(e))
+                throttled = is_throttling(e)
+                if not throttled and not is_transient(e):
+                    raise
+                attempt += 1
+                if throttled:
+                    bucket.throttled()
+                    with self.lock:
+                        self.throttles += 1
+                if attempt >= self.max_attempts:
+                    raise
+                with self.lock:
+                    self.retries += 1
+                if self.metrics:
+                    self.metrics.retry(operation)
+                delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+                click.echo('[!] {error} on {family}. Retrying in {delay:.2f} seconds'.format(
+                    error='Throttled' if throttled else error_code(e), family=family, delay=delay)
+                )
+                time.sleep(delay)
+                continue
+            except Exception as e:
+                if self.metrics:
+                    self.metrics.record(operation, time.time() - start, error=error_code(e))
+                raise
+
+            if self.metrics:
+                self.metrics.record(operation, time.time() - start)
+            bucket.success()
+            return response
+
+    def rates(self):
+        """
+        Current rate (calls per second) of each API family
+        """
+        return dict((family, round(bucket.rate, 2)) for family, bucket in self.buckets.items())
+
+
+class ThrottledPaginator(object):
+    def __init__(self, client, operation):
+        """
+        Paginate a describe operation (NextToken/MaxResults) calling the throttled client
+        """
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        config = PaginationConfig or {}
+        if config.get('PageSize'):
+            kwargs['MaxResults'] = config['PageSize']
+
+        method = getattr(self.client, self.operation)
+        while True:
+            page = method(**kwargs)
+            yield page
+            if not page.get('NextToken'):
+                return
+            kwargs['NextToken'] = page['NextToken']
+
+
+def throttled_client(sessions, service, limiter, region=None, role_arn=None):
+    """
+    Return the client of the sessions wrapped by the rate limiter (the client itself doesn't retry)
+    """
+    return ThrottledClient(sessions.client(service, region=region, role_arn=role_arn,
+                                           config=THROTTLED_CLIENT_CONFIG), limiter)
+
+
+class ThrottledClient(object):
+    def __init__(self, client, limiter):
+        """
+        Wrap a boto3 client so every API call goes through the rate limiter
+        """
+        self.client = client
+        self.limiter = limiter
+
+    def get_paginator(self, operation):
+        return ThrottledPaginator(self, operation)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith('_') or name in ('get_waiter', 'can_paginate') or not callable(attr):
+            return attr
+
+        family = api_family(name)
+
+        def call(*args, **kwargs):
+            return self.limiter.call(family, attr, *args, **kwargs)
+        return call
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# report.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Per-volume result lines and bounded summary of the errors of the run"""
+
+from __future__ import print_function
+
+import io
+import json
+import re
+import threading
+import time
+
+import click
+
+# Groups of errors kept (the other errors are counted in OTHER) and exemplars kept per group
+MAX_GROUPS = 20
+EXEMPLARS = 2
+# Characters kept of each exemplar (the end of the tracebacks) and of the error of a result line
+EXEMPLAR_SIZE = 1500
+LINE_SIZE = 300
+OTHER = 'Other'
+STDOUT = ('-', 'stdout')
+CLIENT_ERROR_PATTERN = re.compile(r'An error occurred \(([\w.]+)\)')
+EXCEPTION_PATTERN = re.compile(r'^([\w.]+(?:Error|Exception|Exceeded|Timeout)\w*)(?::|$)')
+# Ids of the resources replaced in the messages so the same message of many resources is one group
+RESOURCE_PATTERN = re.compile(r'\b(i|vol|snap)-[0-9a-f]+\b')
+
+
+def last_line(error):
+    """
+    Return the last non-empty line of the error (the exception of a traceback)
+    """
+    lines = [line.strip() for line in (error or '').splitlines() if line.strip()]
+    return lines[-1] if lines else ''
+
+
+def message_code(error):
+    """
+    Group of the error message: the code of the ClientError, the exception class of a traceback
+    or the message with the resource ids replaced by <id>
+    """
+    line = last_line(error)
+    match = CLIENT_ERROR_PATTERN.search(line)
+    if match:
+        return match.group(1)
+    match = EXCEPTION_PATTERN.match(line)
+    if match:
+        return match.group(1).split('.')[-1]
+    return RESOURCE_PATTERN.sub(lambda match: '{0}-<id>'.format(match.group(1)), line)[:LINE_SIZE]
+
+
+class ErrorSummary(object):
+    def __init__(self, max_groups=MAX_GROUPS, exemplars=EXEMPLARS, exemplar_size=EXEMPLAR_SIZE):
+        """
+        Thread safe count of the errors by error code with a few exemplars of each code
+        The size is bounded whatever the number of errors
+        """
+        self.max_groups = max_groups
+        self.exemplars = exemplars
+        self.exemplar_size = exemplar_size
+        self.groups = dict()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, error, count=1):
+        self._add(message_code(error), count, [error[-self.exemplar_size:]] if error else [])
+
+    def _add(self, code, count, exemplars):
+        with self.lock:
+            if code not in self.groups and len(self.groups) >= self.max_groups:
+                code = OTHER
+            group = self.groups.setdefault(code, {'count': 0, 'exemplars': []})
+            group['count'] += count
+            for exemplar in exemplars:
+                if len(group['exemplars']) < self.exemplars:
+                    group['exemplars'].append(exemplar)
+            self.count += count
+
+    def merge(self, other):
+        self.update(other.to_dict())
+
+    def update(self, groups):
+        """
+        Add the groups of a summary given as a dict (ex: the errors of the result of a worker)
+        """
+        for code, group in groups.items():
+            self._add(code, group['count'], group['exemplars'])
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    __nonzero__ = __bool__
+
+    def to_dict(self):
+        with self.lock:
+            return dict((code, {'count': group['count'], 'exemplars': list(group['exemplars'])})
+                        for code, group in self.groups.items())
+
+    def summary(self):
+        """
+        Text with the count of each error code (the most frequent first) and its exemplars
+        """
+        msg = ''
+        for code, group in sorted(self.to_dict().items(), key=lambda item: (-item[1]['count'], item[0])):
+            msg += '\nerror: {code} ({count})\n'.format(code=code, count=group['count'])
+            for exemplar in group['exemplars']:
+                msg += '{0}\n'.format(exemplar)
+        return msg
+
+
+def result_record(status, error=None, **fields):
+    """
+    Result line with the status, the fields given and the code and last line of the error
+    """
+    record = dict(fields, time=round(time.time(), 3), status=status)
+    if error:
+        record['error-code'] = message_code(error)
+        record['error'] = last_line(error)[:LINE_SIZE]
+    return record
+
+
+def volume_record(snapshot, status, error=None, account=None, region=None):
+    """
+    Result line of one volume (status is success, failure, deferred or skipped)
+    """
+    return result_record(status, error, **{
+        'account': account,
+        'region': region,
+        'instance-id': snapshot.instance_id,
+        'volume-id': snapshot.volume_id,
+        'device': snapshot.device_name,
+        'snapshot-id': snapshot.snapshot_id,
+    })
+
+
+class ResultSink(object):
+    def __init__(self, path=None):
+        """
+        Write each result as a json line to the file of path, to stdout (path - or stdout)
+        or nowhere (path None). The lines are written as soon as each volume is processed
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.lines = 0
+        self.fp = None
+        if path and path not in STDOUT:
+            self.fp = io.open(path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        if not self.path:
+            return
+        line = json.dumps(record, sort_keys=True, default=str)
+        with self.lock:
+            self.lines += 1
+            if self.fp:
+                self.fp.write(u'{0}\n'.format(line))
+                self.fp.flush()
+            else:
+                click.echo(line)
+
+    def close(self):
+        with self.lock:
+            if self.fp:
+                self.fp.close()
+                self.fp = None
@@ -10,15 +10,42 @@
 
 from __future__ import print_function
 
+import calendar
 import datetime
 import json
+import re
+import threading
 import time
 import traceback
+from collections import OrderedDict
 
-import boto3
-import botocore
 import click
 from botocore.exceptions import ClientError
+from botocore.exceptions import ParamValidationError
+
+from .accounts import default_sessions
+from .accounts import account_id
+from .cache import CACHE_TTL
+from .cache import InventoryCache
+from .drcopy import COPY_CONCURRENCY
+from .drcopy import COPY_TIMEOUT
+from .drcopy import CopyScheduler
+from .drcopy import CopySlots
+from .drcopy import copy_report
+from .filters import compile_selection
+from .hooks import freeze_hooks
+from .hooks import hooks_report
+from .journal import MARGIN
+from .journal import Deadline
+from .journal import Journal
+from .journal import journal_store
+from .journal import target_key
+from .metrics import Metrics
+from .ratelimit import RateLimiter
+from .ratelimit import throttled_client
+from .report import ErrorSummary
+from .report import ResultSink
+from .report import volume_record
 
 # Constant strings for Default Values (Change if you need to run diferently)
 SUCCESS = 'Successful'
@@ -31,11 +58,35 @@ SNS_ARN = 'arn:aws:sns:us-east-1:109881088269:SAP-Backup'
 SNS_ARN_ERROR = 'arn:aws:sns:us-east-1:109881088269:SAP-Backup'
 PROTECTED = False
 VERBOSE = False
-SLEEP_TIME = 0.1
+PAGE_SIZE = 1000
+FILTER_CHUNK = 200
+# Maximum page size of DescribeVolumes
+VOLUME_PAGE_SIZE = 500
+TAG_BATCH = 500
+CONCURRENCY = 1
+MULTI_VOLUME = False
+EXCLUDE_ROOT = False
+STATE_BATCH = 100
+STOP_DELAY = 5
+STOP_TIMEOUT = 600
+# Instances still stopping when the time budget is over (run_stop_orchestration)
+DEFERRED = object()
+TARGET_CONCURRENCY = 20
+SKIP_UNCHANGED = False
+MIN_INTERVAL = 3600
+TRACK_COMPLETION = False
+# Polls of the snapshots state: first delay, growth of the delay, maximum delay and timeout (seconds)
+COMPLETION_DELAY = 5
+COMPLETION_BACKOFF = 1.5
+COMPLETION_MAX_DELAY = 60
+COMPLETION_TIMEOUT = 600
+# StateTransitionReason of the stopped instances ex: User initiated (2016-11-14 10:20:30 GMT)
+STOP_TIME_PATTERN = re.compile(r'\((\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) GMT\)')
 
 
 class SnapshotItem(object):
-    def __init__(self, volume_id, instance_id, instance_name, root_device, tags, state, device_name):
+    def __init__(self, volume_id, instance_id, instance_name, root_device, tags, state, device_name,
+                 owner_id=None, data_volumes=None, stop_time=None, snapshot_id=None):
         self.volume_id = volume_id
         self.instance_id = instance_id
         self.instance_name = instance_name
@@ -43,6 +94,13 @@ class SnapshotItem(object):
         self.tags = tags
         self.state = state
         self.device_name = device_name
+        self.owner_id = owner_id
+        # All the non root EBS volumes attached to the instance (used by the multi-volume snapshots)
+        self.data_volumes = data_volumes or []
+        # Time (epoch) the instance was stopped if it is stopped
+        self.stop_time = stop_time
+        # Id of the snapshot created by the run
+        self.snapshot_id = snapshot_id
 
 
 class SnapshotName(object):
@@ -106,6 +164,509 @@ class SnapshotName(object):
             )
 
 
+class SnapshotNameResolver(object):
+    def __init__(self, client, date, page_size=PAGE_SIZE, chunk_size=FILTER_CHUNK, cache=None, scope=None):
+        """
+        Keep one in-memory index per run with the highest snapshot name of each volume
+        The index is (volume_id, date) -> highest prefix (ex: s20161114c)
+        With an InventoryCache the names of the scope (account/region) still cached are not fetched
+        """
+        self.client = client
+        self.date = date
+        self.page_size = page_size
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.scope = scope
+        self.snapshot_query = 's{date}*'.format(date=date)
+        self.index = dict()
+        self.loaded = set()
+
+    def load(self, volumes):
+        """
+        Fetch today's snapshots of all the volumes with a few paginated calls
+        volumes is a list of (owner_id, volume_id). The volume-id filter receive
+        chunk_size values per call instead of one call per volume
+        """
+        volumes = [(owner_id, volume_id) for owner_id, volume_id in volumes if volume_id not in self.loaded]
+        if self.cache:
+            cached = self.cache.get_names(self.scope, self.date, [volume_id for owner_id, volume_id in volumes])
+            for volume_id, prefix in cached.items():
+                if prefix:
+                    self.record(volume_id, prefix)
+            self.loaded.update(cached)
+            volumes = [(owner_id, volume_id) for owner_id, volume_id in volumes if volume_id not in cached]
+
+        snapshots = iter_volume_snapshots(
+            self.client,
+            volumes,
+            [{'Name': 'tag:Name', 'Values': [self.snapshot_query]}],
+            page_size=self.page_size,
+            chunk_size=self.chunk_size
+        )
+        for snapshot in snapshots:
+            for tag in snapshot.get('Tags', []):
+                if tag['Key'] == 'Name':
+                    self.record(snapshot['VolumeId'], tag['Value'].split('-')[0])
+        self.loaded.update(volume_id for owner_id, volume_id in volumes)
+
+        if self.cache:
+            self.cache.put_names(self.scope, self.date, dict(
+                (volume_id, self.index.get((volume_id, self.date))) for owner_id, volume_id in volumes
+            ))
+
+    def record(self, volume_id, prefix):
+        """
+        Keep the highest prefix of the volume (Same order of the sorted list used by SnapshotName)
+        """
+        key = (volume_id, self.date)
+        if key not in self.index or prefix > self.index[key]:
+            self.index[key] = prefix
+
+    def __call__(self, name, device, volume_id):
+        """
+        Return the next snapshot name of the volume from the index
+        If there is no snapshot today the first letter is 'a' otherwise is the next subsequent letter
+        The name returned is recorded so the next call for the same volume get the following letter
+        """
+        last = self.index.get((volume_id, self.date))
+        if last:
+            prefix = increment_string(last)
+        else:
+            prefix = 's{date}a'.format(date=self.date)
+
+        self.record(volume_id, prefix)
+        return '{prefix}-{name}-{device}'.format(
+            prefix=prefix,
+            name=name,
+            device=device
+        )
+
+
+class LatestSnapshots(object):
+    def __init__(self, client, page_size=PAGE_SIZE, chunk_size=FILTER_CHUNK):
+        """
+        Index volume_id -> (start time epoch, snapshot id) of the latest snapshot created by the script
+        """
+        self.client = client
+        self.page_size = page_size
+        self.chunk_size = chunk_size
+        self.index = dict()
+
+    def load(self, volumes):
+        """
+        Fetch the Scripted snapshots of all the volumes with a few paginated calls
+        volumes is a list of (owner_id, volume_id)
+        """
+        snapshots = iter_volume_snapshots(
+            self.client,
+            volumes,
+            [{'Name': 'tag:Scripted', 'Values': ['True']}],
+            page_size=self.page_size,
+            chunk_size=self.chunk_size
+        )
+        for snapshot in snapshots:
+            self.record(snapshot['VolumeId'], timestamp(snapshot['StartTime']), snapshot['SnapshotId'])
+
+    def record(self, volume_id, start_time, snapshot_id):
+        if volume_id not in self.index or start_time > self.index[volume_id][0]:
+            self.index[volume_id] = (start_time, snapshot_id)
+
+    def get(self, volume_id):
+        return self.index.get(volume_id, (None, None))
+
+
+class SnapshotTagger(object):
+    def __init__(self, client, batch_size=TAG_BATCH):
+        """
+        Apply the snapshot tags in the CreateSnapshot call (TagSpecifications)
+        If the API don't accept the TagSpecifications the tags are queued and written
+        later with CreateTags calls that cover many snapshots at once
+        """
+        self.client = client
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.inline = True
+        self.pending = dict()
+        self.calls = 0
+        self.baseline = 0
+
+    def create_snapshot(self, tags, **kwargs):
+        """
+        Run CreateSnapshot with the tags and return the response
+        """
+        if self.inline:
+            try:
+                response = self.client.create_snapshot(
+                    TagSpecifications=[{'ResourceType': 'snapshot', 'Tags': tags}],
+                    **kwargs
+                )
+                # Without TagSpecifications it would be one CreateTags per tag
+                with self.lock:
+                    self.baseline += len(tags)
+                return response
+            except ParamValidationError:
+                # The botocore installed don't know the TagSpecifications parameter
+                self.inline = False
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in ('InvalidParameter',
+                                                                     'InvalidParameterValue',
+                                                                     'UnknownParameter'):
+                    raise
+                self.inline = False
+            click.echo('[!] TagSpecifications not supported. Snapshot tags will be written in batches')
+
+        response = self.client.create_snapshot(**kwargs)
+        if response.get('SnapshotId'):
+            with self.lock:
+                self.baseline += len(tags)
+                self.pending[response['SnapshotId']] = tags
+        return response
+
+    def defer(self, snapshot_id, tags, applied=0):
+        """
+        Queue tags to be written by flush() for a snapshot that already received applied tags at creation
+        """
+        with self.lock:
+            self.baseline += len(tags) + applied
+            if tags:
+                self.pending.setdefault(snapshot_id, []).extend(tags)
+
+    def flush(self):
+        """
+        Write the queued tags with the minimum number of CreateTags calls
+        Snapshots that share the same tag receive it in the same call (up to batch_size ids)
+        Return the list of snapshot ids that failed to be tagged
+        """
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+
+        resources_by_tag = dict()
+        for snapshot_id, tags in pending.items():
+            for tag in tags:
+                resources_by_tag.setdefault((tag['Key'], tag['Value']), set()).add(snapshot_id)
+
+        # Tags applied to the very same group of snapshots are sent together
+        tags_by_resources = dict()
+        for tag, resources in resources_by_tag.items():
+            tags_by_resources.setdefault(frozenset(resources), []).append({'Key': tag[0], 'Value': tag[1]})
+
+        failed = set()
+        for resources, tags in tags_by_resources.items():
+            resources = sorted(resources)
+            for i in range(0, len(resources), self.batch_size):
+                chunk = resources[i:i + self.batch_size]
+                try:
+                    self.calls += 1
+                    self.client.create_tags(Resources=chunk, Tags=tags)
+                except Exception:
+                    click.echo('[!] Error creating Snapshot Tags: {error}'.format(error=traceback.format_exc()))
+                    failed.update(chunk)
+
+        return sorted(failed)
+
+    @property
+    def saved(self):
+        """
+        Number of CreateTags calls saved compared to one call per tag and per snapshot
+        """
+        return self.baseline - self.calls
+
+
+class RunTotals(object):
+    unit = 'volumes'
+
+    def __init__(self, instances=0, volumes=0, name=None):
+        """
+        Thread safe counters of the snapshot run (or of one part of the run, ex: a region)
+        """
+        self.lock = threading.Lock()
+        self.name = name
+        self.instances = instances
+        self.volumes = volumes
+        self.success = 0
+        self.failures = 0
+        # Errors grouped by error code (bounded whatever the number of failures)
+        self.errors = ErrorSummary()
+        self.snapshot_sets = list()
+        # True when the part could not be processed at all (ex: discovery failed)
+        self.fault = False
+        self.tag_calls_saved = 0
+        self.retries = 0
+        self.rates = dict()
+        # Volumes left for the next invocation when the time budget is over
+        self.deferred = 0
+        # Volumes not changed since their last snapshot (skip-unchanged)
+        self.skipped = list()
+        # State of the snapshots created (track-completion)
+        self.completion = list()
+        # Copies of the snapshots created to the DR regions (copy-regions)
+        self.copies = list()
+        # Freeze and thaw of the instances (hooks)
+        self.hooks = list()
+        self.parts = list()
+
+    def add_success(self, count=1):
+        with self.lock:
+            self.success += count
+
+    def add_failure(self, error=None, count=1):
+        with self.lock:
+            self.failures += count
+        if error:
+            self.errors.add(error, count)
+
+    def add_deferred(self, count=1):
+        with self.lock:
+            self.deferred += count
+
+    def add_snapshot_set(self, snapshot_set):
+        with self.lock:
+            self.snapshot_sets.append(snapshot_set)
+
+    def add_error(self, error):
+        """
+        Keep an error message that is not related to a volume (ex: SNS errors)
+        """
+        self.errors.add(error)
+
+    def demote(self, count, error=None):
+        """
+        Move volumes already counted as success to the failures (ex: tags written after the creation)
+        """
+        with self.lock:
+            self.success -= count
+            self.failures += count
+        if error:
+            self.errors.add(error, count)
+
+    def merge(self, other):
+        """
+        Add the totals of one part of the run (ex: a region)
+        """
+        with self.lock:
+            self.instances += other.instances
+            self.volumes += other.volumes
+            self.success += other.success
+            self.failures += other.failures
+            self.errors.merge(other.errors)
+            self.snapshot_sets.extend(other.snapshot_sets)
+            self.tag_calls_saved += other.tag_calls_saved
+            self.retries += other.retries
+            self.deferred += other.deferred
+            self.skipped.extend(other.skipped)
+            self.completion.extend(other.completion)
+            self.copies.extend(other.copies)
+            self.hooks.extend(other.hooks)
+            self.parts.append(other)
+            # The rates only make sense for a single part
+            self.rates = other.rates if len(self.parts) == 1 else dict()
+
+    @property
+    def faulted(self):
+        """
+        True if this part or any of its parts could not be processed
+        """
+        return self.fault or any(part.faulted for part in self.parts)
+
+    @property
+    def status(self):
+        if self.fault:
+            return FAULT
+        if self.success == self.volumes - self.deferred and not any(part.faulted for part in self.parts):
+            return SUCCESS
+        elif self.success > 0:
+            return PARTIAL
+        return FAULT
+
+    def to_dict(self):
+        return {
+            'result': self.status,
+            'instances': self.instances,
+            'volumes': self.volumes,
+            'success': self.success,
+            'failures': self.failures,
+            'tag-calls-saved': self.tag_calls_saved,
+            'throttling-retries': self.retries,
+            'rate-limits': self.rates,
+            'deferred': self.deferred,
+            'skipped': len(self.skipped),
+        }
+
+    def summary(self):
+        """
+        Text with the totals (used in the output and the SNS message)
+        """
+        msg_result = ''
+        msg_result += '[=] Total Instances          : {instances}\n'.format(instances=self.instances)
+        msg_result += '[=] Total volumes to process : {total}\n'.format(total=self.volumes)
+        msg_result += '[=] Total volumes failed     : {failed}\n'.format(failed=self.failures)
+        msg_result += '[=] Total volumes success    : {success}\n'.format(success=self.success)
+        if self.deferred:
+            msg_result += '[=] Total volumes deferred   : {deferred}\n'.format(deferred=self.deferred)
+        if self.skipped:
+            msg_result += '[=] Total volumes unchanged  : {skipped}\n'.format(skipped=len(self.skipped))
+        if self.completion:
+            report = completion_report(self.completion)
+            msg_result += '[=] Snapshots completed      : {completed}\n'.format(**report)
+            msg_result += '[=] Snapshots failed         : {0}\n'.format(len(report['failed']))
+            msg_result += '[=] Snapshots still pending  : {0}\n'.format(len(report['stragglers']))
+            msg_result += '[=] Snapshot throughput      : {gb-per-minute} GB/min\n'.format(**report)
+        for region, report in sorted(copy_report(self.copies).items()):
+            if region == 'not-copied-sources':
+                continue
+            msg_result += ('[=] Copies to {region:14} : {copied} copied, {failed} failed, {pending} pending, '
+                           '{not_started} not started - {rate} GB/min, queue wait avg {wait}s\n').format(
+                region=region, copied=report['copied'], failed=len(report['failed']),
+                pending=len(report['pending']), not_started=len(report['not-started']),
+                rate=report['gb-per-minute'], wait=report['queue-wait']['avg'])
+        if self.hooks:
+            report = hooks_report(self.hooks)
+            msg_result += ('[=] Instances frozen         : {frozen} - window avg {avg}s max {max}s, '
+                           '{freeze_failed} freeze failed, {thaw_failed} thaw failed\n').format(
+                frozen=report['frozen'], avg=report['window']['avg'], max=report['window']['max'],
+                freeze_failed=len(report['freeze-failed']), thaw_failed=len(report['thaw-failed']))
+        msg_result += '[=] Tag API calls saved      : {saved}\n'.format(saved=self.tag_calls_saved)
+        msg_result += '[=] Throttling retries       : {retries}\n'.format(retries=self.retries)
+        if self.rates:
+            msg_result += '[=] API rates (calls/sec)    : {rates}\n'.format(
+                rates=', '.join('{0}={1}'.format(family, rate) for family, rate in sorted(self.rates.items()))
+            )
+        return msg_result
+
+
+def run_parallel(function, items, concurrency=CONCURRENCY):
+    """
+    Call function(item) for each item using up to concurrency threads
+    items can be a generator: each worker pulls the next item as soon as it is free
+    Return the list of results in the same order of the items
+    """
+    if concurrency <= 1:
+        return [function(item) for item in items]
+
+    items = enumerate(items)
+    lock = threading.Lock()
+    results = dict()
+    errors = list()
+
+    def worker():
+        while True:
+            try:
+                with lock:
+                    index, item = next(items)
+            except StopIteration:
+                return
+            except Exception as e:
+                errors.append(e)
+                return
+            try:
+                results[index] = function(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return [results[index] for index in sorted(results)]
+
+
+def chunks(items, size):
+    """
+    Split the list in lists of size items (Used to batch the API calls)
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def iter_volume_snapshots(client, volumes, filter_list, page_size=PAGE_SIZE, chunk_size=FILTER_CHUNK):
+    """
+    Yield the snapshots of the volumes matching the filters
+    volumes is a list of (owner_id, volume_id). The volume-id filter receive
+    chunk_size values per call instead of one call per volume
+    """
+    by_owner = dict()
+    for owner_id, volume_id in volumes:
+        by_owner.setdefault(owner_id, set()).add(volume_id)
+
+    paginator = client.get_paginator('describe_snapshots')
+    for owner_id, volume_ids in by_owner.items():
+        for chunk in chunks(sorted(volume_ids), chunk_size):
+            pages = paginator.paginate(
+                OwnerIds=[owner_id or 'self'],
+                Filters=filter_list + [{'Name': 'volume-id', 'Values': chunk}],
+                PaginationConfig={'PageSize': page_size}
+            )
+            for page in pages:
+                for snapshot in page.get('Snapshots', []):
+                    yield snapshot
+
+
+def timestamp(value):
+    """
+    Return the epoch of the datetime (naive datetimes are UTC)
+    """
+    return calendar.timegm(value.utctimetuple())
+
+
+def stop_time(instance):
+    """
+    Return the time (epoch) the instance was stopped or None if it is not stopped
+    """
+    if instance.get('State', {}).get('Name') != 'stopped':
+        return None
+    match = STOP_TIME_PATTERN.search(instance.get('StateTransitionReason') or '')
+    if not match:
+        return None
+    return timestamp(datetime.datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S'))
+
+
+def select_changed(snapshot_volumes, latest, min_interval=MIN_INTERVAL, now=None):
+    """
+    Split the volumes in the ones to snapshot and the ones that did not change since their last snapshot:
+    the last snapshot is newer than min_interval seconds or newer than the time the instance was stopped
+    Return (selected, skipped) with skipped a list of dicts with the reason
+    """
+    now = now or time.time()
+    selected = list()
+    skipped = list()
+    for snapshot in snapshot_volumes:
+        start_time, snapshot_id = latest.get(snapshot.volume_id)
+        reason = None
+        if start_time is None:
+            pass
+        elif now - start_time < min_interval:
+            reason = 'Last snapshot taken {0} seconds ago'.format(int(now - start_time))
+        elif snapshot.stop_time is not None and start_time >= snapshot.stop_time:
+            reason = 'Instance stopped before the last snapshot'
+
+        if reason:
+            skipped.append({
+                'volume-id': snapshot.volume_id,
+                'instance-id': snapshot.instance_id,
+                'snapshot-id': snapshot_id,
+                'reason': reason
+            })
+        else:
+            selected.append(snapshot)
+    return selected, skipped
+
+
+def snapshot_tags(snapshot, protected):
+    """
+    Return the tags of the snapshot (without tags with prefix 'aws:') including Scripted and State:Protected
+    """
+    tags = [tag for tag in snapshot.tags if not tag.get('Key', '').startswith('aws:')]
+    tags.append({'Key': 'Scripted', 'Value': 'True'})
+    tags.append({'Key': 'State:Protected', 'Value': '{}:{}'.format(snapshot.state, protected)})
+    return tags
+
+
 def increment_string(s):
     pos = ord(s[-1])
     if 65 <= pos <= 90:
@@ -126,13 +687,55 @@ def increment_string(s):
     return s[:-1] + chr(new_pos)
 
 
+def iter_instances(client, filter_list, page_size=PAGE_SIZE, instance_ids=None, chunk_size=FILTER_CHUNK):
+    """
+    Walk the describe_instances paginator and yield every instance of every reservation
+    Only one page is kept in memory at a time, so large fleets don't grow the memory usage
+    With instance_ids only these instances are described (chunk_size ids per call)
+    Yield tuples of (owner_id, instance)
+    """
+    paginator = client.get_paginator('describe_instances')
+    groups = [None] if instance_ids is None else chunks(instance_ids, chunk_size)
+    for group in groups:
+        pages = paginator.paginate(
+            Filters=filter_list + ([{'Name': 'instance-id', 'Values': group}] if group is not None else []),
+            PaginationConfig={'PageSize': page_size}
+        )
+        for page in pages:
+            for reservation in page.get('Reservations', []):
+                for instance in reservation.get('Instances', []):
+                    yield reservation.get('OwnerId'), instance
+
+
+def iter_volumes(client, filter_list, page_size=VOLUME_PAGE_SIZE, volume_ids=None, chunk_size=FILTER_CHUNK):
+    """
+    Walk the describe_volumes paginator and yield the volumes matching the filters
+    With volume_ids only these volumes are described (chunk_size ids per call)
+    """
+    paginator = client.get_paginator('describe_volumes')
+    groups = [None] if volume_ids is None else chunks(volume_ids, chunk_size)
+    for group in groups:
+        pages = paginator.paginate(
+            Filters=filter_list + ([{'Name': 'volume-id', 'Values': group}] if group is not None else []),
+            PaginationConfig={'PageSize': min(page_size, VOLUME_PAGE_SIZE)}
+        )
+        for page in pages:
+            for volume in page.get('Volumes', []):
+                yield volume
+
+
 def send_sns_message(sns_topic, subject, msg, msg_sms=None, msg_email=None,
-                     msg_apns=None, msg_gcm=None):
+                     msg_apns=None, msg_gcm=None, sessions=None, metrics=None):
     """
     This function send SNS message to specific topic and can format different
     mesages to e-mail, SMS, Apple iOS and Android
+    sessions: AccountSessions to reuse the SNS client (optional)
+    metrics: Metrics recording the call (optional)
     """
-    client_sns = boto3.client('sns')
+    # The topic can be in other region than the snapshots (arn:aws:sns:<region>:<account>:<name>)
+    arn = sns_topic.split(':')
+    region = arn[3] if len(arn) > 5 else None
+    client_sns = (sessions or default_sessions()).client('sns', region=region)
     sns_arn = sns_topic
 
     sns_body = dict()
@@ -142,7 +745,9 @@ def send_sns_message(sns_topic, subject, msg, msg_sms=None, msg_email=None,
     sns_body['APNS'] = {'aps': {'alert': msg_apns or msg}}
     sns_body['GCM'] = {'data': {'message': msg_gcm or msg}}
 
-    client_sns.publish(
+    (metrics or Metrics()).call(
+        'publish',
+        client_sns.publish,
         TargetArn=sns_arn,
         Subject=subject,
         MessageStructure='json',
@@ -150,309 +755,1114 @@ def send_sns_message(sns_topic, subject, msg, msg_sms=None, msg_email=None,
     )
 
 
-def s3snapshot(verbose=VERBOSE, start_time=time.time(), program='', event=None, context=None):
+def snapshot_description(instance_id, state, options):
+    return 'Script {program} [Instance ID = {instance}] [Stop : {stop}] [Stopped : {stopped}] [State : {state}] {label}'.format(
+        program=options['program'],
+        instance=instance_id,
+        stop=options['stop'],
+        stopped=options['stopped'],
+        state=state,
+        label=options['label']
+    )
+
+
+def snapshot_volume(client, tagger, snapshot, options):
     """
-    This function read the parameters from json list and execute the snapshot
+    Run the snapshot of one volume (create with tags)
+    The state of the instance (stop, stopped) is handled by the caller
+    Return the list of errors (empty if the snapshot was successful)
+    """
+    verbose = options['verbose']
+    errors = list()
+
+    click.echo(
+        '[+] Snapshot Instance-id : {id} - Volume-id : {vol} - Block-dev : {block} - Root-dev : {root}'.format(
+            id=snapshot.instance_id,
+            vol=snapshot.volume_id,
+            block=snapshot.device_name,
+            root=snapshot.root_device
+        )
+    )
 
-    list = json list with filter (instance-id or tags)
-    list can contain stop=true/false (If the instances need to be stopped before
-    the snapshot start)
-    verbose: bool
-    start_time: time
-    event: dict
-    program: str
-    context:
+    snapshot_desc = snapshot_description(snapshot.instance_id, snapshot.state, options)
+
+    response = dict()
+    try:
+        # The tags are applied in the same call
+        with options['metrics'].phase('create'):
+            response = tagger.create_snapshot(
+                snapshot_tags(snapshot, options['protected']),
+                DryRun=False,
+                VolumeId=snapshot.volume_id,
+                Description=snapshot_desc
+            )
+
+    except Exception:
+        click.echo(
+            ('[!] Unable to run CreateSnapshot of:\n'
+             'Instance-id : {id}'
+             ' - Volume-id : {vol}'
+             ' - Block-dev : {block}'
+             ' - Root-dev : {root}').format(
+                id=snapshot.instance_id, vol=snapshot.volume_id,
+                block=snapshot.device_name, root=snapshot.root_device
+            )
+        )
+        if verbose:
+            click.echo('[!] {0}'.format(traceback.format_exc()))
+
+        # Add the error message in the stack to send by e-mail later
+        errors.append(traceback.format_exc())
+
+    # Did the Snapshot run correctly?
+    if response.get('State', 'error') != 'error':
+        snapshot.snapshot_id = response['SnapshotId']
+        click.echo('[=] Snapshot created!')
+        click.echo('[+] Snapshot Name : {name} - ID : {id}'.format(
+            name=snapshot_desc,
+            id=response['SnapshotId'])
+        )
+        if verbose:
+            # This in line function will manage datetime.datetime inside response dict
+            date_handler = lambda obj: (
+                obj.isoformat() if isinstance(obj, datetime.datetime) or isinstance(obj,
+                                                                                    datetime.date) else None)
+            click.echo('[~] response info {info}'.format(
+                info=json.dumps(response, default=date_handler, indent=4))
+            )
+
+    else:
+        click.echo('[!] Snapshot creation Failed!')
+        if not errors:
+            errors.append('Snapshot creation failed for volume {0}'.format(snapshot.volume_id))
+
+    click.echo('')
+    return errors
+
+
+def snapshot_instance(client, tagger, volumes, options):
+    """
+    Run the snapshot of the volumes of one instance with a single CreateSnapshots call
+    The snapshots are crash-consistent across the volumes of the instance
+    The state of the instance (stop, stopped) is handled by the caller
+    Return the snapshot set and a dict volume_id -> list of errors
     """
-    client = boto3.client('ec2')
-    flag_error = False
-    stop = STOP
-    stopped = STOPPED
-    label = LABEL
-    sns_arn = SNS_ARN
-    sns_arn_error = SNS_ARN_ERROR
-    protected = PROTECTED
-    error_msg = list()
-    filter_list = []
+    instance_id = volumes[0].instance_id
+    state = volumes[0].state
+    targets = OrderedDict((snapshot.volume_id, snapshot) for snapshot in volumes)
+    snapshot_set = {'instance-id': instance_id, 'snapshots': []}
+    errors = list()
+
+    click.echo('[+] Snapshot Instance-id : {id} - Volumes : {vols}'.format(
+        id=instance_id, vols=', '.join(targets.keys()))
+    )
 
-    if event:
-        # Start parsing the arguments received from Lambda  
-        if 'tags' in event.keys():
-            tags = event.get('tags', {})
-            for key, value in tags.items():
-                filter_list.append({'Name': key, 'Values': [value]})
-
-        if 'instances' in event.keys():
-            instances = event.get('instances')
-            filter_list.append({
-                'Name': 'instance-id',
-                'Values': [item for item in instances]
-            }
+    # Tags shared by all the volumes are applied in the CreateSnapshots call,
+    # the remaining ones (ex: Name) are written in batch by the tagger
+    volume_tags = dict((volume_id, snapshot_tags(snapshot, options['protected']))
+                       for volume_id, snapshot in targets.items())
+    common_tags = [tag for tag in volume_tags[volumes[0].volume_id]
+                   if all(tag in tags for tags in volume_tags.values())]
+
+    try:
+        with options['metrics'].phase('create'):
+            response = client.create_snapshots(
+                InstanceSpecification={
+                    'InstanceId': instance_id,
+                    'ExcludeBootVolume': not any(snapshot.root_device for snapshot in volumes),
+                    'ExcludeDataVolumeIds': [volume_id for volume_id in volumes[0].data_volumes
+                                             if volume_id not in targets]
+                },
+                Description=snapshot_description(instance_id, state, options),
+                TagSpecifications=[{'ResourceType': 'snapshot', 'Tags': common_tags}]
             )
+        for item in response.get('Snapshots', []):
+            if item.get('VolumeId') not in targets:
+                continue
+            tags = [tag for tag in volume_tags[item['VolumeId']] if tag not in common_tags]
+            tagger.defer(item['SnapshotId'], tags, applied=len(common_tags))
+            targets[item['VolumeId']].snapshot_id = item['SnapshotId']
+            snapshot_set['snapshots'].append({
+                'volume-id': item['VolumeId'],
+                'snapshot-id': item['SnapshotId'],
+                'device': targets[item['VolumeId']].device_name
+            })
+        click.echo('[=] Snapshot set created! Instance-id : {id} - Snapshots : {ids}'.format(
+            id=instance_id, ids=', '.join(item['snapshot-id'] for item in snapshot_set['snapshots']))
+        )
 
-        if 'stop' in event.keys():
-            stop = event.get('stop')
+    except Exception:
+        click.echo('[!] Unable to run CreateSnapshots of Instance-id : {id}'.format(id=instance_id))
+        if options['verbose']:
+            click.echo('[!] {0}'.format(traceback.format_exc()))
+        errors.append(traceback.format_exc())
+
+    created = set(item['volume-id'] for item in snapshot_set['snapshots'])
+    volume_errors = dict()
+    for volume_id in targets:
+        if errors:
+            volume_errors[volume_id] = errors
+        elif volume_id not in created:
+            volume_errors[volume_id] = ['Volume {0} missing in the snapshot set of {1}'.format(volume_id, instance_id)]
+    click.echo('')
+    return snapshot_set, volume_errors
+
+
+def wait_stopped(client, instance_ids, delay=None, timeout=STOP_TIMEOUT, metrics=None, deadline=None):
+    """
+    Poll all the instances with batched DescribeInstances calls every delay seconds (default STOP_DELAY)
+    Yield (instance_id, True) as soon as each instance is stopped and (instance_id, False)
+    for the instances not stopped before the timeout
+    With a Deadline the timeout never goes past the time left by the deadline (minus its margin)
+    The time of the polls and of the waits is added to the stop phase of the metrics
+    """
+    delay = STOP_DELAY if delay is None else delay
+    metrics = metrics or Metrics()
+    pending = set(instance_ids)
+    remaining = deadline.remaining() if deadline else None
+    if remaining is not None:
+        timeout = max(0.0, min(timeout, remaining - deadline.margin))
+    deadline = time.time() + timeout
+    while pending:
+        for chunk in chunks(sorted(pending), FILTER_CHUNK):
+            with metrics.phase('stop'):
+                instances = list(iter_instances(client, [{'Name': 'instance-id', 'Values': chunk}]))
+            for _, instance in instances:
+                if instance.get('State', {}).get('Name') == 'stopped' and instance['InstanceId'] in pending:
+                    pending.discard(instance['InstanceId'])
+                    yield instance['InstanceId'], True
+
+        if pending:
+            if time.time() >= deadline:
+                for instance_id in sorted(pending):
+                    yield instance_id, False
+                return
+            with metrics.phase('stop'):
+                time.sleep(max(0.0, min(delay, deadline - time.time())))
+
+
+def completion_record(snapshot, now=None):
+    """
+    Return the state of the snapshot as reported in the run result
+    With now the seconds between the StartTime of the snapshot and now are added
+    """
+    record = {
+        'snapshot-id': snapshot['SnapshotId'],
+        'volume-id': snapshot.get('VolumeId'),
+        'state': snapshot.get('State', 'pending'),
+        'progress': snapshot.get('Progress'),
+        'size-gb': snapshot.get('VolumeSize', 0),
+    }
+    if snapshot.get('StateMessage'):
+        record['message'] = snapshot['StateMessage']
+    if now is not None and snapshot.get('StartTime'):
+        record['start-time'] = timestamp(snapshot['StartTime'])
+        record['seconds'] = round(max(0.0, now - record['start-time']), 1)
+    return record
+
+
+def wait_completed(client, snapshot_ids, delay=COMPLETION_DELAY, max_delay=COMPLETION_MAX_DELAY,
+                   timeout=COMPLETION_TIMEOUT, deadline=None):
+    """
+    Poll the snapshots with batched DescribeSnapshots calls (FILTER_CHUNK ids per call)
+    The delay between the polls grows by COMPLETION_BACKOFF up to max_delay
+    Yield the record of each snapshot as soon as it is completed or in error and the records
+    of the snapshots still pending at the timeout (or when the deadline expires)
+    The seconds to complete are measured when the poll sees the snapshot completed
+    """
+    pending = set(snapshot_ids)
+    last_seen = dict()
+    end = time.time() + timeout
+    while pending:
+        for chunk in chunks(sorted(pending), FILTER_CHUNK):
+            try:
+                snapshots = client.describe_snapshots(SnapshotIds=chunk).get('Snapshots', [])
+            except Exception:
+                click.echo('[!] Error polling the state of the snapshots : {0}'.format(traceback.format_exc()))
+                continue
 
-        if 'stopped' in event.keys():
-            stopped = event.get('stopped')
+            now = time.time()
+            for snapshot in snapshots:
+                if snapshot['SnapshotId'] not in pending:
+                    continue
+                last_seen[snapshot['SnapshotId']] = snapshot
+                if snapshot.get('State') in ('completed', 'error'):
+                    pending.discard(snapshot['SnapshotId'])
+                    yield completion_record(snapshot, now)
 
-        if 'verbose' in event.keys():
-            verbose = event.get('verbose')
+        if pending:
+            if time.time() + delay > end or (deadline and deadline.expired()):
+                for snapshot_id in sorted(pending):
+                    yield completion_record(last_seen.get(snapshot_id, {'SnapshotId': snapshot_id}))
+                return
+            time.sleep(delay)
+            delay = min(max_delay, delay * COMPLETION_BACKOFF)
 
-        if 'sns-arn' in event.keys():
-            sns_arn = event.get('sns-arn')
 
-        if 'sns-arn-error' in event.keys():
-            sns_arn_error = event.get('sns-arn-error')
+def completion_report(records):
+    """
+    Summary of the completion of the snapshots: time to complete, throughput (GB/min
+    from the first start to the last completion), failed snapshots and stragglers (still pending)
+    """
+    completed = [record for record in records if record['state'] == 'completed']
+    seconds = sorted(record['seconds'] for record in completed if 'seconds' in record)
+    timed = [record for record in completed if 'seconds' in record]
+
+    gb_per_minute = 0.0
+    if timed:
+        span = (max(record['start-time'] + record['seconds'] for record in timed) -
+                min(record['start-time'] for record in timed))
+        gb = sum(record['size-gb'] for record in timed)
+        gb_per_minute = round(gb / (span / 60.0), 2) if span > 0 else 0.0
+
+    def percentile(percent):
+        if not seconds:
+            return 0.0
+        return seconds[min(len(seconds) - 1, int(len(seconds) * percent / 100.0))]
+
+    return {
+        'completed': len(completed),
+        'completed-gb': sum(record['size-gb'] for record in completed),
+        'gb-per-minute': gb_per_minute,
+        'time-to-complete': {
+            'avg': round(sum(seconds) / len(seconds), 1) if seconds else 0.0,
+            'max': seconds[-1] if seconds else 0.0,
+            'p50': percentile(50),
+            'p90': percentile(90),
+        },
+        'failed': [record for record in records if record['state'] == 'error'],
+        'stragglers': [record for record in records if record['state'] not in ('completed', 'error')],
+    }
+
+
+def track_completion(client, created, options, totals, on_result=None):
+    """
+    Wait for the snapshots created in the region and keep their state in the totals
+    The volumes of the snapshots that ended in error are moved to the failures
+    (and given to on_result(snapshot, 'failure', error))
+    """
+    by_id = dict((snapshot.snapshot_id, snapshot) for snapshot in created if snapshot.snapshot_id)
+    if not by_id:
+        return
+
+    click.echo('[+] Waiting till the snapshots are completed : {0}'.format(len(by_id)))
+    failed = list()
+    with options['metrics'].phase('completion'):
+        for record in wait_completed(client, list(by_id), timeout=options['completion-timeout'],
+                                     deadline=options['deadline']):
+            totals.completion.append(record)
+            if record['state'] == 'error':
+                click.echo('[!] Snapshot failed : {snapshot-id} - Volume-id : {volume-id}'.format(**record))
+                failed.append(record['snapshot-id'])
+                if on_result:
+                    on_result(by_id[record['snapshot-id']], 'failure', 'Snapshot {0} in error state: {1}'.format(
+                        record['snapshot-id'], record.get('message', '')))
+            elif record['state'] != 'completed':
+                click.echo('[!] Snapshot still pending : {snapshot-id} - {progress}'.format(**record))
+            elif options['verbose']:
+                click.echo('[=] Snapshot completed : {snapshot-id} in {seconds} seconds'.format(**record))
+
+    if failed:
+        totals.demote(len(failed), '{0} snapshots in error state'.format(len(failed)))
+
+
+def copy_snapshots(client, created, options, totals, region=None, role_arn=None, sessions=None, on_result=None):
+    """
+    Copy the snapshots created in the region to the regions of copy-regions (tags Name, Scripted
+    and State:Protected carried over). The copies in flight of each destination are shared with
+    the other regions of the account within copy-concurrency
+    The volumes of the snapshots that could not be copied are moved to the failures
+    """
+    source_region = region or getattr(getattr(client, 'meta', None), 'region_name', None)
+    by_id = dict((snapshot.snapshot_id, snapshot) for snapshot in created if snapshot.snapshot_id)
+    destinations = [item for item in options['copy-regions'] if item != source_region]
+    if not by_id or not destinations:
+        return
+
+    limiter = RateLimiter(options['rate-limits'], metrics=options['metrics'])
+    clients = dict((destination, throttled_client(sessions, 'ec2', limiter, region=destination, role_arn=role_arn))
+                   for destination in destinations)
+    scheduler = CopyScheduler(client, source_region, clients, options['copy-slots'], account=account_id(role_arn),
+                              program=options['program'], timeout=options['copy-timeout'],
+                              deadline=options['deadline'])
+    click.echo('[+] Copying the snapshots to {0} : {1}'.format(', '.join(destinations), len(by_id)))
+    with options['metrics'].phase('copy'):
+        records = scheduler.run(dict((snapshot_id, snapshot_tags(snapshot, options['protected']))
+                                     for snapshot_id, snapshot in by_id.items()))
+    totals.copies.extend(records)
+
+    failed = dict()
+    for record in records:
+        if record['state'] in ('error', 'failed') or (record['state'] == 'source-error' and
+                                                      not options['track-completion']):
+            failed.setdefault(record['source-snapshot-id'], record)
+    if failed:
+        # The source snapshots in error are already failures with track-completion
+        totals.demote(len(failed))
+        for snapshot_id, record in failed.items():
+            error = record.get('error') or 'Copy of {0} to {1} in state {2}'.format(
+                snapshot_id, record.get('region'), record['state'])
+            totals.errors.add(error)
+            if on_result:
+                on_result(by_id[snapshot_id], 'failure', error)
+
+
+def refresh_states(client, snapshot_volumes):
+    """
+    Update the state of the instances of the volumes with batched DescribeInstances calls
+    (used when the volumes were discovered by a previous run ex: a plan)
+    """
+    by_instance = dict()
+    for snapshot in snapshot_volumes:
+        by_instance.setdefault(snapshot.instance_id, []).append(snapshot)
 
-        if 'label' in event.keys():
-            label = event.get('label')
+    for chunk in chunks(sorted(by_instance), FILTER_CHUNK):
+        for _, instance in iter_instances(client, [{'Name': 'instance-id', 'Values': chunk}]):
+            for snapshot in by_instance.get(instance['InstanceId'], []):
+                snapshot.state = instance.get('State', {}).get('Name')
+                snapshot.stop_time = stop_time(instance)
 
-        if 'protected' in event.keys():
-            protected = event.get('protected')
 
-    click.echo('[+] The stop parameter is    : {0}'.format(stop))
-    click.echo('[+] The stopped parameter is : {0}'.format(stopped))
+def run_snapshots(client, tagger, snapshot_volumes, options, totals, on_done=None, on_created=None,
+                  on_result=None, hooks=None):
+    """
+    Process the volumes with a pool of options['concurrency'] workers
+    The volumes of the same instance are processed by the same worker in order
+    No new instance is started after options['deadline'] expires (the volumes are deferred)
+    With hooks (FreezeHooks) the running instances are frozen before their snapshots and thawed after
+    on_done(volumes) is called after each instance is processed
+    on_created(snapshot) is called for each snapshot created
+    on_result(snapshot, status, error) is called for each volume processed, failed or deferred
+    """
+    deadline = options['deadline']
+    on_result = on_result or (lambda snapshot, status, error=None: None)
+    instances = OrderedDict()
+    for snapshot in snapshot_volumes:
+        instances.setdefault(snapshot.instance_id, []).append(snapshot)
 
-    try:
-        response = client.describe_instances(Filters=filter_list)
-        # Get the instances
-        instances = response[response.keys()[0]]
-        # Get the number of instances to inform in the SNS topic
-        total_instances = len(instances)
-        snapshot_volumes = list()
+    def process_volumes(volumes, orchestrated=False):
+        # The instances already stopped or frozen by the orchestration are always processed
+        if not orchestrated and deadline.expired():
+            totals.add_deferred(len(volumes))
+            for snapshot in volumes:
+                on_result(snapshot, 'deferred')
+            return
+
+        try:
+            if options['stopped'] and not orchestrated:
+                snapshot_stopped_volumes(volumes)
+            else:
+                snapshot_instance_volumes(volumes)
+        finally:
+            if on_done:
+                on_done(volumes)
+
+    def snapshot_stopped_volumes(volumes):
+        instance_id = volumes[0].instance_id
+        if volumes[0].state == 'stopped':
+            snapshot_instance_volumes(volumes)
+        else:
+            click.echo('[!] Instance required to be stopped but is not stopped. Skipping : {id}'.format(
+                id=instance_id))
+            error = 'Instance {0} required to be stopped but is not stopped'.format(instance_id)
+            for snapshot in volumes:
+                totals.add_failure(error)
+                on_result(snapshot, 'failure', error)
+
+        # Bring instance back to running state (once per instance)
+        try:
+            with options['metrics'].phase('start'):
+                client.start_instances(InstanceIds=[instance_id])
+        except Exception:
+            click.echo('[!] Error starting instance : {id}'.format(id=instance_id))
+            totals.add_error(traceback.format_exc())
+
+    def snapshot_instance_volumes(volumes):
+        if options['multi-volume']:
+            try:
+                snapshot_set, volume_errors = snapshot_instance(client, tagger, volumes, options)
+                totals.add_snapshot_set(snapshot_set)
+            except Exception:
+                click.echo('[!] Unexpected error processing instance {0}'.format(volumes[0].instance_id))
+                volume_errors = dict((snapshot.volume_id, [traceback.format_exc()]) for snapshot in volumes)
+
+            for snapshot in volumes:
+                if volume_errors.get(snapshot.volume_id):
+                    totals.add_failure('\n'.join(volume_errors[snapshot.volume_id]))
+                    on_result(snapshot, 'failure', '\n'.join(volume_errors[snapshot.volume_id]))
+                else:
+                    totals.add_success()
+                    on_result(snapshot, 'success')
+                    if on_created:
+                        on_created(snapshot)
+            return
+
+        for snapshot in volumes:
+            try:
+                errors = snapshot_volume(client, tagger, snapshot, options)
+            except Exception:
+                click.echo('[!] Unexpected error processing volume {0}'.format(snapshot.volume_id))
+                errors = [traceback.format_exc()]
 
-        for line in instances:
-            instance = line['Instances'][0]
+            if errors:
+                totals.add_failure('\n'.join(errors))
+                on_result(snapshot, 'failure', '\n'.join(errors))
+            else:
+                totals.add_success()
+                on_result(snapshot, 'success')
+                if on_created:
+                    on_created(snapshot)
+
+    if options['stop']:
+        run_stop_orchestration(client, instances, process_volumes, options, totals, on_result=on_result)
+    elif hooks and not options['stopped']:
+        run_hook_orchestration(hooks, instances, process_volumes, options, totals, on_result=on_result)
+    else:
+        run_parallel(process_volumes, instances.values(), options['concurrency'])
 
-            if verbose:
-                click.echo('[+] Instance Id to snapshot : {instance}'.format(instance=instance['InstanceId']))
-                click.echo('[+] Block Devices to snapshot:')
 
-            for block in instance['BlockDeviceMappings']:
-                tags = []
-                name = None
-                if block.get('Ebs', None) is None:
-                    continue
+def run_stop_orchestration(client, instances, process_volumes, options, totals, on_result=None):
+    """
+    Stop all the instances with batched StopInstances calls and snapshot each instance
+    as soon as it is stopped. The instance is started again as soon as its snapshots are pending,
+    so each instance is stopped only once and the downtime of the instances overlaps
+    on_result(snapshot, status, error) is called for the volumes deferred or failed before the snapshot
+    """
+    on_result = on_result or (lambda snapshot, status, error=None: None)
+    stop_errors = dict()
+    for chunk in chunks(instances.keys(), STATE_BATCH):
+        if options['deadline'].expired():
+            # Only the instances already stopped are processed
+            click.echo('[!] Time budget over. Deferring instances : {ids}'.format(ids=', '.join(chunk)))
+            for instance_id in chunk:
+                volumes = instances.pop(instance_id)
+                totals.add_deferred(len(volumes))
+                for snapshot in volumes:
+                    on_result(snapshot, 'deferred')
+            continue
+
+        click.echo('[+] Stopping instances : {ids}'.format(ids=', '.join(chunk)))
+        try:
+            with options['metrics'].phase('stop'):
+                client.stop_instances(InstanceIds=chunk)
+        except Exception:
+            click.echo('[!] Error stopping instances!')
+            for instance_id in chunk:
+                stop_errors[instance_id] = traceback.format_exc()
+
+    def stopped_instances():
+        for instance_id, error in stop_errors.items():
+            yield instance_id, error
+
+        click.echo('[+] Waiting till the instances are stopped...')
+        waiting = [instance_id for instance_id in instances if instance_id not in stop_errors]
+        # When the deadline comes before STOP_TIMEOUT the instances not stopped yet are deferred
+        remaining = options['deadline'].remaining()
+        bounded = remaining is not None and remaining - options['deadline'].margin < STOP_TIMEOUT
+        for instance_id, is_stopped in wait_stopped(client, waiting, metrics=options['metrics'],
+                                                    deadline=options['deadline']):
+            if is_stopped:
+                yield instance_id, None
+            elif bounded:
+                yield instance_id, DEFERRED
+            else:
+                yield instance_id, 'Timeout waiting for instance {0} to stop'.format(instance_id)
+
+    def process_instance(item):
+        instance_id, error = item
+        volumes = instances[instance_id]
+        if error is DEFERRED:
+            # Not marked as done in the journal: the next invocation stops it again
+            click.echo('[!] Time budget over. Deferring instance not stopped yet : {id}'.format(id=instance_id))
+            totals.add_deferred(len(volumes))
+            for snapshot in volumes:
+                on_result(snapshot, 'deferred')
+        elif error:
+            click.echo('[!] Error waiting for instance to stop! Instance-id : {id}'.format(id=instance_id))
+            for snapshot in volumes:
+                totals.add_failure(error)
+                on_result(snapshot, 'failure', error)
+        else:
+            click.echo('[+] Instance stopped : {id}'.format(id=instance_id))
+            process_volumes(volumes, orchestrated=True)
 
-                if instance.get('Tags'):
-                    # Pool the tags and get the Instance name to use and strip the tags that begin 'aws:'
-                    for tag in instance.get('Tags', {}):
-                        if not tag.get('Key').startswith('aws:') and not tag.get('Key') == 'Name':
-                            tags.append({'Key': tag['Key'], 'Value': tag['Value']})
-
-                        elif tag.get('Key') == 'Name':
-                            # Search for the snapshots with the current device to check if there
-                            # is other snapshots from today
-                            name = SnapshotName(
-                                date=datetime.datetime.today().strftime('%Y%m%d'),
-                                name=tag.get('Value'),
-                                device=block.get('DeviceName'),
-                                volume_id=block.get('Ebs', {}).get('VolumeId'),
-                                owner_id=line.get('OwnerId')
-                            )
-                            tags.append({'Key': tag.get('Key'), 'Value': name(client)})
-
-                if not name:
-                    # If the volume don't have Tags we create the tag Name
-                    name = SnapshotName(
-                        date=datetime.datetime.today().strftime('%Y%m%d'),
-                        name=instance.get('InstanceId'),
-                        device=block.get('DeviceName'),
-                        volume_id=block.get('Ebs', {}).get('VolumeId'),
-                        owner_id=line.get('OwnerId')
-                    )
-                    tags.append({'Key': "Name", 'Value': name(client)})
-
-                # Add the volume to the list of items to snapshot
-                snapshot_volumes.append(
-                    SnapshotItem(
-                        volume_id=block.get('Ebs', {}).get('VolumeId'),
-                        instance_id=instance.get('InstanceId'),
-                        instance_name=name if name else instance.get('InstanceId'),
-                        device_name=block.get('DeviceName'),
-                        root_device=True if block.get('DeviceName') == instance.get('RootDeviceName') else False,
-                        tags=tags,
-                        state=instance.get('State', {}).get('Name')
-                    )
-                )
+        # Bring instance back to running state (The snapshots are already pending)
+        try:
+            with options['metrics'].phase('start'):
+                client.start_instances(InstanceIds=[instance_id])
+            click.echo('[+] Instance started : {id}'.format(id=instance_id))
+        except Exception:
+            click.echo('[!] Error starting instance : {id}'.format(id=instance_id))
+            totals.add_error(traceback.format_exc())
 
-                if verbose:
-                    click.echo('[\]  ID: [ {id} - {device} ]'.format(id=id, device=block.get('DeviceName')))
+    run_parallel(process_instance, stopped_instances(), options['concurrency'])
 
-    except Exception:
-        click.echo('[!] Unable to get instances info. Check your permissions or connectivity')
-        if verbose:
-            click.echo('Error {error}'.format(error=traceback.format_exc()))
-        flag_error = True
-        error_msg.append(traceback.format_exc())
-        return {'result': FAULT}
 
-    # Number of items
-    total_volumes = len(snapshot_volumes)
-    # Number of snapshots successfull (At this point none)
-    total_success = 0
-    # Number of snapshots failed (At this point is zero :)
-    total_failures = 0
+def run_hook_orchestration(hooks, instances, process_volumes, options, totals, on_result=None):
+    """
+    Freeze the running instances with batched remote commands and snapshot each instance as soon as
+    its freeze is acknowledged. The instance is thawed as soon as the create calls returned (the snapshots
+    are pending), so each instance is frozen for the time of its create calls instead of a stop and start
+    At most options['concurrency'] instances are frozen at the same time. The other instances are
+    already consistent (ex: stopped) and are processed without hooks
+    """
+    on_result = on_result or (lambda snapshot, status, error=None: None)
+    running = [instance_id for instance_id, volumes in instances.items() if volumes[0].state == 'running']
+    others = [volumes for instance_id, volumes in instances.items() if volumes[0].state != 'running']
 
-    # Start Snapshot Creation
-    for snapshot in snapshot_volumes:
-        click.echo(
-            '[+] Snapshot Instance-id : {id} - Volume-id : {vol} - Block-dev : {block} - Root-dev : {root}'.format(
-                id=snapshot.instance_id,
-                vol=snapshot.volume_id,
-                block=snapshot.device_name,
-                root=snapshot.root_device
-            )
-        )
+    def process_instance(item):
+        instance_id, error = item
+        volumes = instances[instance_id]
+        try:
+            if error:
+                click.echo('[!] Unable to freeze instance : {id}'.format(id=instance_id))
+                for snapshot in volumes:
+                    totals.add_failure(error)
+                    on_result(snapshot, 'failure', error)
+            else:
+                click.echo('[+] Instance frozen : {id}'.format(id=instance_id))
+                process_volumes(volumes, orchestrated=True)
+        finally:
+            # The snapshots are pending: the point in time is taken
+            with options['metrics'].phase('thaw'):
+                hooks.thaw(instance_id)
+
+    if running:
+        click.echo('[+] Freezing instances : {count}'.format(count=len(running)))
+        run_parallel(process_instance, hooks.freeze(running, limit=options['concurrency'],
+                                                    deadline=options['deadline']), options['concurrency'])
+    for instance_id in hooks.deferred:
+        click.echo('[!] Time budget over. Deferring instance : {id}'.format(id=instance_id))
+        totals.add_deferred(len(instances[instance_id]))
+        for snapshot in instances[instance_id]:
+            on_result(snapshot, 'deferred')
+    run_parallel(process_volumes, others, options['concurrency'])
+
+    with options['metrics'].phase('thaw'):
+        records = hooks.wait_thawed()
+    for record in records:
+        if record.get('thaw-error'):
+            totals.add_error(record['thaw-error'])
+    with totals.lock:
+        totals.hooks.extend(records)
+
+
+def parse_event(event, verbose=VERBOSE, program=''):
+    """
+    Read the parameters from the event (Lambda payload or CLI arguments)
+    Return the dict of options used by the snapshot run
+    """
+    options = {
+        'stop': STOP,
+        'stopped': STOPPED,
+        'label': LABEL,
+        'sns-arn': SNS_ARN,
+        'sns-arn-error': SNS_ARN_ERROR,
+        'protected': PROTECTED,
+        'page-size': PAGE_SIZE,
+        'concurrency': CONCURRENCY,
+        'multi-volume': MULTI_VOLUME,
+        'exclude-root': EXCLUDE_ROOT,
+        'skip-unchanged': SKIP_UNCHANGED,
+        'min-interval': MIN_INTERVAL,
+        'rate-limits': {},
+        'client-config': {},
+        'regions': [None],
+        'accounts': [None],
+        'role-session-name': 's3snapshot',
+        'time-budget': None,
+        'time-margin': MARGIN,
+        'journal-store': {},
+        'continuation-token': None,
+        'cache-path': None,
+        'cache-ttl': CACHE_TTL,
+        'emit-metrics': None,
+        'report-path': None,
+        'notify': True,
+        'track-completion': TRACK_COMPLETION,
+        'completion-timeout': COMPLETION_TIMEOUT,
+        'copy-regions': [],
+        'copy-concurrency': COPY_CONCURRENCY,
+        'copy-timeout': COPY_TIMEOUT,
+        # Configuration of the freeze and thaw hooks (hooks.py), None to snapshot without them
+        'hooks': None,
+        'verbose': verbose,
+        'program': program,
+        # Filters of DescribeInstances and the Selection of the volumes (filters.py)
+        'filters': [],
+        'selection': compile_selection({}),
+        # Replaced by the run with the deadline of the Lambda context / time budget
+        'deadline': Deadline(),
+        'journal': None,
+        'cache': None,
+        'metrics': Metrics(),
+        'report': ResultSink(),
+        # Volumes of each target (account/region) given by a plan instead of the discovery
+        'planned': None,
+        # Error of an invalid argument of the event (the run returns FAULT)
+        'invalid': None,
+    }
 
-        snapshot_desc = 'Script {program} [Instance ID = {instance}] [Stop : {stop}] [Stopped : {stopped}] [State : {state}] {label}'.format(
-            program=program,
-            instance=snapshot.instance_id,
-            stop=stop,
-            stopped=stopped,
-            state=snapshot.state,
-            label=label
-        )
+    if event:
+        # Start parsing the arguments received from Lambda
+        # The filters are compiled to EC2 filters, the rest of the selection is evaluated locally
+        try:
+            options['selection'] = compile_selection(event)
+        except ValueError as e:
+            click.echo('[!] Unable to process. Invalid selection : {0}'.format(e))
+            options['invalid'] = str(e)
+        options['filters'] = options['selection'].instance_filters
 
-        # Need to stop first?
-        instance_stopped = False
-        if stop:
-            click.echo('[+] Stopping instance : {id}'.format(id=snapshot.instance_id))
-            response = client.stop_instances(InstanceIds=[snapshot.instance_id])
+        for key in ('stop', 'stopped', 'verbose', 'sns-arn', 'sns-arn-error', 'label', 'protected',
+                    'multi-volume', 'exclude-root', 'skip-unchanged', 'track-completion', 'notify'):
+            if key in event.keys():
+                options[key] = event.get(key)
 
-            try:
-                click.echo('[+] Waiting till the instance is stopped...')
-                client.get_waiter('instance_stopped').wait(InstanceIds=[snapshot.instance_id])
-                instance_stopped = True
+        if 'page-size' in event.keys():
+            options['page-size'] = int(event.get('page-size'))
 
-            except Exception:
-                click.echo('[!] Error waiting for instance to stop!')
-                flag_error = True
-                total_failures += 1
-                error_msg.append(traceback.format_exc())
+        if event.get('completion-timeout') is not None:
+            options['completion-timeout'] = float(event.get('completion-timeout'))
 
-        # Need to check if the instance is already stopped before start the snapshot
-        if (stopped and snapshot.state == 'stopped') or (not stopped and stop and instance_stopped) or (
-                    not stop and not stopped):
+        if event.get('copy-regions'):
+            copy_regions = event.get('copy-regions')
+            if not isinstance(copy_regions, list):
+                copy_regions = [region.strip() for region in copy_regions.split(',') if region.strip()]
+            options['copy-regions'] = copy_regions
 
-            try:
-                # Try to avoid Throttling API requests. Wait 1 second before start.
-                time.sleep(SLEEP_TIME)
-                response = client.create_snapshot(
-                    DryRun=False,
-                    VolumeId=snapshot.volume_id,
-                    Description=snapshot_desc
-                )
+        if event.get('copy-concurrency') is not None:
+            options['copy-concurrency'] = max(1, int(event.get('copy-concurrency')))
 
-            except Exception:
-                click.echo(
-                    ('[!] Unable to run CreateSnapshot of:\n'
-                     'Instance-id : {id}'
-                     ' - Volume-id : {vol}'
-                     ' - Block-dev : {block}'
-                     ' - Root-dev : {root}').format(
-                        id=snapshot.instance_id, vol=snapshot.volume_id,
-                        block=snapshot.device_name, root=snapshot.root_device
-                    )
+        if event.get('copy-timeout') is not None:
+            options['copy-timeout'] = float(event.get('copy-timeout'))
+
+        if event.get('min-interval') is not None:
+            options['min-interval'] = float(event.get('min-interval'))
+
+        if event.get('client-config'):
+            options['client-config'] = dict(event.get('client-config'))
+
+        if event.get('hooks'):
+            # true for the default hooks or the dict of the configuration
+            options['hooks'] = dict(event.get('hooks')) if isinstance(event.get('hooks'), dict) else {}
+
+        if 'rate-limits' in event.keys():
+            options['rate-limits'] = dict((key, float(value)) for key, value in event.get('rate-limits').items())
+
+        if event.get('regions'):
+            regions = event.get('regions')
+            if not isinstance(regions, list):
+                regions = [region.strip() for region in regions.split(',') if region.strip()]
+            options['regions'] = regions
+
+        if event.get('accounts'):
+            accounts = event.get('accounts')
+            if not isinstance(accounts, list):
+                accounts = [role_arn.strip() for role_arn in accounts.split(',') if role_arn.strip()]
+            options['accounts'] = accounts
+
+        if 'role-session-name' in event.keys():
+            options['role-session-name'] = event.get('role-session-name')
+
+        if 'concurrency' in event.keys():
+            options['concurrency'] = max(1, int(event.get('concurrency')))
+
+        if event.get('time-budget'):
+            options['time-budget'] = float(event.get('time-budget'))
+
+        if 'time-margin' in event.keys():
+            options['time-margin'] = float(event.get('time-margin'))
+
+        if event.get('journal'):
+            options['journal-store'] = event.get('journal')
+
+        if event.get('continuation-token'):
+            options['continuation-token'] = event.get('continuation-token')
+
+        if event.get('cache'):
+            options['cache-path'] = event.get('cache')
+
+        if event.get('cache-ttl') is not None:
+            options['cache-ttl'] = float(event.get('cache-ttl'))
+
+        if event.get('emit-metrics') is not None:
+            options['emit-metrics'] = event.get('emit-metrics')
+
+        if event.get('report'):
+            options['report-path'] = event.get('report')
+
+    # Copies in flight of each DR region shared by all the regions of the run
+    options['copy-slots'] = CopySlots(options['copy-concurrency'])
+    return options
+
+
+def select_volumes(client, options, scope=None):
+    """
+    Discover the instances and build the list of volumes of the selection (without the names)
+    With the inventory cache the instances of the scope (account/region) are read from the cache
+    The selection with volume criteria (type, size, tags of the volumes) describes the volumes: first when the
+    discovery is by volumes (only the instances of the volumes selected are described) or after the instances
+    Return (total_instances, snapshot_volumes)
+    """
+    verbose = options['verbose']
+    cache = options['cache']
+    selection = options['selection']
+
+    # Get the number of instances to inform in the SNS topic
+    total_instances = 0
+    snapshot_volumes = list()
+    # Volumes of the volume criteria by volume id (None without volume criteria)
+    volumes = None
+    cached = False
+
+    if selection.volume_discovery:
+        volumes = dict((volume['VolumeId'], volume) for volume in iter_volumes(
+            client, selection.discovery_filters(), page_size=options['page-size']))
+        instance_ids = sorted(set(attachment['InstanceId'] for volume in volumes.values()
+                                  for attachment in volume.get('Attachments', [])))
+        click.echo('[+] Volumes selected : {0} - Instances : {1}'.format(len(volumes), len(instance_ids)))
+        instances = iter_instances(client, options['filters'], page_size=options['page-size'],
+                                   instance_ids=instance_ids)
+    else:
+        instances = cache.get_instances(scope, options['filters']) if cache else None
+        if instances is not None:
+            click.echo('[+] Instances read from the cache : {0}'.format(len(instances)))
+            cached = True
+        else:
+            instances = iter_instances(client, options['filters'], page_size=options['page-size'])
+            if cache:
+                instances = list(instances)
+                cache.put_instances(scope, options['filters'], instances)
+
+    for owner_id, instance in instances:
+        if not selection.match_instance(instance):
+            continue
+        total_instances += 1
+
+        if verbose:
+            click.echo('[+] Instance Id to snapshot : {instance}'.format(instance=instance['InstanceId']))
+            click.echo('[+] Block Devices to snapshot:')
+
+        data_volumes = [block['Ebs'].get('VolumeId') for block in instance['BlockDeviceMappings']
+                        if block.get('Ebs') and block.get('DeviceName') != instance.get('RootDeviceName')]
+
+        for block in instance['BlockDeviceMappings']:
+            tags = []
+            name = None
+            if block.get('Ebs', None) is None:
+                continue
+
+            root_device = block.get('DeviceName') == instance.get('RootDeviceName')
+            if root_device and options['exclude-root']:
+                continue
+            if not selection.match_block(block.get('DeviceName'), root_device):
+                continue
+
+            if instance.get('Tags'):
+                # Pool the tags and get the Instance name to use and strip the tags that begin 'aws:'
+                for tag in instance.get('Tags', {}):
+                    if not tag.get('Key').startswith('aws:') and not tag.get('Key') == 'Name':
+                        tags.append({'Key': tag['Key'], 'Value': tag['Value']})
+
+                    elif tag.get('Key') == 'Name':
+                        name = tag.get('Value')
+
+            # Add the volume to the list of items to snapshot
+            # (The tag Name is resolved later for all the volumes at once)
+            snapshot_volumes.append(
+                SnapshotItem(
+                    volume_id=block.get('Ebs', {}).get('VolumeId'),
+                    instance_id=instance.get('InstanceId'),
+                    instance_name=name if name else instance.get('InstanceId'),
+                    device_name=block.get('DeviceName'),
+                    root_device=root_device,
+                    tags=tags,
+                    state=instance.get('State', {}).get('Name'),
+                    owner_id=owner_id,
+                    data_volumes=data_volumes,
+                    stop_time=stop_time(instance)
                 )
-                flag_error = True
-                total_failures += 1
-                if verbose:
-                    click.echo('[!] {0}'.format(traceback.format_exc()))
-
-                # Add the error message in the stack to send by e-mail later
-                error_msg.append(traceback.format_exc())
-
-            # Did the Snapshot run correctly?
-            if response.get('State', 'error') is not 'error':
-                click.echo('[=] Snapshot created!')
-                click.echo('[+] Snapshot Name : {name} - ID : {id}'.format(
-                    name=snapshot_desc,
-                    id=response['SnapshotId'])
+            )
+
+            if verbose:
+                click.echo('[\\]  ID: [ {id} - {device} ]'.format(
+                    id=block.get('Ebs', {}).get('VolumeId'),
+                    device=block.get('DeviceName'))
                 )
-                if verbose:
-                    # This in line function will manage datetime.datetime inside response dict
-                    date_handler = lambda obj: (
-                        obj.isoformat() if isinstance(obj, datetime.datetime) or isinstance(obj,
-                                                                                            datetime.date) else None)
-                    click.echo('[~] response info {info}'.format(
-                        info=json.dumps(response, default=date_handler, indent=4))
-                    )
-
-                # Add tags to Snapshot
-                try:
-                    # loop thru each tag to ignore tags with prefix: 'aws:
-                    for tag in snapshot.tags:
-                        if not tag.get('Key', '').startswith('aws:'):
-                            client.create_tags(Resources=[response['SnapshotId']], Tags=[tag])
-
-                    # Tag the State and Scripted tags
-                    client.create_tags(Resources=[response.get('SnapshotId')], Tags=[{"Key": "Scripted", "Value": "True"}])
-                    client.create_tags(Resources=[response.get('SnapshotId')],
-                                       Tags=[{"Key": "State:Protected", "Value": '{}:{}'.format(snapshot.state, protected)}])
-
-                except botocore.exceptions.ClientError:
-                    # If we have requested too fast we need to wait an run again ;-)
-                    click.echo('[!] Error writing tags... Waiting for {} secods'.format(SLEEP_TIME))
-                    time.sleep(SLEEP_TIME)
-                    flag_error = True
-                    total_failures += 1
-                    pass
 
-                except Exception:
-                    click.echo('[!] Error creating Snapshot Tags: {error}'.format(error=traceback.format_exc()))
-                    # Add the error message in the stack to send by e-mail later
-                    error_msg.append(traceback.format_exc())
-                    flag_error = True
-                    total_failures += 1
-                    pass
+    if selection.needs_volumes:
+        if volumes is None:
+            volumes = dict((volume['VolumeId'], volume) for volume in iter_volumes(
+                client, selection.volume_filters, page_size=options['page-size'],
+                volume_ids=sorted(snapshot.volume_id for snapshot in snapshot_volumes)))
+        snapshot_volumes = [snapshot for snapshot in snapshot_volumes if snapshot.volume_id in volumes and
+                            selection.match_volume(volumes[snapshot.volume_id])]
+    if selection.selects_volumes:
+        # Only the instances with volumes selected
+        total_instances = len(set(snapshot.instance_id for snapshot in snapshot_volumes))
+    if cached and (options['stop'] or options['stopped'] or options['hooks'] is not None):
+        # The state of the cached instances may have changed since they were cached
+        refresh_states(client, snapshot_volumes)
+    return total_instances, snapshot_volumes
+
+
+def discover_volumes(client, options, scope=None):
+    """
+    Discover the instances and build the list of volumes to snapshot with the tag Name resolved
+    With skip-unchanged the volumes not changed since their last snapshot are left out
+    With the inventory cache the names of the scope (account/region) are read from the cache
+    Return (total_instances, snapshot_volumes, skipped)
+    """
+    metrics = options['metrics']
+    start = time.time()
+    total_instances, snapshot_volumes = select_volumes(client, options, scope=scope)
 
-            else:
-                click.echo('[!] Snapshot creation Failed!')
-                flag_error = True
-                total_failures += 1
+    skipped = list()
+    if options['skip-unchanged']:
+        latest = LatestSnapshots(client, page_size=options['page-size'])
+        latest.load([(snapshot.owner_id, snapshot.volume_id) for snapshot in snapshot_volumes])
+        snapshot_volumes, skipped = select_changed(snapshot_volumes, latest, min_interval=options['min-interval'])
+        for item in skipped:
+            click.echo('[=] Skipping unchanged Volume-id : {volume-id} - {reason}'.format(**item))
+    metrics.add_phase('discovery', time.time() - start)
+
+    resolve_names(client, snapshot_volumes, options, scope=scope)
+    return total_instances, snapshot_volumes, skipped
 
+
+def resolve_names(client, snapshot_volumes, options, scope=None):
+    """
+    Set the tag Name of the volumes with the next name of today (a name already set, ex: by a plan, is replaced)
+    """
+    # Search for the snapshots of all the volumes to check if there is other snapshots from today
+    with options['metrics'].phase('naming'):
+        resolver = SnapshotNameResolver(
+            client,
+            date=datetime.datetime.today().strftime('%Y%m%d'),
+            page_size=options['page-size'],
+            cache=options['cache'],
+            scope=scope
+        )
+        resolver.load([(snapshot.owner_id, snapshot.volume_id) for snapshot in snapshot_volumes])
+        for snapshot in snapshot_volumes:
+            snapshot.tags = [tag for tag in snapshot.tags if tag['Key'] != 'Name']
+            snapshot.tags.append({
+                'Key': 'Name',
+                'Value': resolver(snapshot.instance_name, snapshot.device_name, snapshot.volume_id)
+            })
+
+
+def target_name(region=None, role_arn=None):
+    """
+    Text of the account and region of a target used in the messages (ex: ' of region eu-west-1')
+    """
+    return '{account}{region}'.format(
+        account=' of account {0}'.format(account_id(role_arn)) if role_arn else '',
+        region=' of region {0}'.format(region) if region else ''
+    )
+
+
+def target_fault(totals, error, message, options):
+    """
+    Mark the totals of a target that could not be processed (the other targets of the run go on)
+    """
+    click.echo(message)
+    if options['verbose']:
+        click.echo('Error {error}'.format(error=error))
+    totals.fault = True
+    totals.add_error(error)
+    return totals
+
+
+def snapshot_region(options, region=None, role_arn=None, sessions=None):
+    """
+    Run the discovery and the snapshots of one region of one account
+    with its own client and rate limits (role_arn None is the account of the ambient credentials)
+    Return the RunTotals of the region
+    """
+    sessions = sessions or default_sessions()
+    try:
+        # All the EC2 calls of the region share the rate limits
+        limiter = RateLimiter(options['rate-limits'], metrics=options['metrics'])
+        client = throttled_client(sessions, 'ec2', limiter, region=region, role_arn=role_arn)
+        hooks = None
+        if options['hooks'] is not None:
+            # The remote commands have their own API limits
+            hooks = freeze_hooks(options['hooks'], sessions, region=region, role_arn=role_arn,
+                                 limiter=RateLimiter(options['rate-limits'], metrics=options['metrics']))
+        if options['planned'] is not None:
+            total_instances, snapshot_volumes, skipped = options['planned'].get(target_key(role_arn, region),
+                                                                                 (0, [], []))
+            if options['stopped'] or options['hooks'] is not None:
+                # The state of the instances may have changed since the plan
+                refresh_states(client, snapshot_volumes)
+            # Other runs (or the same plan) may have taken the names of the plan since it was written
+            resolve_names(client, snapshot_volumes, options, scope=target_key(role_arn, region))
         else:
-            click.echo('[!] Instance required to be stopped but is not stopped. Skipping')
-            flag_error = True
-            total_failures += 1
-
-        if stop or stopped:
-            # Bring instance back to running state
-            # (Wait 1 second to give time to snapshot start)
-            time.sleep(SLEEP_TIME)
-            response = client.start_instances(InstanceIds=[snapshot.instance_id])
-
-        if not flag_error:
-            total_success += 1
-        # Reset the flag_error to iterate again
-        flag_error = False
-        click.echo('')
+            total_instances, snapshot_volumes, skipped = discover_volumes(client, options,
+                                                                          scope=target_key(role_arn, region))
 
-    msg_result = ''
-    msg_result += '[=] Total Instances          : {instances}\n'.format(instances=total_instances)
-    msg_result += '[=] Total volumes to process : {total}\n'.format(total=total_volumes)
-    msg_result += '[=] Total volumes failed     : {failed}\n'.format(failed=total_failures)
-    msg_result += '[=] Total volumes success    : {success}\n'.format(success=total_success)
+    except Exception:
+        return target_fault(
+            RunTotals(name=region), traceback.format_exc(),
+            '[!] Unable to get instances info{0}. Check your permissions or connectivity'.format(
+                target_name(region, role_arn)),
+            options
+        )
 
-    click.echo(msg_result)
+    on_done = None
+    journal = options['journal']
+    if journal:
+        # Skip the volumes processed by the previous invocations of the run
+        target = target_key(role_arn, region)
+        done = journal.done(target)
+        if done:
+            click.echo('[+] Volumes already processed by the previous invocations : {0}'.format(len(done)))
+            snapshot_volumes = [snapshot for snapshot in snapshot_volumes if snapshot.volume_id not in done]
 
-    if total_success == total_volumes:
-        status = SUCCESS
-    elif total_success > 0:
-        status = PARTIAL
-    else:
-        status = FAULT
+        def on_done(volumes):
+            journal.mark(target, [snapshot.volume_id for snapshot in volumes])
+
+    totals = RunTotals(instances=total_instances, volumes=len(snapshot_volumes), name=region)
+    totals.skipped = skipped
+    tagger = SnapshotTagger(client)
+    created = list()
+
+    # One result line per volume (the last line of a volume wins, ex: failed after the creation)
+    report = options['report']
+    account = account_id(role_arn)
+
+    def on_result(snapshot, status, error=None):
+        report.write(volume_record(snapshot, status, error, account=account, region=region))
+
+    for item in skipped:
+        report.write(dict(item, status='skipped', account=account, region=region))
+
+    try:
+        # Start Snapshot Creation
+        run_snapshots(client, tagger, snapshot_volumes, options, totals, on_done=on_done, on_created=created.append,
+                      on_result=on_result, hooks=hooks)
+
+        if options['cache'] and created:
+            # Write through the names of the snapshots created (sYYYYMMDDx-<name>-<device>)
+            by_date = dict()
+            for snapshot in created:
+                prefix = [tag['Value'] for tag in snapshot.tags if tag['Key'] == 'Name'][0].split('-')[0]
+                by_date.setdefault(prefix[1:9], dict())[snapshot.volume_id] = prefix
+            for date, names in by_date.items():
+                options['cache'].put_names(target_key(role_arn, region), date, names)
+
+        # Write the tags that could not be applied in the CreateSnapshot calls
+        with options['metrics'].phase('tag'):
+            failed_tags = tagger.flush()
+        if failed_tags:
+            totals.demote(len(failed_tags), 'Unable to tag {0} snapshots'.format(len(failed_tags)))
+            for snapshot in created:
+                if snapshot.snapshot_id in failed_tags:
+                    on_result(snapshot, 'failure', 'Unable to tag the snapshot {0}'.format(snapshot.snapshot_id))
+
+        if options['track-completion']:
+            track_completion(client, created, options, totals, on_result=on_result)
+
+        if options['copy-regions']:
+            copy_snapshots(client, created, options, totals, region=region, role_arn=role_arn, sessions=sessions,
+                           on_result=on_result)
+
+    except Exception:
+        # The volumes already processed keep their counts
+        target_fault(totals, traceback.format_exc(),
+                     '[!] Unable to process the snapshots{0}'.format(target_name(region, role_arn)), options)
+
+    totals.tag_calls_saved = tagger.saved
+    totals.retries = limiter.retries
+    totals.rates = limiter.rates()
+    return totals
+
+
+def run_targets(options, function, totals_class=RunTotals, sessions=None):
+    """
+    Call function(options, region=, role_arn=, sessions=) for each region of each account in parallel
+    The role of each account is assumed only once and shared by its regions
+    Return the merged totals and an OrderedDict with the totals of each account
+    """
+    sessions = sessions or default_sessions(session_name=options['role-session-name'])
+    # The clients of each target are shared by the workers of the target (settings of this run only)
+    sessions = sessions.configured(options['client-config'], pool_size=options['concurrency'])
+    targets = [(role_arn, region) for role_arn in options['accounts'] for region in options['regions']]
+
+    def run_target(target):
+        role_arn, region = target
+        try:
+            return function(options, region=region, role_arn=role_arn, sessions=sessions)
+        except Exception:
+            # One target can't abort the others (the summary and the SNS message are still sent)
+            return target_fault(totals_class(name=region), traceback.format_exc(),
+                                '[!] Unable to process{0}'.format(target_name(region, role_arn)), options)
+
+    parts = run_parallel(run_target, targets, min(len(targets), TARGET_CONCURRENCY))
+
+    totals = totals_class()
+    accounts = OrderedDict()
+    for (role_arn, region), part in zip(targets, parts):
+        if role_arn not in accounts:
+            accounts[role_arn] = totals_class(name=account_id(role_arn))
+        accounts[role_arn].merge(part)
+    for account in accounts.values():
+        totals.merge(account)
+
+    return totals, accounts
 
-    # Finished Processing. Send SNS results
+
+def targets_summary(accounts):
+    """
+    Text with the status of each account and region (only when there is more than one)
+    """
+    msg_result = ''
+    for account in accounts.values():
+        if len(accounts) > 1:
+            msg_result += '[=] Account {account:16} : {status} - {success}/{total} {unit}\n'.format(
+                account=account.name, status=account.status, success=account.success, total=account.volumes,
+                unit=account.unit
+            )
+        if len(account.parts) > 1:
+            for part in account.parts:
+                msg_result += '[=] {indent}Region {region:16} : {status} - {success}/{total} {unit}\n'.format(
+                    indent='  ' if len(accounts) > 1 else '', region=part.name, status=part.status,
+                    success=part.success, total=part.volumes, unit=part.unit
+                )
+    return msg_result
+
+
+def targets_result(accounts, result):
+    """
+    Add the results of each account and region to the result (only when there is more than one)
+    """
+    for account in accounts.values():
+        account_result = account.to_dict()
+        if len(account.parts) > 1:
+            account_result['regions'] = dict((part.name, part.to_dict()) for part in account.parts)
+        if len(accounts) > 1:
+            result.setdefault('accounts', dict())[account.name] = account_result
+        elif 'regions' in account_result:
+            result['regions'] = account_result['regions']
+    return result
+
+
+def notify(options, totals, msg_result, start_time, event=None, context=None, job='snapshot', sessions=None):
+    """
+    Send the SNS message with the result and the SNS error message with the errors (if any)
+    """
+    verbose = options['verbose']
+    status = totals.status
 
     click.echo('[+] Sending SNS topic ')
     elapsed_time = time.time() - start_time
     message_default = (
-        'The snapshot of servers has been {status}\n'
+        'The {job} of servers has been {status}\n'
         'Start time: {start}\n'
         'Elapsed time {elapsed}\n'
         '{total}').format(
+        job=job,
         status=status,
         start=time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(start_time)),
         elapsed=datetime.timedelta(seconds=elapsed_time),
@@ -476,45 +1886,171 @@ def s3snapshot(verbose=VERBOSE, start_time=time.time(), program='', event=None,
             click.echo('{message}'.format(message=message_context))
     try:
         send_sns_message(
-            sns_arn,
-            subject='[Snapshot {status}]'.format(status=status),
-            msg=message_default
+            options['sns-arn'],
+            subject='[{job} {status}]'.format(job=job.capitalize(), status=status),
+            msg=message_default,
+            sessions=sessions,
+            metrics=options['metrics']
         )
 
     except Exception:
         click.echo('[!] Error when sending SNS message: Unable to send SNS')
         if verbose:
             click.echo('[!] Error: {0}'.format(traceback.format_exc()))
-        error_msg.append(traceback.format_exc())
+        totals.add_error(traceback.format_exc())
 
     if status == FAULT or status == PARTIAL:
         message_default = (
-            'There are errors during the snapshot processing\n'
+            'There are errors during the {job} processing\n'
             'Bellow the information of the processing job:\n'
             'Start time  : {start}\n').format(
+            job=job,
             start=time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(start_time))
         )
 
-        # Include all error messages in the default msg
-        for line in error_msg:
-            message_default += '\n'
-            message_default += 'error: {0}'.format(line)
+        # Include the count of each error code and a few exemplars (bounded whatever the number of errors)
+        message_default += totals.errors.summary()
 
         # Customize the error message to SMS
-        message_sms = ('Snapshot status: {status}\n'
-                       'There are errors during the Snapshot\n'
-                       'Look in your e-mail for more information').format(status=status)
+        message_sms = ('{job} status: {status}\n'
+                       'There are errors during the {job}\n'
+                       'Look in your e-mail for more information').format(job=job.capitalize(), status=status)
         try:
             send_sns_message(
-                sns_arn_error,
-                subject='[Snapshot {status}]'.format(status=status),
+                options['sns-arn-error'],
+                subject='[{job} {status}]'.format(job=job.capitalize(), status=status),
                 msg=message_default,
-                msg_sms=message_sms
+                msg_sms=message_sms,
+                sessions=sessions,
+                metrics=options['metrics']
             )
         except:
             click.echo('[!] Error when sending SNS error message: Unable to send SNS')
             if verbose:
                 click.echo('[!] {0}'.format(traceback.format_exc()))
 
+
+def emit_metrics(options, context=None):
+    """
+    Write the metrics as embedded metric format log lines (by default only in Lambda)
+    """
+    emit = options['emit-metrics']
+    if emit or (emit is None and context is not None):
+        for line in options['metrics'].emf():
+            click.echo(line)
+
+
+def open_report(options):
+    """
+    Open the sink of the per-volume result lines given by the report path (the run goes on without it on errors)
+    """
+    if options['report-path']:
+        try:
+            options['report'] = ResultSink(options['report-path'])
+        except Exception:
+            click.echo('[!] Unable to open the report {0}. Running without report'.format(options['report-path']))
+
+
+def s3snapshot(verbose=VERBOSE, start_time=time.time(), program='', event=None, context=None, sessions=None,
+               planned=None):
+    """
+    This function read the parameters from json list and execute the snapshot
+
+    list = json list with filter (instance-id or tags)
+    list can contain stop=true/false (If the instances need to be stopped before
+    the snapshot start)
+    verbose: bool
+    start_time: time
+    event: dict
+    program: str
+    context:
+    sessions: AccountSessions reused between runs (optional)
+    planned: dict target -> (instances, volumes, skipped) of a plan processed without discovery (optional)
+    """
+    options = parse_event(event, verbose=verbose, program=program)
+    if options['invalid']:
+        return {'result': FAULT}
+    options['planned'] = planned
+    stop = options['stop']
+    stopped = options['stopped']
+
+    click.echo('[+] The stop parameter is    : {0}'.format(stop))
+    click.echo('[+] The stopped parameter is : {0}'.format(stopped))
+
+    # Stop before the Lambda timeout (or the time budget) and keep a journal to resume the run
+    options['deadline'] = Deadline(context, budget=options['time-budget'], margin=options['time-margin'])
+    if options['deadline'].enabled or options['continuation-token']:
+        try:
+            store = journal_store(options['journal-store'])
+        except Exception:
+            click.echo('[!] Unable to process. Invalid journal configuration {0}'.format(options['journal-store']))
+            return {'result': FAULT}
+
+        if options['continuation-token']:
+            options['journal'] = Journal.resume(store, options['continuation-token'])
+            if not options['journal']:
+                # Starting again would snapshot the volumes already processed
+                click.echo('[!] Unable to process. Journal not found for the continuation token {0}'.format(
+                    options['continuation-token'])
+                )
+                return {'result': FAULT}
+            click.echo('[+] Resuming the run         : {0}'.format(options['continuation-token']))
+        else:
+            options['journal'] = Journal(store)
+
+        if not options['journal'].start():
+            return {'result': FAULT}
+
+    if options['cache-path']:
+        try:
+            options['cache'] = InventoryCache(options['cache-path'], ttl=options['cache-ttl'])
+        except Exception:
+            click.echo('[!] Unable to open the cache {0}. Running without cache'.format(options['cache-path']))
+            if options['verbose']:
+                click.echo('[!] {0}'.format(traceback.format_exc()))
+
+    open_report(options)
+
+    # Each region of each account is processed in parallel with its own client and rate limits
+    totals, accounts = run_targets(options, snapshot_region, sessions=sessions)
+    if options['cache']:
+        options['cache'].close()
+    options['report'].close()
+    if all(part.fault for account in accounts.values() for part in account.parts):
+        return {'result': FAULT}
+
+    journal = options['journal']
+    if journal and totals.deferred:
+        journal.save()
+        click.echo('[!] Time budget over. {0} volumes left for the next invocation'.format(totals.deferred))
+        click.echo('[+] Continuation token : {0}'.format(journal.run_id))
+    elif journal:
+        journal.complete()
+
+    msg_result = totals.summary() + targets_summary(accounts)
+    click.echo(msg_result)
+
+    # Finished Processing. Send SNS results (the workers of a coordinator don't send them)
+    if options['notify']:
+        with options['metrics'].phase('notify'):
+            notify(options, totals, msg_result, start_time, event=event, context=context, sessions=sessions)
+    emit_metrics(options, context)
+
+    result = totals.to_dict()
+    result['metrics'] = options['metrics'].to_dict()
+    result['errors'] = totals.errors.to_dict()
+    if options['multi-volume']:
+        result['snapshot-sets'] = totals.snapshot_sets
+    if options['skip-unchanged']:
+        result['skipped-volumes'] = totals.skipped
+    if options['track-completion']:
+        result['completion'] = completion_report(totals.completion)
+    if options['copy-regions']:
+        result['copies'] = copy_report(totals.copies)
+    if totals.hooks:
+        result['hooks'] = hooks_report(totals.hooks)
+    if journal and totals.deferred:
+        result['continuation-token'] = journal.run_id
+
     # Return an HTTP error code
-    return {'result': status}
+    return targets_result(accounts, result)
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+#
+# shard.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Coordinator of the very large fleets: the plan is split in shards executed by workers"""
+
+from __future__ import print_function
+
+import heapq
+import json
+import multiprocessing
+import time
+import traceback
+
+import click
+
+from .accounts import default_sessions
+from .journal import Deadline
+from .plan import build_plan
+from .plan import execute
+from .s3snapshot import FAULT
+from .s3snapshot import VERBOSE
+from .s3snapshot import RunTotals
+from .s3snapshot import emit_metrics
+from .s3snapshot import notify
+from .s3snapshot import parse_event
+from .s3snapshot import run_parallel
+
+# Volumes per shard when the number of shards is not given
+SHARD_VOLUMES = 2000
+PROCESSES = 4
+DISPATCH_CONCURRENCY = 20
+# Seconds a synchronous invocation of a worker can take (the Lambda timeout)
+INVOKE_TIMEOUT = 900
+DISPATCHER = 'local'
+# Backend used by default inside Lambda (no shared memory for the local processes)
+LAMBDA_DISPATCHER = 'lambda'
+# Seconds kept by the coordinator after the workers (aggregation and SNS message)
+COORDINATOR_MARGIN = 60
+# Keys of the coordinator event not given to the workers
+COORDINATOR_KEYS = ('action', 'dispatcher', 'shards', 'shard-volumes', 'plan', 'continuation-token')
+# Sessions inherited by the local worker processes (fork), None to create new ones in each worker
+WORKER_SESSIONS = None
+
+
+def split_plan(data, count):
+    """
+    Split the plan in up to count shards balanced by the number of volumes
+    All the volumes of an instance stay in the same shard, so the instance is stopped and started once
+    Return the list of plans of the shards (the largest instances are placed first in the lightest shard)
+    """
+    items = [(len(instance['volumes']), position, index, instance)
+             for index, target in enumerate(data['targets'])
+             for position, instance in enumerate(target['instances'])]
+    items.sort(key=lambda item: (-item[0], item[2], item[1]))
+
+    loads = [(0, number) for number in range(max(1, count))]
+    assigned = [list() for _ in loads]
+    for size, position, index, instance in items:
+        load, number = heapq.heappop(loads)
+        assigned[number].append((index, position, instance))
+        heapq.heappush(loads, (load + size, number))
+
+    shards = list()
+    for items in assigned:
+        if not items:
+            continue
+        by_target = dict()
+        for index, position, instance in sorted(items, key=lambda item: item[:2]):
+            by_target.setdefault(index, []).append(instance)
+        targets = list()
+        for index, instances in sorted(by_target.items()):
+            target = dict(data['targets'][index], instances=instances, skipped=[], duplicates=[])
+            target['total-instances'] = len(instances)
+            targets.append(target)
+        shards.append(dict(data, targets=targets, volumes=sum(
+            len(instance['volumes']) for target in targets for instance in target['instances'])))
+    return shards
+
+
+def run_worker(args):
+    """
+    Execute one shard in a worker process of the local dispatcher
+    """
+    event, program = args
+    try:
+        return execute(event=event, start_time=time.time(), program=program, sessions=WORKER_SESSIONS)
+    except Exception:
+        return {'result': FAULT, 'error': traceback.format_exc()}
+
+
+class LocalDispatcher(object):
+    def __init__(self, processes=PROCESSES, sessions=None):
+        """
+        Execute the shards in a pool of local processes (tests and single host runs)
+        sessions are inherited by the workers when the processes are forked (ex: FakeSessions)
+        """
+        self.processes = int(processes)
+        self.sessions = sessions
+
+    def run(self, events, program=''):
+        global WORKER_SESSIONS
+        WORKER_SESSIONS = self.sessions
+        pool = multiprocessing.Pool(min(self.processes, len(events)) or 1)
+        try:
+            return pool.map(run_worker, [(event, program) for event in events])
+        finally:
+            pool.close()
+            pool.join()
+            WORKER_SESSIONS = None
+
+
+class LambdaDispatcher(object):
+    def __init__(self, function=None, qualifier=None, concurrency=DISPATCH_CONCURRENCY, region=None, sessions=None):
+        """
+        Execute each shard with a synchronous invocation of the Lambda function
+        (the action execute of lambda_handler, by default the function of the coordinator)
+        """
+        self.function = function
+        self.qualifier = qualifier
+        self.concurrency = int(concurrency)
+        self.region = region
+        self.sessions = sessions
+
+    def run(self, events, program=''):
+        # The invocations last up to the timeout of the function and are not retried by the client
+        client = (self.sessions or default_sessions()).client('lambda', region=self.region, config={
+            'read-timeout': INVOKE_TIMEOUT + 60, 'max-attempts': 1, 'pool-size': self.concurrency})
+
+        def invoke(event):
+            # The handler returns the whole result of the shard instead of its message
+            kwargs = {'FunctionName': self.function, 'InvocationType': 'RequestResponse',
+                      'Payload': json.dumps(dict(event, **{'full-result': True}))}
+            if self.qualifier:
+                kwargs['Qualifier'] = self.qualifier
+            try:
+                response = client.invoke(**kwargs)
+                payload = json.loads(response['Payload'].read() or '{}')
+            except Exception:
+                return {'result': FAULT, 'error': traceback.format_exc()}
+            if response.get('FunctionError'):
+                return {'result': FAULT, 'error': '{0}: {1}'.format(
+                    payload.get('errorType', response['FunctionError']), payload.get('errorMessage', ''))}
+            return payload
+
+        return run_parallel(invoke, events, min(self.concurrency, len(events)) or 1)
+
+
+# Backends available with the event key dispatcher: {"backend": "<name>", ...}
+DISPATCHERS = {
+    'local': LocalDispatcher,
+    'lambda': LambdaDispatcher,
+}
+
+
+def dispatcher_backend(config=None, context=None, sessions=None):
+    """
+    Build the dispatcher from the event configuration ex: {"backend": "lambda", "function": "s3snapshot"}
+    The lambda backend invokes the function of the coordinator when no function is given
+    and shares the clients of the sessions (the local processes create their own)
+    Without backend the lambda backend is used when the coordinator runs in Lambda
+    """
+    config = dict(config or {})
+    name = config.pop('backend', LAMBDA_DISPATCHER if getattr(context, 'invoked_function_arn', None) else DISPATCHER)
+    if name not in DISPATCHERS:
+        raise ValueError('Unknown dispatcher {0}'.format(name))
+    if name == 'lambda':
+        config['sessions'] = sessions
+        if not config.get('function'):
+            config['function'] = getattr(context, 'invoked_function_arn', None)
+            if not config['function']:
+                raise ValueError('The lambda dispatcher needs a function')
+    return DISPATCHERS[name](**config)
+
+
+def shard_count(volumes, event):
+    if event.get('shards'):
+        return max(1, int(event['shards']))
+    shard_volumes = max(1, int(event.get('shard-volumes') or SHARD_VOLUMES))
+    return max(1, (volumes + shard_volumes - 1) // shard_volumes)
+
+
+def shard_totals(number, volumes, result):
+    """
+    Totals of one shard from the result of its worker
+    A worker that failed counts all the volumes of its shard as failures
+    """
+    totals = RunTotals(instances=result.get('instances', 0), volumes=volumes, name=str(number))
+    totals.success = result.get('success', 0)
+    totals.deferred = result.get('deferred', 0)
+    totals.failures = result.get('failures', volumes - totals.success - totals.deferred)
+    totals.tag_calls_saved = result.get('tag-calls-saved', 0)
+    totals.retries = result.get('throttling-retries', 0)
+    totals.errors.update(result.get('errors', {}))
+    if result.get('error'):
+        totals.add_error(result['error'])
+    if 'success' not in result:
+        totals.fault = True
+        if not result.get('error'):
+            totals.add_error('Worker of shard {0} failed: {1}'.format(number, result.get('result')))
+    return totals
+
+
+def shards_summary(totals):
+    msg_result = ''
+    for part in totals.parts:
+        msg_result += '[=] Shard {name:18} : {status} - {success}/{total} {unit}\n'.format(
+            name=part.name, status=part.status, success=part.success, total=part.volumes, unit=part.unit
+        )
+    return msg_result
+
+
+def coordinate(verbose=VERBOSE, start_time=time.time(), program='', event=None, context=None, sessions=None,
+               dispatcher=None):
+    """
+    Discover the volumes, split the plan in shards balanced by volumes (instances are not split)
+    and execute each shard with a worker of the dispatcher (event key dispatcher or dispatcher given)
+    The results of the workers are aggregated in one result and one SNS message
+    The event accepts the same keys of s3snapshot plus:
+    shards: int or shard-volumes: int (volumes per shard)
+    dispatcher: dict {"backend": "local", "processes": 4} or {"backend": "lambda", "function": name}
+    (by default lambda in Lambda and local elsewhere)
+    In Lambda (or with time-budget) the time-budget of the workers ends COORDINATOR_MARGIN seconds
+    before the coordinator, the workers defer the volumes left and return their continuation token
+    """
+    event = dict(event or {})
+    options = parse_event(event, verbose=verbose, program=program)
+    if options['invalid']:
+        return {'result': FAULT}
+    try:
+        dispatcher = dispatcher or dispatcher_backend(event.get('dispatcher'), context=context, sessions=sessions)
+    except Exception:
+        click.echo('[!] Unable to process. Invalid dispatcher configuration {0}'.format(event.get('dispatcher')))
+        return {'result': FAULT}
+
+    plan_totals, accounts, data = build_plan(options, event, sessions=sessions)
+    if data is None:
+        return {'result': FAULT}
+
+    shards = split_plan(data, shard_count(data['volumes'], event))
+    click.echo('[+] Dispatching {volumes} volumes in {shards} shards'.format(volumes=data['volumes'],
+                                                                              shards=len(shards)))
+    worker_event = dict((key, value) for key, value in event.items() if key not in COORDINATOR_KEYS)
+    remaining = Deadline(context, budget=options['time-budget']).remaining()
+    if remaining is not None:
+        # The workers must return before the coordinator times out: the volumes left are deferred
+        # with a continuation token in the result of their shard
+        budget = remaining - COORDINATOR_MARGIN
+        if budget <= options['time-margin']:
+            click.echo('[!] Unable to process. Not enough time left to dispatch the shards')
+            return {'result': FAULT}
+        worker_event['time-budget'] = min(budget, options['time-budget'] or budget)
+    events = [dict(worker_event, action='execute', plan=shard, notify=False) for shard in shards]
+    with options['metrics'].phase('dispatch'):
+        try:
+            results = dispatcher.run(events, program=program) if events else []
+        except Exception:
+            # Each shard fails with the error of the dispatcher (summary and SNS message are still sent)
+            click.echo('[!] Unable to dispatch the shards')
+            if options['verbose']:
+                click.echo('[!] {0}'.format(traceback.format_exc()))
+            results = [{'result': FAULT, 'error': traceback.format_exc()} for _ in events]
+
+    totals = RunTotals()
+    for number, (shard, result) in enumerate(zip(shards, results)):
+        totals.merge(shard_totals(number, shard['volumes'], result or {}))
+    # The instances and the volumes skipped are the ones of the discovery
+    totals.instances = plan_totals.instances
+    totals.skipped = plan_totals.skipped
+    msg_result = shards_summary(totals)
+    if plan_totals.faulted:
+        # Targets that could not be discovered
+        totals.errors.merge(plan_totals.errors)
+        totals.parts.append(plan_totals)
+
+    msg_result = totals.summary() + msg_result
+    click.echo(msg_result)
+
+    with options['metrics'].phase('notify'):
+        notify(options, totals, msg_result, start_time, event=event, context=context, sessions=sessions)
+    emit_metrics(options, context)
+
+    result = totals.to_dict()
+    result['shards'] = list()
+    for number, (shard, item) in enumerate(zip(shards, results)):
+        item = item or {}
+        shard_result = {'shard': number, 'volumes': shard['volumes'], 'result': item.get('result', FAULT)}
+        for key in ('success', 'failures', 'deferred', 'continuation-token'):
+            if key in item:
+                shard_result[key] = item[key]
+        result['shards'].append(shard_result)
+    result['expected-calls'] = data['expected-calls']
+    result['metrics'] = options['metrics'].to_dict()
+    result['errors'] = totals.errors.to_dict()
+    return result
@@ -39,7 +39,7 @@ setup(
     name='s3snapshot',
     version=find_version("s3snapshot", "__init__.py"),
     license='Apache Software License',
-    py_modules=['s3snapshot.s3snapshot', 's3snapshot.cli', 'lambda_handler'],
+    py_modules=['s3snapshot.s3snapshot', 's3snapshot.accounts', 's3snapshot.ratelimit', 's3snapshot.metrics', 's3snapshot.report', 's3snapshot.drcopy', 's3snapshot.hooks', 's3snapshot.filters', 's3snapshot.journal', 's3snapshot.cache', 's3snapshot.prune', 's3snapshot.plan', 's3snapshot.shard', 's3snapshot.daemon', 's3snapshot.cli', 'lambda_handler'],
     author='Rafael M. Koike',
     author_email='koiker@amazon.com',
     description='Snapshot script',
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+#
+# conftest.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Fixtures of the tests (see helpers.py)"""
+
+import pytest
+
+from tests.helpers import REGION
+from tests.helpers import make_sessions
+
+
+@pytest.fixture
+def sessions():
+    return make_sessions(stop_delay=0.05)
+
+
+@pytest.fixture
+def ec2(sessions):
+    return sessions.client('ec2', region=REGION)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# helpers.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+"""Helpers of the tests: the runs use the in-process fake of benchmarks.fake (no account or network needed)"""
+
+import time
+
+from benchmarks.fake import FakeSessions
+from benchmarks.fake import build_fleet
+
+REGION = 'us-east-1'
+COPY_REGION = 'us-west-2'
+VOLUMES = 8
+INSTANCES = VOLUMES // 2
+# The limiter starts at the maximum rates so the runs don't wait for the tokens
+RATE_LIMITS = {'describe': 100, 'create-snapshot': 50, 'tagging': 50, 'instance-state': 20, 'delete-snapshot': 20}
+
+
+def make_event(**keys):
+    """
+    Return the event of a run in REGION (the keys use the names of the event ex: **{'keep-last': 1})
+    """
+    event = {'regions': [REGION], 'rate-limits': RATE_LIMITS}
+    event.update(keys)
+    return event
+
+
+def make_sessions(volumes=VOLUMES, regions=(REGION,), **kwargs):
+    """
+    Return FakeSessions with a fleet of the volumes given in the regions (no instance in the other regions)
+    The keyword arguments are given to FakeSessions (ex: ssm, stop_delay)
+    """
+    return FakeSessions(fleet=lambda role_arn, region: build_fleet(volumes) if region in regions else [],
+                        **kwargs)
+
+
+def names(client):
+    """
+    Name tags of the snapshots of the fake EC2 client
+    """
+    return [tag['Value'] for snapshot in client.snapshots.values() for tag in snapshot['Tags']
+            if tag['Key'] == 'Name']
+
+
+class Recorder(object):
+    def __init__(self, function):
+        """
+        Wrap a method of a fake client and keep the keyword arguments of each call
+        """
+        self.function = function
+        self.calls = list()
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.function(**kwargs)
+
+
+class LambdaContext(object):
+    def __init__(self, seconds):
+        """
+        Lambda context with seconds left before the timeout of the invocation
+        """
+        self.end = time.time() + seconds
+        self.log_stream_name = 'stream'
+        self.log_group_name = 'group'
+        self.aws_request_id = 'request'
+        self.memory_limit_in_mb = 128
+
+    def get_remaining_time_in_millis(self):
+        return int((self.end - time.time()) * 1000)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# test_accounts.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import collections
+import threading
+import time
+
+import pytest
+
+from s3snapshot import accounts
+from s3snapshot.accounts import AccountSessions
+from s3snapshot.accounts import account_id
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import run_parallel
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import make_sessions
+
+ROLES = ['arn:aws:iam::{0:012d}:role/Snapshot'.format(number) for number in range(1, 5)]
+ASSUME_TIME = 0.2
+
+
+class StubSession(object):
+    def __init__(self, *args, **kwargs):
+        """
+        boto3 session without credentials or network (the clients are plain objects)
+        """
+
+    def client(self, service, region_name=None, config=None):
+        return object()
+
+
+class AssumeRole(object):
+    def __init__(self):
+        """
+        Slow AssumeRole keeping the number of calls per role and the peak of the calls at the same time
+        """
+        self.calls = collections.Counter()
+        self.current = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, role_arn, session_name=None, duration=None, sts_client=None):
+        with self.lock:
+            self.calls[role_arn] += 1
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        time.sleep(ASSUME_TIME)
+        with self.lock:
+            self.current -= 1
+        return StubSession()
+
+
+@pytest.fixture
+def assume_role(monkeypatch):
+    assume_role = AssumeRole()
+    monkeypatch.setattr(accounts.boto3.session, 'Session', StubSession)
+    monkeypatch.setattr(accounts, 'assume_role_session', assume_role)
+    return assume_role
+
+
+def test_roles_are_assumed_in_parallel_and_once(assume_role):
+    sessions = AccountSessions()
+    # Three workers per account ask for a client at the same time
+    clients = run_parallel(lambda role_arn: sessions.client('ec2', region='us-east-1', role_arn=role_arn),
+                           ROLES * 3, concurrency=len(ROLES) * 3)
+
+    assert assume_role.calls == collections.Counter(dict((role_arn, 1) for role_arn in ROLES))
+    assert assume_role.peak == len(ROLES)
+    # The workers of the same account share the client
+    assert len(set(id(client) for client in clients)) == len(ROLES)
+
+
+def test_cached_clients_do_not_wait_for_an_assume_role(assume_role):
+    sessions = AccountSessions()
+    cached = sessions.client('ec2', region='us-east-1')
+    thread = threading.Thread(target=sessions.client, args=('ec2', 'us-east-1', ROLES[0]))
+    thread.start()
+    time.sleep(ASSUME_TIME / 4)
+
+    start = time.time()
+    assert sessions.client('ec2', region='us-east-1') is cached
+    assert time.time() - start < ASSUME_TIME / 2
+    thread.join()
+
+
+def test_accounts_are_snapshotted_in_one_run():
+    sessions = make_sessions()
+    result = s3snapshot(event=make_event(accounts=ROLES[:2]), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['success'] == 2 * VOLUMES
+    assert sorted(result['accounts']) == sorted(account_id(role_arn) for role_arn in ROLES[:2])
+    assert sorted(role_arn for role_arn, region in sessions.ec2) == sorted(ROLES[:2])
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+#
+# test_bench.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+from benchmarks.bench import RATE_LIMITS as BENCH_RATE_LIMITS
+from benchmarks.bench import run_benchmark
+from benchmarks.fake import FakeEC2
+from benchmarks.fake import build_fleet
+from s3snapshot.s3snapshot import SUCCESS
+from tests.helpers import REGION
+from tests.helpers import VOLUMES
+
+
+def test_the_benchmark_measures_the_run():
+    event = {'regions': [REGION], 'rate-limits': BENCH_RATE_LIMITS}
+    measures = run_benchmark(VOLUMES, event, per_instance=2, latency=0.0, limits=None, stop_delay=0.0)
+
+    assert measures['result'] == SUCCESS
+    assert measures['success'] == VOLUMES
+    assert measures['calls-per-volume']['create_snapshot'] == 1.0
+    assert measures['throttled'] == 0
+    assert measures['peak-memory-mb'] > 0
+
+
+def test_only_the_snapshots_described_complete():
+    ec2 = FakeEC2(build_fleet(VOLUMES))
+    first, second = [ec2.create_snapshot(VolumeId=volume_id)['SnapshotId']
+                     for volume_id in ('vol-0000000000', 'vol-0000000001')]
+
+    snapshots = ec2.describe_snapshots(SnapshotIds=[first])['Snapshots']
+    assert [snapshot['State'] for snapshot in snapshots] == ['completed']
+    assert ec2.snapshots[second]['State'] == 'pending'
+
+
+def test_the_snapshots_complete_after_the_delay():
+    ec2 = FakeEC2(build_fleet(VOLUMES), complete_delay=60)
+    snapshot_id = ec2.create_snapshot(VolumeId='vol-0000000000')['SnapshotId']
+
+    assert ec2.describe_snapshots(SnapshotIds=[snapshot_id])['Snapshots'][0]['State'] == 'pending'
+    ec2.created[snapshot_id] -= 60
+    assert ec2.describe_snapshots(SnapshotIds=[snapshot_id])['Snapshots'][0]['State'] == 'completed'
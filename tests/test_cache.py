@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# test_cache.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import time
+
+import pytest
+
+from s3snapshot.cache import InventoryCache
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+
+SCOPE = 'self/us-east-1'
+FILTERS = [{'Name': 'tag:Snapshot', 'Values': ['True']}]
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('inventory.db'))
+
+
+def count(cache, table):
+    return cache.connection.execute('SELECT COUNT(*) FROM {0}'.format(table)).fetchone()[0]
+
+
+def test_the_entries_older_than_the_ttl_are_evicted(path):
+    cache = InventoryCache(path, ttl=0.2)
+    cache.put_instances(SCOPE, FILTERS, [('111111111111', {'InstanceId': 'i-00000000'})])
+    cache.put_names(SCOPE, '2017-01-01', {'vol-0000000000': '0001'})
+    assert cache.get_instances(SCOPE, FILTERS) == [('111111111111', {'InstanceId': 'i-00000000'})]
+    assert cache.get_names(SCOPE, '2017-01-01', ['vol-0000000000']) == {'vol-0000000000': '0001'}
+
+    time.sleep(0.3)
+    # Expired entries are never returned, and are removed when the cache is opened again
+    assert cache.get_instances(SCOPE, FILTERS) is None
+    assert cache.get_names(SCOPE, '2017-01-01', ['vol-0000000000']) == {}
+    cache.close()
+    cache = InventoryCache(path, ttl=0.2)
+    assert count(cache, 'instances') == 0
+    assert count(cache, 'snapshot_names') == 0
+    cache.close()
+
+
+def test_the_second_run_reads_the_instances_from_the_cache(sessions, ec2, path):
+    s3snapshot(event=make_event(cache=path), sessions=sessions)
+    describes = ec2.calls['describe_instances']
+
+    result = s3snapshot(event=make_event(cache=path), sessions=sessions)
+    assert result['result'] == SUCCESS
+    assert result['success'] == VOLUMES
+    assert ec2.calls['describe_instances'] == describes
+
+
+def test_the_cached_states_are_refreshed_for_stopped(sessions, ec2, path):
+    s3snapshot(event=make_event(cache=path), sessions=sessions)
+    # Stopped after its state was cached as running
+    ec2.instances['i-00000000']['State'] = {'Name': 'stopped'}
+
+    result = s3snapshot(event=make_event(cache=path, stopped=True), sessions=sessions)
+    assert result['success'] == 2
+    assert result['failures'] == VOLUMES - 2
+    assert sorted(ec2.by_volume['vol-0000000000']) == sorted(set(ec2.by_volume['vol-0000000000']))
+    assert len(ec2.by_volume['vol-0000000000']) == 2
+    assert len(ec2.by_volume['vol-0000000100']) == 1
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# test_client_config.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import pytest
+from botocore.exceptions import EndpointConnectionError
+
+from benchmarks.fake import client_error
+from s3snapshot import ratelimit
+from s3snapshot.accounts import POOL_MARGIN
+from s3snapshot.accounts import AccountSessions
+from s3snapshot.ratelimit import RateLimiter
+from s3snapshot.ratelimit import ThrottledClient
+from s3snapshot.ratelimit import throttled_client
+from tests.helpers import REGION
+
+
+@pytest.fixture(autouse=True)
+def credentials(monkeypatch):
+    # The clients are created without any call: no credential lookup or network
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setattr(ratelimit, 'BASE_DELAY', 0.001)
+
+
+class FlakyEC2(object):
+    def __init__(self, *errors):
+        """
+        Client whose calls fail with the errors given, then succeed
+        """
+        self.errors = list(errors)
+        self.calls = 0
+
+    def describe_instances(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'Reservations': []}
+
+
+def test_the_clients_are_shared_and_sized_to_the_workers():
+    sessions = AccountSessions(config={'read-timeout': 30})
+    sessions.configure({'read-timeout': 30}, pool_size=20)
+    client = sessions.client('ec2', region=REGION)
+
+    assert sessions.client('ec2', region=REGION) is client
+    assert client.meta.config.max_pool_connections == 20 + POOL_MARGIN
+    assert client.meta.config.read_timeout == 30
+    assert client.meta.config.retries == {'mode': 'standard', 'total_max_attempts': 3}
+
+    # Same settings: the client and its connections are kept
+    sessions.configure({'read-timeout': 30}, pool_size=20)
+    assert sessions.client('ec2', region=REGION) is client
+    sessions.configure({'read-timeout': 30}, pool_size=40)
+    assert sessions.client('ec2', region=REGION).meta.config.max_pool_connections == 40 + POOL_MARGIN
+
+
+def test_the_throttled_clients_do_not_retry():
+    sessions = AccountSessions(config={'retry-mode': 'adaptive', 'max-attempts': 10})
+    client = throttled_client(sessions, 'ec2', RateLimiter(), region=REGION)
+
+    assert isinstance(client, ThrottledClient)
+    assert client.client.meta.config.retries == {'mode': 'legacy', 'total_max_attempts': 1}
+    # The other clients keep the retries of the settings
+    assert sessions.client('ec2', region=REGION).meta.config.retries == {'mode': 'adaptive',
+                                                                         'total_max_attempts': 10}
+
+
+def test_the_limiter_retries_the_transient_errors():
+    ec2 = FlakyEC2(client_error('InternalError', 'DescribeInstances'),
+                   EndpointConnectionError(endpoint_url='https://ec2.us-east-1.amazonaws.com'))
+    limiter = RateLimiter()
+
+    assert ThrottledClient(ec2, limiter).describe_instances() == {'Reservations': []}
+    assert ec2.calls == 3
+    assert limiter.retries == 2
+    assert limiter.throttles == 0
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#
+# test_completion.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+from s3snapshot.s3snapshot import PARTIAL
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import REGION
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import make_sessions
+
+
+def test_the_completion_is_polled_in_batches(sessions, ec2):
+    result = s3snapshot(event=make_event(**{'track-completion': True}), sessions=sessions)
+    completion = result['completion']
+
+    assert result['result'] == SUCCESS
+    assert completion['completed'] == VOLUMES
+    assert completion['completed-gb'] == VOLUMES * 8
+    assert completion['failed'] == [] and completion['stragglers'] == []
+    # One DescribeSnapshots for the names of the volumes and one poll for all the snapshots of the region
+    assert ec2.calls['describe_snapshots'] == 2
+    assert all(snapshot['State'] == 'completed' for snapshot in ec2.snapshots.values())
+
+
+def test_the_snapshots_in_error_are_failures(sessions, ec2, monkeypatch):
+    create_snapshot = ec2.create_snapshot
+
+    def failing_create_snapshot(**kwargs):
+        response = create_snapshot(**kwargs)
+        if kwargs['VolumeId'] == 'vol-0000000000':
+            ec2.snapshots[response['SnapshotId']].update(State='error', StateMessage='Internal error')
+        return response
+
+    monkeypatch.setattr(ec2, 'create_snapshot', failing_create_snapshot)
+    result = s3snapshot(event=make_event(**{'track-completion': True}), sessions=sessions)
+
+    assert result['result'] == PARTIAL
+    assert result['success'] == VOLUMES - 1
+    assert result['failures'] == 1
+    assert [record['volume-id'] for record in result['completion']['failed']] == ['vol-0000000000']
+    assert result['completion']['failed'][0]['message'] == 'Internal error'
+    assert result['completion']['completed'] == VOLUMES - 1
+
+
+def test_the_snapshots_pending_at_the_timeout_are_stragglers():
+    sessions = make_sessions(complete_delay=60)
+    result = s3snapshot(event=make_event(**{'track-completion': True, 'completion-timeout': 0.1}),
+                        sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['completion']['completed'] == 0
+    assert len(result['completion']['stragglers']) == VOLUMES
+    assert all(record['state'] == 'pending' for record in result['completion']['stragglers'])
+    assert sessions.client('ec2', region=REGION).calls['describe_snapshots'] == 2
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# test_concurrency.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import threading
+import time
+
+import pytest
+
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import run_parallel
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import REGION
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import make_sessions
+from tests.helpers import names
+
+
+class InFlight(object):
+    def __init__(self, function, latency=0.05):
+        """
+        Wrap a fake API call and keep the peak of the calls in flight at the same time
+        """
+        self.function = function
+        self.latency = latency
+        self.current = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, **kwargs):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        try:
+            time.sleep(self.latency)
+            return self.function(**kwargs)
+        finally:
+            with self.lock:
+                self.current -= 1
+
+
+@pytest.mark.parametrize('concurrency', [1, 3])
+def test_workers_are_bounded_by_the_concurrency(concurrency, monkeypatch):
+    sessions = make_sessions(volumes=2 * VOLUMES)
+    ec2 = sessions.client('ec2', region=REGION)
+    in_flight = InFlight(ec2.create_snapshot)
+    monkeypatch.setattr(ec2, 'create_snapshot', in_flight)
+
+    result = s3snapshot(event=make_event(concurrency=concurrency), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['success'] == 2 * VOLUMES
+    assert in_flight.peak == concurrency
+    assert len(set(names(ec2))) == 2 * VOLUMES
+
+
+def test_run_parallel_keeps_the_order_and_raises_the_errors():
+    assert run_parallel(lambda item: item * 2, iter(range(20)), concurrency=4) == [item * 2 for item in range(20)]
+
+    def fail(item):
+        if item == 3:
+            raise ValueError(item)
+
+    with pytest.raises(ValueError):
+        run_parallel(fail, range(10), concurrency=4)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# test_daemon.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import threading
+
+import pytest
+
+from s3snapshot.accounts import AccountSessions
+from s3snapshot.daemon import BLOCKED_DELAY
+from s3snapshot.daemon import Daemon
+from s3snapshot.daemon import Job
+from s3snapshot.daemon import jitter
+from s3snapshot.s3snapshot import SUCCESS
+from tests.helpers import REGION
+from tests.helpers import make_event
+from tests.helpers import make_sessions
+
+DAY = 86400
+# 02:00 UTC of a day
+SLOT = 100 * DAY + 7200
+
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class GatedDaemon(Daemon):
+    def __init__(self, *args, **kwargs):
+        """
+        Daemon whose inventory refreshes wait for the gate
+        """
+        super(GatedDaemon, self).__init__(*args, **kwargs)
+        self.gate = threading.Event()
+
+    def refresh(self, job):
+        self.gate.wait(10)
+        super(GatedDaemon, self).refresh(job)
+
+
+def schedule(tmpdir, *jobs):
+    return {'window': 0, 'cache': str(tmpdir.join('daemon.db')), 'event': make_event(),
+            'jobs': [dict({'at': '02:00'}, **job) for job in jobs]}
+
+
+def wait(daemon):
+    for thread in list(daemon.refreshing.values()):
+        thread.join(10)
+    while daemon.running:
+        threading.Event().wait(0.01)
+
+
+def test_the_jitter_spreads_the_jobs_in_the_window():
+    offsets = [jitter('job-{0}'.format(number), 600) for number in range(50)]
+
+    assert all(0 <= offset < 600 for offset in offsets)
+    assert len(set(offsets)) > 25
+    assert jitter('job-1', 600) == offsets[1]
+    job = Job('job-1', event=make_event(), at='02:00', window=600)
+    assert job.schedule(SLOT) == SLOT + offsets[1]
+    # A slot missed is skipped
+    assert job.schedule(SLOT + offsets[1] + 1) == SLOT + DAY + offsets[1]
+
+
+def test_the_refresh_does_not_block_the_scheduler(tmpdir):
+    daemon = GatedDaemon(schedule(tmpdir, {'name': 'slow'}, {'name': 'other', 'at': '03:00'}),
+                         sessions=make_sessions(), clock=Clock(SLOT))
+
+    # The job waits for its inventory, the scheduler does not
+    assert daemon.step() == BLOCKED_DELAY
+    assert 'slow' in daemon.refreshing and not daemon.running
+    daemon.gate.set()
+    wait(daemon)
+
+    daemon.step()
+    wait(daemon)
+    assert [(name, result['result']) for name, _, result in daemon.results] == [('slow', SUCCESS)]
+
+
+def test_the_jobs_on_the_same_instances_are_serialized(tmpdir):
+    sessions = make_sessions()
+    daemon = GatedDaemon(schedule(tmpdir, {'name': 'first', 'event': {'instances': ['i-00000000', 'i-00000001']}},
+                                  {'name': 'second', 'event': {'instances': ['i-00000000', 'i-00000001']}},
+                                  {'name': 'other', 'event': {'instances': ['i-00000003']}},
+                                  {'name': 'third', 'event': {'instances': ['i-00000001', 'i-00000002']}}),
+                         sessions=sessions, clock=Clock(SLOT))
+    daemon.max_jobs = 4
+    daemon.gate.set()
+    daemon.step()
+    for thread in list(daemon.refreshing.values()):
+        thread.join(10)
+
+    # Hold the runs to see the jobs started together
+    release = threading.Event()
+    ec2 = sessions.client('ec2', region=REGION)
+    create_snapshot = ec2.create_snapshot
+
+    def held_create_snapshot(**kwargs):
+        release.wait(10)
+        return create_snapshot(**kwargs)
+
+    ec2.create_snapshot = held_create_snapshot
+    daemon.step()
+    assert sorted(daemon.running) == ['first', 'other']
+    release.set()
+    wait(daemon)
+
+    # second and third share an instance too: one job per step
+    for count in (3, 4):
+        daemon.step()
+        wait(daemon)
+        assert len(daemon.results) == count
+    assert [name for name, _, _ in daemon.results][2:] == ['second', 'third']
+    assert all(result['result'] == SUCCESS for _, _, result in daemon.results)
+
+
+@pytest.fixture
+def credentials(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+
+
+def test_each_job_keeps_its_client_settings(credentials):
+    sessions = AccountSessions()
+    fast = sessions.configured({'read-timeout': 5}, pool_size=4)
+    slow = sessions.configured({'read-timeout': 900}, pool_size=4)
+
+    client = fast.client('ec2', region=REGION)
+    assert slow.client('ec2', region=REGION).meta.config.read_timeout == 900
+    # The settings of one job don't replace the client of the other job
+    assert fast.client('ec2', region=REGION) is client
+    assert client.meta.config.read_timeout == 5
+    assert sessions.client('ec2', region=REGION).meta.config.read_timeout == 60
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+# test_discovery.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+from benchmarks.fake import FakeSessions
+from benchmarks.fake import build_fleet
+from s3snapshot.ratelimit import RateLimiter
+from s3snapshot.ratelimit import throttled_client
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import iter_instances
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import RATE_LIMITS
+from tests.helpers import REGION
+from tests.helpers import make_event
+
+VOLUMES = 40
+INSTANCES = 20
+
+
+def shared_reservations(role_arn, region):
+    """
+    Fleet of INSTANCES instances with two instances per reservation
+    """
+    reservations = build_fleet(VOLUMES)
+    return [{'OwnerId': first['OwnerId'], 'Instances': first['Instances'] + second['Instances']}
+            for first, second in zip(reservations[::2], reservations[1::2])]
+
+
+def test_every_instance_of_every_reservation_and_page():
+    sessions = FakeSessions(fleet=shared_reservations)
+    result = s3snapshot(event=make_event(**{'page-size': 5}), sessions=sessions)
+    ec2 = sessions.client('ec2', region=REGION)
+
+    assert result['result'] == SUCCESS
+    assert result['instances'] == INSTANCES
+    assert result['volumes'] == VOLUMES
+    # 10 reservations in pages of 5
+    assert ec2.calls['describe_instances'] == 2
+    assert len(ec2.snapshots) == VOLUMES
+
+
+def test_instances_are_streamed_page_by_page():
+    sessions = FakeSessions(fleet=shared_reservations)
+    client = throttled_client(sessions, 'ec2', RateLimiter(RATE_LIMITS), region=REGION)
+    instances = iter_instances(client, [], page_size=5)
+
+    owner_id, instance = next(instances)
+    assert instance['InstanceId'] == 'i-00000000'
+    assert sessions.client('ec2', region=REGION).calls['describe_instances'] == 1
+    assert len(list(instances)) == INSTANCES - 1
+    assert sessions.client('ec2', region=REGION).calls['describe_instances'] == 2
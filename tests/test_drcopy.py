@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# test_drcopy.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import collections
+
+from benchmarks.fake import FakeEC2
+from benchmarks.fake import build_fleet
+from s3snapshot.drcopy import COPY_VOLUME_ID
+from s3snapshot.drcopy import SOURCE_VOLUME_TAG
+from s3snapshot.drcopy import CopyScheduler
+from s3snapshot.drcopy import CopySlots
+from s3snapshot.prune import prune
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import COPY_REGION
+from tests.helpers import REGION
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+
+
+def source_volumes(client):
+    """
+    Number of copies of each source volume (tag SourceVolumeId)
+    """
+    return collections.Counter(tag['Value'] for snapshot in client.snapshots.values()
+                               for tag in snapshot['Tags'] if tag['Key'] == SOURCE_VOLUME_TAG)
+
+
+def test_copies_are_tagged_with_their_source_volume(sessions, ec2):
+    assert s3snapshot(event=make_event(**{'copy-regions': [COPY_REGION]}), sessions=sessions)['result'] == SUCCESS
+    copies = sessions.client('ec2', region=COPY_REGION)
+
+    assert len(copies.snapshots) == VOLUMES
+    assert all(snapshot['VolumeId'] == COPY_VOLUME_ID for snapshot in copies.snapshots.values())
+    assert set(source_volumes(copies)) == set(ec2.by_volume)
+
+
+def test_prune_of_the_copies_per_source_volume(sessions):
+    for _ in range(3):
+        assert s3snapshot(event=make_event(**{'copy-regions': [COPY_REGION]}), sessions=sessions)['result'] == SUCCESS
+    copies = sessions.client('ec2', region=COPY_REGION)
+
+    result = prune(event=make_event(regions=[COPY_REGION], **{'keep-last': 2}), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['volumes'] == VOLUMES
+    assert result['deleted'] == VOLUMES
+    assert sorted(source_volumes(copies).values()) == [2] * VOLUMES
+
+
+def test_the_copies_stay_within_the_limit_of_the_destination():
+    source = FakeEC2(build_fleet(VOLUMES))
+    snapshot_ids = [source.new_snapshot(volume['VolumeId'], '', [])['SnapshotId'] for volume in source.volumes()]
+    destination = FakeEC2(copy_limit=2)
+    copy_snapshot = destination.copy_snapshot
+    pending = list()
+
+    def counting_copy_snapshot(**kwargs):
+        response = copy_snapshot(**kwargs)
+        pending.append(len([snapshot for snapshot in destination.snapshots.values()
+                            if snapshot['State'] == 'pending']))
+        return response
+
+    destination.copy_snapshot = counting_copy_snapshot
+    slots = CopySlots(limit=4)
+    scheduler = CopyScheduler(source, REGION, {COPY_REGION: destination}, slots, delay=0.01)
+    records = scheduler.run(dict((snapshot_id, []) for snapshot_id in snapshot_ids))
+
+    assert sorted(record['state'] for record in records) == ['completed'] * VOLUMES
+    assert len(destination.snapshots) == VOLUMES
+    assert max(pending) == 2
+    # The copies refused lowered the limit of the destination, the copies completed raised it again
+    assert slots.limits[(None, COPY_REGION)] <= 4
+    assert slots.inflight[(None, COPY_REGION)] == 0
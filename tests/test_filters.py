@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# test_filters.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import pytest
+
+from benchmarks.fake import FakeSessions
+from benchmarks.fake import build_fleet
+from s3snapshot.filters import MAX_VALUES
+from s3snapshot.filters import compile_selection
+from s3snapshot.s3snapshot import FAULT
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import INSTANCES
+from tests.helpers import REGION
+from tests.helpers import Recorder
+from tests.helpers import make_event
+
+# Root (gp3, 8 GiB), gp2 (100 GiB) and st1 (500 GiB) volume of each instance
+PER_INSTANCE = 3
+
+
+@pytest.fixture
+def sessions():
+    return FakeSessions(fleet=lambda role_arn, region: build_fleet(INSTANCES * PER_INSTANCE,
+                                                                   per_instance=PER_INSTANCE))
+
+
+@pytest.fixture
+def ec2(sessions, monkeypatch):
+    ec2 = sessions.client('ec2', region=REGION)
+    for name in ('describe_instances', 'describe_volumes'):
+        monkeypatch.setattr(ec2, name, Recorder(getattr(ec2, name)))
+    return ec2
+
+
+def snapshotted(ec2):
+    return sorted(volume_id for volume_id, snapshot_ids in ec2.by_volume.items() if snapshot_ids)
+
+
+def test_small_size_ranges_are_filtered_by_ec2(sessions, ec2):
+    result = s3snapshot(event=make_event(**{'min-size': 50, 'max-size': 200}), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['instances'] == INSTANCES
+    assert snapshotted(ec2) == ['vol-{0:08x}01'.format(number) for number in range(INSTANCES)]
+    # Volume discovery: the sizes are sent to DescribeVolumes and only the instances of the volumes are described
+    filters = dict((item['Name'], item['Values']) for item in ec2.describe_volumes.calls[0]['Filters'])
+    assert filters['size'] == [str(size) for size in range(50, 201)]
+    assert len(ec2.describe_instances.calls) == 1
+
+
+def test_large_size_ranges_are_evaluated_locally(sessions, ec2):
+    selection = compile_selection({'min-size': 400})
+    assert selection.volume_filters == [] and selection.min_size == 400
+    assert 'size' not in [item['Name'] for item in compile_selection({'max-size': MAX_VALUES + 1}).volume_filters]
+
+    result = s3snapshot(event=make_event(**{'min-size': 400}), sessions=sessions)
+    assert result['result'] == SUCCESS
+    assert snapshotted(ec2) == ['vol-{0:08x}02'.format(number) for number in range(INSTANCES)]
+
+
+def test_types_devices_and_negated_tags(sessions, ec2):
+    result = s3snapshot(event=make_event(**{'volume-types': ['gp3', 'st1'], 'exclude-devices': ['/dev/xvd[a]']}),
+                        sessions=sessions)
+    assert result['success'] == INSTANCES
+    assert snapshotted(ec2) == ['vol-{0:08x}02'.format(number) for number in range(INSTANCES)]
+
+    result = s3snapshot(event=make_event(tags={'!tag:Env': 'PROD'}), sessions=sessions)
+    assert result['result'] == SUCCESS
+    assert result['volumes'] == 0
+
+
+def test_an_invalid_selection_is_a_fault(sessions):
+    assert s3snapshot(event=make_event(**{'volume-scope': 'boot'}), sessions=sessions)['result'] == FAULT
+    assert s3snapshot(event=make_event(tags={'!instance-type': 't2.micro'}), sessions=sessions)['result'] == FAULT
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#
+# test_hooks.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import pytest
+
+from benchmarks.fake import FakeSessions
+from benchmarks.fake import build_fleet
+from s3snapshot.s3snapshot import PARTIAL
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import REGION
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+
+
+def hooks_sessions(failures=None):
+    return FakeSessions(fleet=lambda role_arn, region: build_fleet(VOLUMES), ssm={'failures': failures})
+
+
+def invocations(ssm):
+    """
+    Finish time of the freeze and thaw of each instance
+    """
+    times = dict()
+    for finished, instance_id, comment in ssm.history:
+        times.setdefault(instance_id, dict())[comment.split()[-1]] = finished
+    return times
+
+
+@pytest.mark.parametrize('hooks', [True, {'timeout': 30, 'thaw-after': 60}])
+def test_instances_are_frozen_during_the_snapshot(hooks):
+    sessions = hooks_sessions()
+    result = s3snapshot(event=make_event(hooks=hooks), sessions=sessions)
+    ec2 = sessions.client('ec2', region=REGION)
+
+    assert result['result'] == SUCCESS
+    assert result['hooks']['frozen'] == VOLUMES // 2
+    assert len(ec2.snapshots) == VOLUMES
+    times = invocations(sessions.client('ssm', region=REGION))
+    assert sorted(times) == sorted(ec2.instances)
+    for instance_id, invocation in times.items():
+        assert invocation['freeze'] <= invocation['thaw']
+        assert len([snapshot for snapshot in ec2.snapshots.values() if instance_id in snapshot['Description']]) == 2
+
+
+def test_failed_freeze_skips_the_instance():
+    sessions = hooks_sessions(failures=['i-00000001'])
+    result = s3snapshot(event=make_event(hooks=True), sessions=sessions)
+    ec2 = sessions.client('ec2', region=REGION)
+
+    assert result['result'] == PARTIAL
+    assert result['failures'] == 2
+    assert result['hooks']['freeze-failed'] == ['i-00000001']
+    assert not any('i-00000001' in snapshot['Description'] for snapshot in ec2.snapshots.values())
+    # The instance is thawed even when its freeze failed
+    assert 'thaw' in invocations(sessions.client('ssm', region=REGION))['i-00000001']
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# test_journal.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import time
+
+import pytest
+
+from s3snapshot import s3snapshot as module
+from s3snapshot.journal import Deadline
+from s3snapshot.s3snapshot import FAULT
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from s3snapshot.s3snapshot import wait_stopped
+from tests.helpers import LambdaContext
+from tests.helpers import REGION
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import make_sessions
+from tests.helpers import names
+
+
+@pytest.fixture
+def journal(tmpdir):
+    return {'store': 'file', 'path': str(tmpdir.join('journal'))}
+
+
+def test_the_run_resumes_from_the_continuation_token(journal):
+    sessions = make_sessions(latency=0.05)
+    ec2 = sessions.client('ec2', region=REGION)
+    first = s3snapshot(event=make_event(journal=journal, **{'time-budget': 1.2, 'time-margin': 1.0}),
+                       context=LambdaContext(900), sessions=sessions)
+
+    assert 0 < first['deferred'] < VOLUMES
+    assert first['success'] == VOLUMES - first['deferred']
+    token = first['continuation-token']
+
+    second = s3snapshot(event=make_event(journal=journal, **{'continuation-token': token}), sessions=sessions)
+    assert second['result'] == SUCCESS
+    assert second['success'] == first['deferred']
+    assert 'continuation-token' not in second
+    # Each volume is snapshotted once over the two invocations
+    assert sorted(ec2.by_volume) == sorted(set(ec2.by_volume))
+    assert all(len(snapshots) == 1 for snapshots in ec2.by_volume.values())
+    assert len(set(names(ec2))) == VOLUMES
+
+
+def test_an_unknown_continuation_token_is_a_fault(journal):
+    result = s3snapshot(event=make_event(journal=journal, **{'continuation-token': 'snapshot-unknown'}),
+                        sessions=make_sessions())
+    assert result['result'] == FAULT
+
+
+def test_the_wait_for_the_stop_ends_with_the_deadline(sessions):
+    ec2 = sessions.client('ec2', region=REGION)
+    ec2.stop_delay = 60
+    ec2.stop_instances(InstanceIds=['i-00000000'])
+    deadline = Deadline(LambdaContext(0.5), margin=0.2)
+
+    start = time.time()
+    assert list(wait_stopped(module.throttled_client(sessions, 'ec2', module.RateLimiter(), region=REGION),
+                             ['i-00000000'], delay=0.05, deadline=deadline)) == [('i-00000000', False)]
+    assert time.time() - start < 0.5
+
+
+def test_instances_still_stopping_are_deferred_and_started(journal, monkeypatch):
+    monkeypatch.setattr(module, 'STOP_DELAY', 0.05)
+    sessions = make_sessions(stop_delay=0.8)
+    ec2 = sessions.client('ec2', region=REGION)
+    first = s3snapshot(event=make_event(stop=True, journal=journal, **{'time-margin': 0.5}),
+                       context=LambdaContext(1.0), sessions=sessions)
+
+    assert first['deferred'] == VOLUMES
+    assert first['success'] == 0
+    assert len(ec2.snapshots) == 0
+    assert all(instance['State']['Name'] == 'running' for instance in ec2.instances.values())
+
+    ec2.stop_delay = 0.05
+    second = s3snapshot(event=make_event(stop=True, journal=journal,
+                                         **{'continuation-token': first['continuation-token']}),
+                        sessions=sessions)
+    assert second['result'] == SUCCESS
+    assert second['success'] == VOLUMES
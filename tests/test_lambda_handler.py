@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# test_lambda_handler.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import io
+import json
+
+import pytest
+
+import lambda_handler
+from s3snapshot import accounts
+from s3snapshot.shard import LambdaDispatcher
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import make_sessions
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    """
+    lambda_handler of a new container with the fake backend
+    """
+    sessions = make_sessions()
+    monkeypatch.setattr(accounts, 'SESSIONS_BACKEND', lambda session_name=None: sessions)
+    monkeypatch.setattr(lambda_handler, 'ENGINE', dict())
+    monkeypatch.setattr(lambda_handler, 'SESSIONS', dict())
+    return lambda_handler.lambda_handler
+
+
+def test_the_handler_returns_the_message(handler):
+    assert handler(make_event(), None) == '[=] The s3snapshot was : Successful'
+    assert handler(dict(make_event(), action='prune', **{'keep-last': 1}), None) == '[=] The prune was : Successful'
+
+
+def test_the_full_result_on_request_and_warm_invocations(handler):
+    cold = handler(make_event(**{'full-result': True}), None)
+    warm = handler(make_event(**{'full-result': True}), None)
+
+    assert cold['success'] == VOLUMES
+    assert cold['message'] == '[=] The s3snapshot was : Successful'
+    assert cold['cold-start'] is True
+    assert warm['cold-start'] is False
+    # The warm invocations reuse the sessions (and clients) of the container
+    assert len(lambda_handler.SESSIONS) == 1
+
+
+class FakeLambda(object):
+    def __init__(self):
+        self.payloads = list()
+
+    def invoke(self, FunctionName, InvocationType, Payload, Qualifier=None):
+        self.payloads.append(json.loads(Payload))
+        return {'Payload': io.BytesIO(json.dumps({'result': 'Successful', 'success': 1}).encode('utf-8'))}
+
+
+class LambdaSessions(object):
+    def __init__(self):
+        self.lambda_client = FakeLambda()
+
+    def client(self, service, region=None, role_arn=None, config=None):
+        return self.lambda_client
+
+
+def test_the_shards_ask_for_the_full_result():
+    sessions = LambdaSessions()
+    results = LambdaDispatcher(function='s3snapshot', sessions=sessions).run([{'action': 'execute'}] * 2)
+
+    assert results == [{'result': 'Successful', 'success': 1}] * 2
+    assert all(payload['full-result'] for payload in sessions.lambda_client.payloads)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# test_metrics.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import json
+
+from s3snapshot import s3snapshot as module
+from s3snapshot.metrics import Metrics
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import INSTANCES
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import make_sessions
+
+
+def test_the_result_has_the_calls_of_each_operation_and_the_phases(sessions, ec2, monkeypatch):
+    monkeypatch.setattr(module, 'STOP_DELAY', 0.01)
+    result = s3snapshot(event=make_event(stop=True), sessions=sessions)
+    metrics = result['metrics']
+
+    assert result['result'] == SUCCESS
+    for operation, calls in ec2.calls.items():
+        assert metrics['operations'][operation]['calls'] == calls
+    assert metrics['operations']['create_snapshot']['calls'] == VOLUMES
+    assert metrics['operations']['start_instances']['calls'] == INSTANCES
+    assert set(['discovery', 'naming', 'create', 'stop', 'start', 'notify']) <= set(metrics['phases'])
+    assert metrics['phases']['create']['count'] == VOLUMES
+
+
+def test_the_throttles_and_retries_are_counted():
+    sessions = make_sessions(limits={'create-snapshot': 4})
+    result = s3snapshot(event=make_event(), sessions=sessions)
+    create = result['metrics']['operations']['create_snapshot']
+
+    assert result['success'] == VOLUMES
+    assert create['throttles'] == sessions.throttled()['create_snapshot'] > 0
+    assert create['retries'] == create['throttles']
+    assert create['calls'] == VOLUMES + create['throttles']
+    assert create['errors'] == 0
+
+
+def test_the_latency_percentiles_come_from_the_histogram():
+    metrics = Metrics()
+    for milliseconds in [1] * 90 + [40] * 9 + [20000]:
+        metrics.record('describe_instances', milliseconds / 1000.0)
+    metrics.record('create_snapshot', 0.001, error='IncorrectState')
+    data = metrics.to_dict()['operations']
+
+    latency = data['describe_instances']['latency-ms']
+    assert (latency['p50'], latency['p90'], latency['p99'], latency['max']) == (5.0, 5.0, 50.0, 20000.0)
+    assert data['describe_instances']['histogram-ms'] == {'<=5': 90, '<=50': 9, '>10000': 1}
+    assert data['create_snapshot']['error-codes'] == {'IncorrectState': 1}
+
+
+def test_the_metrics_are_emitted_as_embedded_metric_format(sessions, capsys):
+    s3snapshot(event=make_event(**{'emit-metrics': True}), sessions=sessions)
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"')]
+
+    operations = dict((line['Operation'], line) for line in lines if 'Operation' in line)
+    assert operations['create_snapshot']['Calls'] == VOLUMES
+    assert all(line['_aws']['CloudWatchMetrics'][0]['Namespace'] for line in lines)
+    assert any('Phase' in line for line in lines)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+#
+# test_multi_volume.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import INSTANCES
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import names
+
+
+def test_one_create_snapshots_call_per_instance(sessions, ec2):
+    result = s3snapshot(event=make_event(**{'multi-volume': True}), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['success'] == VOLUMES
+    assert ec2.calls['create_snapshots'] == INSTANCES
+    assert ec2.calls['create_snapshot'] == 0
+    assert len(result['snapshot-sets']) == INSTANCES
+    # The Name of each volume is written after the call
+    assert len(set(names(ec2))) == VOLUMES
+
+
+def test_exclude_root_leaves_out_the_boot_volume(sessions, ec2):
+    result = s3snapshot(event=make_event(**{'multi-volume': True, 'exclude-root': True}), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['success'] == VOLUMES - INSTANCES
+    assert sorted(ec2.by_volume) == sorted('vol-{0:08x}01'.format(number) for number in range(INSTANCES))
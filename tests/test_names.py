@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+#
+# test_names.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import collections
+
+from s3snapshot.ratelimit import RateLimiter
+from s3snapshot.ratelimit import throttled_client
+from s3snapshot.s3snapshot import SnapshotNameResolver
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import RATE_LIMITS
+from tests.helpers import REGION
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import names
+
+DATE = '20161117'
+
+
+def test_each_run_takes_the_next_letter(sessions, ec2):
+    for run in range(3):
+        s3snapshot(event=make_event(), sessions=sessions)
+        # One batched DescribeSnapshots call per run, not one per volume
+        assert ec2.calls['describe_snapshots'] == run + 1
+
+    prefixes = collections.Counter(name.split('-')[0][-1] for name in names(ec2))
+    assert prefixes == {'a': VOLUMES, 'b': VOLUMES, 'c': VOLUMES}
+    assert len(set(names(ec2))) == 3 * VOLUMES
+
+
+def test_names_increment_within_one_run(sessions):
+    resolver = SnapshotNameResolver(throttled_client(sessions, 'ec2', RateLimiter(RATE_LIMITS), region=REGION), DATE)
+    resolver.load([(None, 'vol-1')])
+
+    assert resolver('server', '/dev/xvda', 'vol-1') == 's{0}a-server-/dev/xvda'.format(DATE)
+    assert resolver('server', '/dev/xvda', 'vol-1') == 's{0}b-server-/dev/xvda'.format(DATE)
+    assert resolver('server', '/dev/xvda', 'vol-2') == 's{0}a-server-/dev/xvda'.format(DATE)
+
+
+def test_one_query_per_owner(sessions, ec2):
+    ec2.new_snapshot('vol-1', '', [{'Key': 'Name', 'Value': 's{0}c-server-/dev/xvda'.format(DATE)}])
+    resolver = SnapshotNameResolver(throttled_client(sessions, 'ec2', RateLimiter(RATE_LIMITS), region=REGION), DATE)
+    resolver.load([('111111111111', 'vol-1'), ('222222222222', 'vol-2'), ('222222222222', 'vol-3')])
+
+    assert ec2.calls['describe_snapshots'] == 2
+    assert resolver('server', '/dev/xvda', 'vol-1') == 's{0}d-server-/dev/xvda'.format(DATE)
+    assert resolver('server', '/dev/xvda', 'vol-3') == 's{0}a-server-/dev/xvda'.format(DATE)
+    # The volumes already loaded are not fetched again
+    resolver.load([('111111111111', 'vol-1')])
+    assert ec2.calls['describe_snapshots'] == 2
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+#
+# test_plan.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+from s3snapshot.plan import execute
+from s3snapshot.plan import plan
+from s3snapshot.s3snapshot import FAULT
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import names
+
+
+def test_execute_creates_the_planned_volumes(sessions, ec2, tmpdir):
+    path = str(tmpdir.join('plan.json'))
+    assert plan(event=make_event(plan=path), sessions=sessions)['result'] == SUCCESS
+    assert len(ec2.snapshots) == 0
+
+    result = execute(event=make_event(plan=path), sessions=sessions)
+    assert result['result'] == SUCCESS
+    assert result['success'] == VOLUMES
+    assert len(ec2.snapshots) == VOLUMES
+
+
+def test_execute_resolves_the_names_again(sessions, ec2, tmpdir):
+    path = str(tmpdir.join('plan.json'))
+    plan(event=make_event(plan=path), sessions=sessions)
+    # A run between the plan and its executions takes the names of the plan
+    assert s3snapshot(event=make_event(), sessions=sessions)['result'] == SUCCESS
+    for _ in range(2):
+        assert execute(event=make_event(plan=path), sessions=sessions)['result'] == SUCCESS
+
+    assert len(ec2.snapshots) == 3 * VOLUMES
+    assert len(set(names(ec2))) == 3 * VOLUMES
+
+
+def test_plan_needs_a_file(sessions):
+    assert plan(event=make_event(), sessions=sessions)['result'] == FAULT
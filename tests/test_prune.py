@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# test_prune.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+from s3snapshot.prune import prune
+from s3snapshot.s3snapshot import FAULT
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+
+
+def snapshot_runs(sessions, runs=3):
+    for _ in range(runs):
+        assert s3snapshot(event=make_event(), sessions=sessions)['result'] == SUCCESS
+
+
+def test_prune_keeps_the_last_snapshots_of_each_volume(sessions, ec2):
+    snapshot_runs(sessions)
+    result = prune(event=make_event(**{'keep-last': 1}), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['deleted'] == 2 * VOLUMES
+    assert sorted(len(snapshots) for snapshots in ec2.by_volume.values()) == [1] * VOLUMES
+
+
+def test_prune_only_the_selected_volumes(sessions, ec2):
+    snapshot_runs(sessions)
+    result = prune(event=make_event(instances=['i-00000000'], **{'keep-last': 1}), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['volumes'] == 2
+    assert result['deleted'] == 4
+    assert len(ec2.snapshots) == 3 * VOLUMES - 4
+    assert len(ec2.by_volume['vol-0000000000']) == 1
+    assert len(ec2.by_volume['vol-0000000100']) == 3
+
+
+def test_dry_run_deletes_nothing(sessions, ec2):
+    snapshot_runs(sessions)
+    result = prune(event=make_event(instances=['i-00000000'], **{'keep-last': 1, 'dry-run': True}),
+                   sessions=sessions)
+
+    assert result['candidates'] == 4
+    assert result['deleted'] == 0
+    assert len(result['dry-run']) == 4
+    assert len(ec2.snapshots) == 3 * VOLUMES
+    assert ec2.calls['delete_snapshot'] == 0
+
+
+def test_prune_refuses_the_keys_it_cannot_apply(sessions, ec2):
+    snapshot_runs(sessions, runs=1)
+    result = prune(event=make_event(**{'keep-last': 1, 'skip-unchanged': True}), sessions=sessions)
+
+    assert result['result'] == FAULT
+    assert len(ec2.snapshots) == VOLUMES
+
+
+def test_protected_snapshots_are_kept(sessions, ec2):
+    assert s3snapshot(event=make_event(protected=True), sessions=sessions)['result'] == SUCCESS
+    snapshot_runs(sessions, runs=2)
+    result = prune(event=make_event(**{'keep-last': 1}), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['protected'] == VOLUMES
+    assert result['deleted'] == VOLUMES
+    assert all(len(snapshots) == 2 for snapshots in ec2.by_volume.values())
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# test_ratelimit.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import pytest
+
+from benchmarks.fake import client_error
+from s3snapshot import ratelimit
+from s3snapshot.ratelimit import BACK_OFF
+from s3snapshot.ratelimit import RAMP_UP
+from s3snapshot.ratelimit import RateLimiter
+from s3snapshot.ratelimit import TokenBucket
+from s3snapshot.ratelimit import api_family
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import make_sessions
+
+
+@pytest.fixture(autouse=True)
+def no_delay(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'BASE_DELAY', 0.001)
+
+
+def test_bucket_ramps_up_and_backs_off():
+    bucket = TokenBucket(10.0, max_rate=10.5)
+    for _ in range(10):
+        bucket.success()
+    assert bucket.rate == 10.5
+
+    bucket.throttled()
+    assert bucket.rate == pytest.approx(10.5 * BACK_OFF)
+    # The throttles of the calls already in flight don't cut the rate again
+    bucket.throttled()
+    assert bucket.rate == pytest.approx(10.5 * BACK_OFF)
+    bucket.success()
+    assert bucket.rate == pytest.approx(10.5 * BACK_OFF + RAMP_UP)
+
+
+def test_bucket_never_goes_below_the_minimum():
+    bucket = TokenBucket(1.0, min_rate=0.5)
+    for _ in range(10):
+        bucket.last_throttle = 0.0
+        bucket.throttled()
+    assert bucket.rate == 0.5
+
+
+def test_throttled_calls_are_retried():
+    limiter = RateLimiter({'create-snapshot': 40})
+    responses = [client_error('RequestLimitExceeded', 'CreateSnapshot')] * 2 + ['created']
+
+    def call():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert limiter.call('create-snapshot', call) == 'created'
+    assert limiter.throttles == 2
+    assert limiter.retries == 2
+    assert limiter.rates()['create-snapshot'] < 40
+
+
+def test_other_errors_are_not_retried():
+    limiter = RateLimiter()
+
+    def call():
+        raise client_error('InvalidVolume.NotFound', 'CreateSnapshot')
+
+    with pytest.raises(Exception):
+        limiter.call('create-snapshot', call)
+    assert limiter.retries == 0
+
+
+def test_api_families():
+    assert api_family('describe_snapshots') == 'describe'
+    assert api_family('create_snapshots') == 'create-snapshot'
+    assert api_family('create_tags') == 'tagging'
+    assert api_family('stop_instances') == 'instance-state'
+    assert api_family('publish') == 'other'
+
+
+def test_run_under_throttling_succeeds():
+    sessions = make_sessions(limits={'create-snapshot': 4})
+    result = s3snapshot(event=make_event(concurrency=4, **{'rate-limits': {'create-snapshot': 40}}),
+                        sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['success'] == VOLUMES
+    assert result['throttling-retries'] > 0
+    assert result['rate-limits']['create-snapshot'] < 40
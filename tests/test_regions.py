@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# test_regions.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+from s3snapshot import s3snapshot as module
+from s3snapshot.s3snapshot import FAULT
+from s3snapshot.s3snapshot import PARTIAL
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import make_sessions
+
+REGIONS = ['us-east-1', 'eu-west-1']
+
+
+def test_regions_are_snapshotted_in_one_run():
+    sessions = make_sessions(regions=REGIONS)
+    result = s3snapshot(event=make_event(regions=REGIONS), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['success'] == 2 * VOLUMES
+    assert sorted(result['regions']) == sorted(REGIONS)
+    assert all(len(sessions.client('ec2', region=region).snapshots) == VOLUMES for region in REGIONS)
+    assert sessions.sns.calls['publish'] >= 1
+
+
+def test_a_failure_after_the_discovery_only_faults_its_region(monkeypatch):
+    track_completion = module.track_completion
+
+    def fail_in_eu(client, created, options, totals, on_result=None):
+        if client.client is sessions.client('ec2', region='eu-west-1'):
+            raise RuntimeError('completion failed')
+        return track_completion(client, created, options, totals, on_result=on_result)
+
+    sessions = make_sessions(regions=REGIONS)
+    monkeypatch.setattr(module, 'track_completion', fail_in_eu)
+    result = s3snapshot(event=make_event(regions=REGIONS, **{'track-completion': True}), sessions=sessions)
+
+    assert result['result'] == PARTIAL
+    assert result['regions']['us-east-1']['result'] == SUCCESS
+    assert result['regions']['eu-west-1']['result'] == FAULT
+    # The snapshots created before the failure keep their counts
+    assert result['regions']['eu-west-1']['success'] == VOLUMES
+    assert sessions.sns.calls['publish'] >= 1
+
+
+def test_an_unexpected_error_of_a_target_only_faults_its_region(monkeypatch):
+    snapshot_region = module.snapshot_region
+
+    def fail_in_eu(options, region=None, role_arn=None, sessions=None):
+        if region == 'eu-west-1':
+            raise RuntimeError('unexpected')
+        return snapshot_region(options, region=region, role_arn=role_arn, sessions=sessions)
+
+    sessions = make_sessions(regions=REGIONS)
+    monkeypatch.setattr(module, 'snapshot_region', fail_in_eu)
+    result = s3snapshot(event=make_event(regions=REGIONS), sessions=sessions)
+
+    assert result['result'] == PARTIAL
+    assert result['success'] == VOLUMES
+    assert result['regions']['eu-west-1']['result'] == FAULT
+    assert sessions.sns.calls['publish'] >= 1
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# test_report.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import json
+
+from benchmarks.fake import client_error
+from s3snapshot.report import OTHER
+from s3snapshot.report import ErrorSummary
+from s3snapshot.s3snapshot import PARTIAL
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import REGION
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+
+FAILING = ('vol-0000000000', 'vol-0000000201')
+
+
+def test_one_result_line_per_volume_and_errors_by_code(sessions, ec2, monkeypatch, tmpdir):
+    create_snapshot = ec2.create_snapshot
+
+    def failing_create_snapshot(**kwargs):
+        if kwargs['VolumeId'] in FAILING:
+            raise client_error('IncorrectState', 'CreateSnapshot')
+        return create_snapshot(**kwargs)
+
+    monkeypatch.setattr(ec2, 'create_snapshot', failing_create_snapshot)
+    path = tmpdir.join('results.jsonl')
+    result = s3snapshot(event=make_event(report=str(path)), sessions=sessions)
+
+    assert result['result'] == PARTIAL
+    records = [json.loads(line) for line in path.readlines()]
+    assert len(records) == VOLUMES
+    assert all(record['region'] == REGION for record in records)
+    failures = dict((record['volume-id'], record) for record in records if record['status'] == 'failure')
+    assert sorted(failures) == sorted(FAILING)
+    assert all(record['error-code'] == 'IncorrectState' for record in failures.values())
+    assert all(record['snapshot-id'] in ec2.snapshots for record in records if record['status'] == 'success')
+
+    assert list(result['errors']) == ['IncorrectState']
+    assert result['errors']['IncorrectState']['count'] == len(FAILING)
+
+
+def test_the_summary_is_bounded():
+    summary = ErrorSummary(max_groups=2, exemplars=1, exemplar_size=20)
+    for index in range(100):
+        summary.add('Timeout waiting for instance i-{0:08x} to stop'.format(index))
+    summary.add('An error occurred (IncorrectState) when calling the CreateSnapshot operation')
+    summary.add('Traceback (most recent call last):\nValueError: bad value')
+    groups = summary.to_dict()
+
+    assert len(summary) == 102
+    # ValueError is above max_groups
+    assert sorted(groups) == sorted(['Timeout waiting for instance i-<id> to stop', 'IncorrectState', OTHER])
+    assert groups['Timeout waiting for instance i-<id> to stop']['count'] == 100
+    assert len(groups['Timeout waiting for instance i-<id> to stop']['exemplars']) == 1
+    assert all(len(exemplar) <= 20 for group in groups.values() for exemplar in group['exemplars'])
+
+    # The groups of a worker are added
+    other = ErrorSummary()
+    other.add('Traceback (most recent call last):\nValueError: bad value')
+    summary.merge(other)
+    assert summary.to_dict()[OTHER]['count'] == 2
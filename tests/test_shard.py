@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# test_shard.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+from s3snapshot.plan import execute
+from s3snapshot.s3snapshot import FAULT
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.shard import COORDINATOR_MARGIN
+from s3snapshot.shard import coordinate
+from s3snapshot.shard import split_plan
+from tests.helpers import INSTANCES
+from tests.helpers import LambdaContext
+from tests.helpers import REGION
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+from tests.helpers import make_sessions
+from tests.helpers import names
+
+SIZES = (4, 3, 3, 2, 2, 1, 1)
+
+
+class InlineDispatcher(object):
+    def __init__(self, sessions):
+        """
+        Execute the shards one after the other in the process of the test and keep their events
+        """
+        self.sessions = sessions
+        self.events = list()
+
+    def run(self, events, program=''):
+        self.events.extend(events)
+        return [execute(event=event, sessions=self.sessions) for event in events]
+
+
+class FailingDispatcher(object):
+    def run(self, events, program=''):
+        raise RuntimeError('dispatch failed')
+
+
+def test_the_shards_are_balanced_without_splitting_the_instances():
+    targets = [{'region': region, 'instances': [
+        {'instance-id': 'i-{0}{1}'.format(region, index), 'volumes': ['vol'] * size}
+        for index, size in enumerate(SIZES)]} for region in ('a', 'b')]
+    shards = split_plan({'targets': targets, 'volumes': 2 * sum(SIZES)}, 4)
+
+    assert [shard['volumes'] for shard in shards] == [8, 8, 8, 8]
+    instances = [instance['instance-id'] for shard in shards for target in shard['targets']
+                 for instance in target['instances']]
+    assert sorted(instances) == sorted(instance['instance-id'] for target in targets
+                                       for instance in target['instances'])
+
+
+def test_more_shards_than_instances():
+    targets = [{'instances': [{'volumes': ['vol'] * 2}]}]
+    assert [shard['volumes'] for shard in split_plan({'targets': targets, 'volumes': 2}, 3)] == [2]
+
+
+def test_the_coordinator_aggregates_the_shards():
+    sessions = make_sessions()
+    dispatcher = InlineDispatcher(sessions)
+    result = coordinate(event=make_event(shards=INSTANCES), sessions=sessions, dispatcher=dispatcher)
+
+    assert result['result'] == SUCCESS
+    assert result['success'] == VOLUMES
+    assert [shard['volumes'] for shard in result['shards']] == [VOLUMES // INSTANCES] * INSTANCES
+    assert all(event['notify'] is False for event in dispatcher.events)
+    assert len(set(names(sessions.client('ec2', region=REGION)))) == VOLUMES
+    # One SNS message for the whole run
+    assert sessions.sns.calls['publish'] == 1
+
+
+def test_the_workers_end_before_the_coordinator():
+    sessions = make_sessions()
+    dispatcher = InlineDispatcher(sessions)
+    coordinate(event=make_event(shards=2), context=LambdaContext(600), sessions=sessions, dispatcher=dispatcher)
+
+    assert all(event['time-budget'] <= 600 - COORDINATOR_MARGIN for event in dispatcher.events)
+
+
+def test_a_failing_dispatcher_fails_every_shard():
+    sessions = make_sessions()
+    result = coordinate(event=make_event(shards=2), sessions=sessions, dispatcher=FailingDispatcher())
+
+    assert result['result'] == FAULT
+    assert [shard['result'] for shard in result['shards']] == [FAULT, FAULT]
+    assert result['failures'] == VOLUMES
+    assert list(result['errors']) == ['RuntimeError']
+    # The message of the run and the message of the errors
+    assert sessions.sns.calls['publish'] == 2
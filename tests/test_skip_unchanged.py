@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+# test_skip_unchanged.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+
+
+def test_volumes_with_a_recent_snapshot_are_skipped(sessions, ec2):
+    s3snapshot(event=make_event(), sessions=sessions)
+    describes = ec2.calls['describe_snapshots']
+
+    result = s3snapshot(event=make_event(**{'skip-unchanged': True}), sessions=sessions)
+    assert result['result'] == SUCCESS
+    assert len(ec2.snapshots) == VOLUMES
+    assert len(result['skipped-volumes']) == VOLUMES
+    assert all(item['reason'].startswith('Last snapshot taken') for item in result['skipped-volumes'])
+    assert set(item['snapshot-id'] for item in result['skipped-volumes']) == set(ec2.snapshots)
+    # The latest snapshots of all the volumes are listed with one paginated call
+    assert ec2.calls['describe_snapshots'] - describes == 1
+
+
+def test_running_instances_are_snapshotted_after_the_min_interval(sessions, ec2):
+    s3snapshot(event=make_event(), sessions=sessions)
+    result = s3snapshot(event=make_event(**{'skip-unchanged': True, 'min-interval': 0}), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['skipped-volumes'] == []
+    assert len(ec2.snapshots) == 2 * VOLUMES
+
+
+def test_stopped_instances_snapshotted_since_the_stop_are_skipped(sessions, ec2):
+    ec2.stop_delay = 0
+    ec2.stop_instances(InstanceIds=list(ec2.instances))
+    ec2.refresh_states()
+    s3snapshot(event=make_event(), sessions=sessions)
+
+    result = s3snapshot(event=make_event(**{'skip-unchanged': True, 'min-interval': 0}), sessions=sessions)
+    assert len(ec2.snapshots) == VOLUMES
+    assert len(result['skipped-volumes']) == VOLUMES
+    assert all(item['reason'] == 'Instance stopped before the last snapshot' for item in result['skipped-volumes'])
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# test_stop.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+import collections
+
+import pytest
+
+from s3snapshot import s3snapshot as module
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import INSTANCES
+from tests.helpers import VOLUMES
+from tests.helpers import Recorder
+from tests.helpers import make_event
+
+
+@pytest.fixture(autouse=True)
+def stop_delay(monkeypatch):
+    # The fake instances stop in stop_delay (0.05 seconds): poll them without the 5 seconds of STOP_DELAY
+    monkeypatch.setattr(module, 'STOP_DELAY', 0.01)
+
+
+@pytest.fixture
+def recorders(ec2, monkeypatch):
+    recorders = dict((name, Recorder(getattr(ec2, name))) for name in ('stop_instances', 'start_instances'))
+    for name, recorder in recorders.items():
+        monkeypatch.setattr(ec2, name, recorder)
+    return recorders
+
+
+@pytest.mark.parametrize('multi_volume', [False, True])
+def test_stop_is_one_batched_call_and_one_start_per_instance(sessions, ec2, recorders, multi_volume):
+    result = s3snapshot(event=make_event(stop=True, **{'multi-volume': multi_volume}), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert result['success'] == VOLUMES
+    stops = recorders['stop_instances'].calls
+    assert len(stops) == 1
+    assert sorted(stops[0]['InstanceIds']) == sorted(ec2.instances)
+    starts = collections.Counter(instance_id for call in recorders['start_instances'].calls
+                                 for instance_id in call['InstanceIds'])
+    assert len(recorders['start_instances'].calls) == INSTANCES
+    assert starts == collections.Counter(dict((instance_id, 1) for instance_id in ec2.instances))
+    assert all('[Stop : True]' in snapshot['Description'] for snapshot in ec2.snapshots.values())
+    assert all(instance['State']['Name'] == 'running' for instance in ec2.instances.values())
+
+
+def test_stopped_skips_the_running_instances(sessions, ec2):
+    result = s3snapshot(event=make_event(stopped=True), sessions=sessions)
+
+    assert result['success'] == 0
+    assert result['failures'] == VOLUMES
+    assert len(ec2.snapshots) == 0
+    assert ec2.calls['stop_instances'] == 0
+
+
+def test_stopped_snapshots_the_stopped_instances(sessions, ec2, recorders):
+    ec2.instances['i-00000000']['State'] = {'Name': 'stopped'}
+    result = s3snapshot(event=make_event(stopped=True), sessions=sessions)
+
+    assert result['success'] == 2
+    assert set(snapshot['VolumeId'] for snapshot in ec2.snapshots.values()) == {'vol-0000000000', 'vol-0000000001'}
+    assert recorders['stop_instances'].calls == []
+    # Started once per instance (not once per volume)
+    assert len(recorders['start_instances'].calls) == INSTANCES
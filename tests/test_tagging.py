@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+#
+# test_tagging.py
+#
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+from benchmarks.fake import client_error
+from s3snapshot.s3snapshot import SUCCESS
+from s3snapshot.s3snapshot import s3snapshot
+from tests.helpers import VOLUMES
+from tests.helpers import make_event
+
+
+def tag_keys(snapshot):
+    return set(tag['Key'] for tag in snapshot['Tags'])
+
+
+def test_tags_are_applied_at_creation(sessions, ec2):
+    result = s3snapshot(event=make_event(), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert ec2.calls['create_tags'] == 0
+    assert all(tag_keys(snapshot) >= {'Name', 'Scripted', 'State:Protected', 'Env'}
+               for snapshot in ec2.snapshots.values())
+
+
+def test_fallback_to_batched_create_tags(sessions, ec2, monkeypatch):
+    create_snapshot = ec2.create_snapshot
+
+    def without_tag_specifications(TagSpecifications=None, **kwargs):
+        if TagSpecifications:
+            raise client_error('UnknownParameter', 'CreateSnapshot')
+        return create_snapshot(**kwargs)
+
+    monkeypatch.setattr(ec2, 'create_snapshot', without_tag_specifications)
+    result = s3snapshot(event=make_event(), sessions=sessions)
+
+    assert result['result'] == SUCCESS
+    assert len(ec2.snapshots) == VOLUMES
+    assert all(tag_keys(snapshot) >= {'Name', 'Scripted', 'State:Protected', 'Env'}
+               for snapshot in ec2.snapshots.values())
+    # The tags shared by all the snapshots go in one call, the Name of each snapshot in its own call
+    assert ec2.calls['create_tags'] <= VOLUMES + 1